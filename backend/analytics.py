@@ -0,0 +1,218 @@
+import atexit
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timezone
+
+import metadata_index
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Round-robin rollups: every event is added to its hour, day and month bucket at flush
+# time, and each resolution expires on its own schedule (hours first, months last), so
+# old history is kept only at coarse resolution. Queries never scan raw events.
+# key = '' holds the bucket-wide total of each bucket (R2 keys are never empty), which
+# keeps total time series to one row per bucket however many files there are.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analytics (
+    resolution TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    downloads INTEGER NOT NULL DEFAULT 0,
+    bytes_out INTEGER NOT NULL DEFAULT 0,
+    uploads INTEGER NOT NULL DEFAULT 0,
+    bytes_in INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (resolution, bucket, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_analytics_key ON analytics (resolution, key, bucket);
+"""
+
+TOTAL_KEY = ''
+METRICS = ('downloads', 'bytes_out', 'uploads', 'bytes_in')
+RESOLUTIONS = {'h': 'hour', 'd': 'day', 'm': 'month'}
+PRUNE_EVERY = 3600
+
+settings = {'retention': {'hour': 7, 'day': 90, 'month': 24 * 31}}  # days per resolution
+# (hour bucket, key) -> [downloads, bytes_out, uploads, bytes_in], until the next flush
+pending = {}
+pending_lock = threading.Lock()
+
+
+def init_analytics(hourly_days, daily_days, monthly_months):
+    metadata_index.get_connection().executescript(SCHEMA)
+    settings['retention'] = {'hour': hourly_days, 'day': daily_days, 'month': monthly_months * 31}
+
+
+# Bucketing (UTC)
+def bucket_start(resolution, ts):
+    ts = int(ts)
+    if resolution == 'hour':
+        return ts - ts % 3600
+    if resolution == 'day':
+        return ts - ts % 86400
+    dt = datetime.fromtimestamp(ts, timezone.utc)
+    return int(datetime(dt.year, dt.month, 1, tzinfo=timezone.utc).timestamp())
+
+
+def next_bucket(resolution, start):
+    if resolution == 'hour':
+        return start + 3600
+    if resolution == 'day':
+        return start + 86400
+    dt = datetime.fromtimestamp(start, timezone.utc)
+    year, month = (dt.year + 1, 1) if dt.month == 12 else (dt.year, dt.month + 1)
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp())
+
+
+# Recording
+def record(key, downloads=0, bytes_out=0, uploads=0, bytes_in=0):
+    hour = bucket_start('hour', time.time())
+    with pending_lock:
+        counts = pending.setdefault((hour, key), [0, 0, 0, 0])
+        counts[0] += downloads
+        counts[1] += bytes_out
+        counts[2] += uploads
+        counts[3] += bytes_in
+
+
+def record_download(key):
+    record(key, downloads=1)
+
+
+def record_bytes_out(key, count):
+    if count:
+        record(key, bytes_out=count)
+
+
+def record_upload(key, size):
+    record(key, uploads=1, bytes_in=size)
+
+
+def metered(body, key):
+    """Pass a download body through, adding the bytes actually sent (after it ends) to key's rollups."""
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        record_bytes_out(key, sent)
+
+
+@metrics.timed('analytics_flush')
+def flush():
+    """Add buffered events to the hour, day and month rollups. Returns the number of rows written."""
+    with pending_lock:
+        batch = dict(pending)
+        pending.clear()
+    if not batch:
+        return 0
+
+    rows = {}
+    for (hour, key), counts in batch.items():
+        for resolution in ('hour', 'day', 'month'):
+            bucket = hour if resolution == 'hour' else bucket_start(resolution, hour)
+            for row_key in (key, TOTAL_KEY):
+                row = rows.setdefault((resolution, bucket, row_key), [0, 0, 0, 0])
+                for i, n in enumerate(counts):
+                    row[i] += n
+    try:
+        with metadata_index.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO analytics (resolution, bucket, key, downloads, bytes_out, uploads, bytes_in) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(resolution, bucket, key) DO UPDATE SET "
+                "downloads = downloads + excluded.downloads, bytes_out = bytes_out + excluded.bytes_out, "
+                "uploads = uploads + excluded.uploads, bytes_in = bytes_in + excluded.bytes_in",
+                [(*row_id, *counts) for row_id, counts in rows.items()]
+            )
+    except Exception as e:
+        # Put the events back so the next flush retries them
+        logger.error(f"Analytics flush failed: {e}")
+        with pending_lock:
+            for bucket_key, counts in batch.items():
+                merged = pending.setdefault(bucket_key, [0, 0, 0, 0])
+                for i, n in enumerate(counts):
+                    merged[i] += n
+        return 0
+    return len(rows)
+
+
+def prune():
+    """Drop buckets older than their resolution's retention."""
+    now = time.time()
+    with metadata_index.transaction() as conn:
+        for resolution, days in settings['retention'].items():
+            conn.execute(
+                "DELETE FROM analytics WHERE resolution = ? AND bucket < ?",
+                (resolution, bucket_start(resolution, now - days * 86400))
+            )
+
+
+def start_flusher(interval):
+    def loop():
+        last_prune = 0
+        while True:
+            time.sleep(interval)
+            try:
+                flush()
+                if time.time() - last_prune >= PRUNE_EVERY:
+                    prune()
+                    last_prune = time.time()
+            except Exception as e:
+                logger.error(f"Analytics maintenance failed: {e}")
+
+    thread = threading.Thread(target=loop, name='analytics-flusher', daemon=True)
+    thread.start()
+    atexit.register(flush)
+    return thread
+
+
+# Queries
+def parse_period(period):
+    """'24h', '7d' or '12m' -> (resolution, first bucket start). Raises ValueError."""
+    match = re.fullmatch(r'(\d{1,4})([hdm])', period or '')
+    if not match or int(match.group(1)) < 1:
+        raise ValueError("period must look like 24h, 7d or 12m")
+    count, resolution = int(match.group(1)), RESOLUTIONS[match.group(2)]
+    start = bucket_start(resolution, time.time())
+    for _ in range(count - 1):  # the current bucket counts as the first
+        start = bucket_start(resolution, start - 1)
+    return resolution, start
+
+
+def top_keys(period, metric='downloads', limit=10):
+    """Files with the highest `metric` over the period, with all their totals."""
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+    resolution, start = parse_period(period)
+    rows = metadata_index.get_connection().execute(
+        "SELECT key, SUM(downloads) AS downloads, SUM(bytes_out) AS bytes_out, "
+        "SUM(uploads) AS uploads, SUM(bytes_in) AS bytes_in FROM analytics "
+        f"WHERE resolution = ? AND bucket >= ? AND key != ? GROUP BY key HAVING SUM({metric}) > 0 "
+        f"ORDER BY SUM({metric}) DESC, key LIMIT ?",
+        (resolution, start, TOTAL_KEY, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def series(period, key=None):
+    """One point per bucket over the period (zeros included), for one file or the whole bucket."""
+    resolution, start = parse_period(period)
+    rows = metadata_index.get_connection().execute(
+        "SELECT bucket, downloads, bytes_out, uploads, bytes_in FROM analytics "
+        "WHERE resolution = ? AND key = ? AND bucket >= ? ORDER BY bucket",
+        (resolution, key or TOTAL_KEY, start)
+    ).fetchall()
+    found = {row['bucket']: row for row in rows}
+    points = []
+    end = bucket_start(resolution, time.time())
+    bucket = start
+    while bucket <= end:
+        row = found.get(bucket)
+        point = {'bucket': datetime.fromtimestamp(bucket, timezone.utc).isoformat()}
+        point.update({name: row[name] if row else 0 for name in METRICS})
+        points.append(point)
+        bucket = next_bucket(resolution, bucket)
+    return resolution, points
@@ -1,18 +1,38 @@
+import base64
 import hmac
 import json
 import logging
 import math
 import os
 import secrets
+import threading
 import time
 from datetime import datetime, timedelta
 from functools import wraps
+from urllib.parse import quote
 
-import boto3
 import jwt
 from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, send_from_directory, send_file, redirect, Response, make_response
+from flask import Flask, request, jsonify, send_from_directory, send_file, redirect, Response, make_response, g
+from werkzeug.http import http_date
+
+import analytics
+import auth_sessions
+import change_feed
+import compression
+import counter_store
+import dedup
+import download_tickets
+import metadata_index
+import metrics
+import multipart_uploads
+import object_cache
+import rate_limiter
+import shards
+import thumbnails
+import transfer_manager
+import zip_stream
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
@@ -21,52 +41,159 @@ load_dotenv()
 app = Flask(__name__, static_folder=None)
 
 # Cloudflare R2 Configuration
-R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
-R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
-R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
+# R2_ACCOUNT_ID, R2_ACCESS_KEY_ID, R2_SECRET_ACCESS_KEY, R2_BUCKET_NAME, R2_PUBLIC_URL and
+# R2_ENDPOINT_URL (any S3-compatible endpoint, e.g. a local emulator for benchmarks) describe
+# the bucket; R2_SHARDS spreads files over several buckets or accounts (see shards.py)
 R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
-R2_ENDPOINT_URL = f"https://{R2_ACCOUNT_ID}.r2.cloudflarestorage.com"
-R2_PUBLIC_URL = os.getenv("R2_PUBLIC_URL")
+SHARD_CONFIGS = shards.configs_from_env()
 PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost").rstrip('/')
 
+# Legacy JSON counters, imported once into the counter store
 DOWNLOAD_COUNT_FILE = 'data/download_counts.json'
 UPLOAD_HISTORY_FILE = 'data/upload_history.json'
 
+# Counter store: buffered in memory, flushed to SQLite (WAL) in batches
+COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", "2"))
+COUNTER_COMPACT_INTERVAL = int(os.getenv("COUNTER_COMPACT_INTERVAL", "3600"))
+
+# Local metadata index (SQLite), re-synced against R2 in the background
+INDEX_SYNC_INTERVAL = int(os.getenv("INDEX_SYNC_INTERVAL", "300"))
+
+# Bucket stats are cached briefly so concurrent dashboard refreshes share one computation
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "5"))
+stats_cache = {"value": None, "expires": 0.0}
+stats_cache_lock = threading.Lock()
+
+# Downloads: optional parallel ranged prefetch for large files
+PARALLEL_DOWNLOADS = os.getenv("PARALLEL_DOWNLOADS", "false").lower() == "true"
+PARALLEL_DOWNLOAD_THRESHOLD = int(os.getenv("PARALLEL_DOWNLOAD_THRESHOLD", str(64 * 1024 * 1024)))
+PARALLEL_DOWNLOAD_PART_SIZE = int(os.getenv("PARALLEL_DOWNLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+PARALLEL_DOWNLOAD_WORKERS = int(os.getenv("PARALLEL_DOWNLOAD_WORKERS", "4"))
+
+# Uploads at or below this size go out as one conditional put_object
+SINGLE_PUT_MAX = 1024 * 1024 * 10
+KEY_ALLOCATION_ATTEMPTS = 3
+# Larger uploads go through transfer_manager: part size follows the object size, and part
+# concurrency adapts between MIN and MAX across all uploads in the process
+TRANSFER_MIN_CONCURRENCY = int(os.getenv("TRANSFER_MIN_CONCURRENCY", "2"))
+TRANSFER_MAX_CONCURRENCY = int(os.getenv("TRANSFER_MAX_CONCURRENCY", "16"))
+TRANSFER_MAX_INFLIGHT_BYTES = int(os.getenv("TRANSFER_MAX_INFLIGHT_BYTES", str(256 * 1024 * 1024)))
+TRANSFER_MAX_BANDWIDTH = int(os.getenv("TRANSFER_MAX_BANDWIDTH", "0"))  # bytes/s to R2, 0 = unlimited
+
+# Optional upload deduplication: uploads through /api/upload are SHA-256'd as they stream to R2,
+# and a file whose content is already stored becomes an alias of it instead of a second copy
+DEDUP_UPLOADS = os.getenv("DEDUP_UPLOADS", "false").lower() == "true"
+
+# Optional compression of compressible uploads through /api/upload (gzip, or zstd with the
+# zstandard package): files of at least COMPRESSION_MIN_SIZE whose first bytes shrink to
+# COMPRESSION_MAX_RATIO or less are stored encoded, and decompressed for clients that need it
+COMPRESSION_ENABLED = os.getenv("COMPRESSION", "false").lower() == "true"
+COMPRESSION_ENCODING = os.getenv("COMPRESSION_ENCODING", "gzip").lower()
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", str(64 * 1024)))
+COMPRESSION_MAX_RATIO = float(os.getenv("COMPRESSION_MAX_RATIO", "0.8"))
+
+# Resumable chunked uploads (S3 multipart); idle sessions are aborted by a janitor
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_JANITOR_INTERVAL = int(os.getenv("UPLOAD_JANITOR_INTERVAL", "3600"))
+
+# Direct-to-R2 transfers: clients move bytes with short-lived presigned URLs
+DIRECT_TRANSFERS = os.getenv("DIRECT_TRANSFERS", "false").lower() == "true"
+DIRECT_URL_EXPIRES = int(os.getenv("DIRECT_URL_EXPIRES", "900"))
+DIRECT_SINGLE_PUT_MAX = int(os.getenv("DIRECT_SINGLE_PUT_MAX", str(64 * 1024 * 1024)))
+# Browsers talk to every shard's endpoint (the CSP must allow each)
+R2_ENDPOINTS = list(dict.fromkeys(config['endpoint_url'] for config in SHARD_CONFIGS))
+
+# Optional read-through disk cache for downloads (bounded by total bytes)
+OBJECT_CACHE_ENABLED = os.getenv("OBJECT_CACHE", "false").lower() == "true"
+OBJECT_CACHE_DIR = os.getenv("OBJECT_CACHE_DIR", "data/object-cache")
+OBJECT_CACHE_MAX_BYTES = int(os.getenv("OBJECT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+OBJECT_CACHE_MAX_OBJECT_BYTES = int(os.getenv("OBJECT_CACHE_MAX_OBJECT_BYTES", str(256 * 1024 * 1024)))
+
+# Optional thumbnails for images (and video poster frames, with ffmpeg), stored under .thumbnails/
+THUMBNAILS_ENABLED = os.getenv("THUMBNAILS", "false").lower() == "true"
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_MAX_SOURCE_BYTES = int(os.getenv("THUMBNAIL_MAX_SOURCE_BYTES", str(50 * 1024 * 1024)))
+
+# Multi-file ZIP downloads: objects fetched concurrently ahead of the archive writer
+ZIP_MAX_FILES = int(os.getenv("ZIP_MAX_FILES", "10000"))
+ZIP_PREFETCH_FILES = int(os.getenv("ZIP_PREFETCH_FILES", "4"))
+
+# Live dashboard updates (SSE at /api/events): seconds of events kept for reconnecting clients,
+# and open streams per process in WSGI mode (each holds a gunicorn thread; the ASGI server has no limit)
+CHANGE_FEED_RETENTION = int(os.getenv("CHANGE_FEED_RETENTION", "3600"))
+CHANGE_FEED_MAX_STREAMS = int(os.getenv("CHANGE_FEED_MAX_STREAMS", "8"))
+
+# Browser downloads through signed tickets (/api/dl/...): the download must start within
+# DOWNLOAD_TICKET_TTL seconds, and can then be paused and resumed for DOWNLOAD_RESUME_WINDOW
+# (but not after the session that asked for the ticket expires)
+DOWNLOAD_TICKET_TTL = int(os.getenv("DOWNLOAD_TICKET_TTL", "60"))
+DOWNLOAD_RESUME_WINDOW = int(os.getenv("DOWNLOAD_RESUME_WINDOW", "3600"))
+
+# Download/upload analytics: hourly, daily and monthly rollups, each kept for its own period
+ANALYTICS_HOURLY_RETENTION_DAYS = int(os.getenv("ANALYTICS_HOURLY_RETENTION_DAYS", "7"))
+ANALYTICS_DAILY_RETENTION_DAYS = int(os.getenv("ANALYTICS_DAILY_RETENTION_DAYS", "90"))
+ANALYTICS_MONTHLY_RETENTION_MONTHS = int(os.getenv("ANALYTICS_MONTHLY_RETENTION_MONTHS", "24"))
+ANALYTICS_TOP_MAX = 100
+
+# File listing pagination
+FILES_PAGE_DEFAULT = 60
+FILES_PAGE_MAX = 500
+
+# Metrics: /metrics is served on the internal network only (nginx does not proxy it);
+# set METRICS_TOKEN to also require "Authorization: Bearer <token>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Optional profiling: sample this fraction of requests, keep profiles of those slower than the threshold
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_REQUEST_MS = float(os.getenv("PROFILE_SLOW_REQUEST_MS", "1000"))
+PROFILE_DIR = 'data/profiles'
+
 # Authentication Configuration
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "")
 AUTH_SECRET_KEY = os.getenv("AUTH_SECRET_KEY", secrets.token_hex(64))
 AUTH_COOKIE_NAME = "__Host-auth_token"
 AUTH_SESSION_HOURS = int(os.getenv("AUTH_SESSION_HOURS", "24"))
+# Seconds nginx may reuse a successful /api/auth/verify answer for the same cookie
+AUTH_VERIFY_CACHE_SECONDS = int(os.getenv("AUTH_VERIFY_CACHE_SECONDS", "10"))
 
-# In-memory Rate Limiter
-login_attempts = {}  # {ip: [(timestamp, ...], ...}
+# Rate Limiting (token buckets in the metadata DB, shared by every worker)
 RATE_LIMIT_WINDOW = 900  # 15mins
 RATE_LIMIT_MAX = 3
+# Per-client request limits for uploads and downloads, per minute (0 = unlimited)
+UPLOAD_RATE_LIMIT = int(os.getenv("UPLOAD_RATE_LIMIT", "0"))
+DOWNLOAD_RATE_LIMIT = int(os.getenv("DOWNLOAD_RATE_LIMIT", "0"))
+LOGIN_LIMIT = rate_limiter.per_window('login', RATE_LIMIT_MAX, RATE_LIMIT_WINDOW)
+UPLOAD_LIMIT = rate_limiter.per_window('upload', UPLOAD_RATE_LIMIT, 60) if UPLOAD_RATE_LIMIT > 0 else None
+DOWNLOAD_LIMIT = rate_limiter.per_window('download', DOWNLOAD_RATE_LIMIT, 60) if DOWNLOAD_RATE_LIMIT > 0 else None
 
 def check_rate_limit(ip):
-    """Check if IP has exceeded login rate limit."""
-    now = time.time()
-    if ip not in login_attempts:
-        login_attempts[ip] = []
-    
-    # Clean old entries
-    login_attempts[ip] = [t for t in login_attempts[ip] if now - t < RATE_LIMIT_WINDOW]
-    
-    if len(login_attempts[ip]) >= RATE_LIMIT_MAX:
-        return False
-    return True
-
-def record_attempt(ip):
-    """Record a login attempt for rate limiting."""
-    now = time.time()
-    if ip not in login_attempts:
-        login_attempts[ip] = []
-    login_attempts[ip].append(now)
+    """Use up one login attempt for the IP. Returns (allowed, retry_after_seconds)."""
+    return rate_limiter.consume(LOGIN_LIMIT, ip)
 
 def get_client_ip():
     """Get real client IP, considering proxy headers."""
-    return request.headers.get('X-Real-IP', 
-           request.headers.get('X-Forwarded-For', request.remote_addr))
+    return rate_limiter.client_ip_from(request.headers, request.remote_addr)
+
+def rate_limit_response(retry_after, message="Too many requests. Please try again later."):
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def rate_limited(limit):
+    """Per-client request limit for a route (no-op when limit is None)."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if limit:
+                client_ip = get_client_ip()
+                allowed, retry_after = rate_limiter.consume(limit, client_ip)
+                if not allowed:
+                    app.logger.warning(f"{limit.scope.capitalize()} rate limit exceeded for IP: {client_ip}")
+                    return rate_limit_response(retry_after)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
 
 # JWT Token Management
 def generate_auth_token():
@@ -120,97 +247,177 @@ def verify_password(password):
         app.logger.error(f"Password verification error: {e}")
         return False
 
+def auth_cookie_name():
+    """__Host- cookies require Secure, so plain-HTTP deployments use a plain cookie name."""
+    return AUTH_COOKIE_NAME if PUBLIC_BASE_URL.startswith('https') else "auth_token"
+
+def verify_session(token):
+    """verify_auth_token behind a cache of already-verified tokens and the revocation list."""
+    payload = auth_sessions.cached_payload(token)
+    if payload:
+        return payload
+    payload = verify_auth_token(token)
+    if not payload or auth_sessions.is_revoked(payload['jti']):
+        return None
+    auth_sessions.remember(token, payload)
+    return payload
+
+def revoke_session(token):
+    """Server-side logout: the token stops working even if a copy of the cookie survives."""
+    payload = verify_auth_token(token) if token else None
+    if payload:
+        auth_sessions.revoke(payload['jti'], payload['exp'])
+
+def verify_cache_headers(payload):
+    """Let nginx cache a positive verify answer briefly, never beyond the token's expiry."""
+    ttl = max(0, min(AUTH_VERIFY_CACHE_SECONDS, int(payload['exp'] - time.time())))
+    return {'X-Accel-Expires': str(ttl)}
+
 # Authentication Decorator
 def require_auth(f):
     """Decorator to require authentication on API endpoints."""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        token = request.cookies.get(AUTH_COOKIE_NAME)
+        token = request.cookies.get(auth_cookie_name())
         if not token:
             return jsonify({"error": "Authentication required"}), 401
         
-        payload = verify_auth_token(token)
+        payload = verify_session(token)
         if not payload:
             response = make_response(jsonify({"error": "Invalid or expired session"}), 401)
             # Clear invalid cookie
-            response.delete_cookie(AUTH_COOKIE_NAME, path='/', samesite='Strict')
+            response.delete_cookie(auth_cookie_name(), path='/', samesite='Strict')
             return response
         
         return f(*args, **kwargs)
     return decorated_function
 
 # Security Headers Middleware
-@app.after_request
-def add_security_headers(response):
-    """Add security headers to every response."""
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-    response.headers['Permissions-Policy'] = 'camera=(), microphone=(), geolocation=()'
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
+# Shared with the ASGI server mode (asgi_app.py)
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'Referrer-Policy': 'strict-origin-when-cross-origin',
+    'Permissions-Policy': 'camera=(), microphone=(), geolocation=()',
+    'Cache-Control': 'no-store, no-cache, must-revalidate',
+    'Pragma': 'no-cache',
     # CSP: only allow scripts/styles from self and CDN sources used by frontend
-    response.headers['Content-Security-Policy'] = (
+    'Content-Security-Policy': (
         "default-src 'self'; "
         "script-src 'self' https://cdn.jsdelivr.net; "
         "style-src 'self' 'unsafe-inline' https://cdn.jsdelivr.net https://cdnjs.cloudflare.com; "
         "font-src 'self' https://cdnjs.cloudflare.com; "
         "img-src 'self' data:; "
-        "connect-src 'self'; "
+        f"connect-src 'self'{''.join(' ' + url for url in R2_ENDPOINTS) if DIRECT_TRANSFERS else ''}; "
         "frame-ancestors 'none'; "
         "base-uri 'self'; "
         "form-action 'self';"
-    )
+    ),
+}
+
+@app.after_request
+def add_security_headers(response):
+    """Add security headers to every response."""
+    for name, value in SECURITY_HEADERS.items():
+        response.headers[name] = value
     return response
 
+# Request Metrics
+request_profiler = metrics.RequestProfiler(PROFILE_SAMPLE_RATE, PROFILE_SLOW_REQUEST_MS, PROFILE_DIR)
+
+def request_route():
+    """Route template (not the raw path), so metric labels stay bounded."""
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.profiler = request_profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    route, method, status = request_route(), request.method, response.status_code
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        request_profiler.finish(profiler, route, time.perf_counter() - started)
+    # Streamed bodies are still being sent here; observe once the response is closed
+    response.call_on_close(lambda: metrics.http_request_duration.observe(
+        time.perf_counter() - started, method=method, route=route, status=status))
+    return response
+
+@app.teardown_request
+def release_request_profiler(exc):
+    # after_request is skipped when a request fails badly enough; never leave the profiler running
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        request_profiler.finish(profiler, request_route(), 0)
+
 # S3-Compatible Storage Client
-s3_client = boto3.client(
-    's3',
-    endpoint_url=R2_ENDPOINT_URL,
-    aws_access_key_id=R2_ACCESS_KEY_ID,
-    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-    region_name='auto'
+# Upload parts are streamed from the request body, which cannot be rewound for
+# the default checksums of newer botocore releases
+os.environ.setdefault("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+transfer_manager.configure(
+    TRANSFER_MIN_CONCURRENCY, TRANSFER_MAX_CONCURRENCY, TRANSFER_MAX_INFLIGHT_BYTES, TRANSFER_MAX_BANDWIDTH
 )
+# One client (and connection pool) per shard: R2_SHARDS, or just R2_BUCKET_NAME (see shards.py)
+def create_shard_client(config):
+    # Every shared transfer thread, plus request threads doing their own calls, gets a connection
+    client = shards.create_client(config, transfer_manager.connection_pool_size(extra=16))
+    metrics.instrument_s3_client(client)
+    transfer_manager.attach(client)
+    return client
+shards.init_shards(SHARD_CONFIGS, create_shard_client)
 
-# Helper Functions
-def get_download_counts():
-    """Read file JSON for counting any downloaded."""
-    if not os.path.exists(DOWNLOAD_COUNT_FILE):
-        return {}
-    try:
-        with open(DOWNLOAD_COUNT_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return {}
+# Metadata Index
+@metrics.timed('index_reconcile')
+def reconcile_index():
+    """Full paginated walk of every shard (in parallel) into the local index, then a stats recount."""
+    counter_store.flush()
+    files_before = metadata_index.get_totals(get_current_period_start())['total_files']
+    run = metadata_index.start_reconcile(shards.primary().name)
+    seen = shards.fan_out(lambda shard: metadata_index.reconcile_shard(
+        run, shard.client, shard.bucket, shard.name, skip_prefixes=(thumbnails.RESERVED_PREFIX,)
+    ))
+    _, removed = metadata_index.finish_reconcile(
+        run, sum(seen.values()), on_removed=lambda keys: change_feed.publish('delete', {'keys': keys})
+    )
+    files_after = metadata_index.get_totals(get_current_period_start())['total_files']
+    if files_after - files_before + removed > 0:
+        # Objects written to R2 by something other than this backend: dashboards reload their list
+        change_feed.publish('resync', {})
+    if files_after != files_before or removed:
+        publish_bucket_stats()
+    else:
+        invalidate_bucket_stats()
+    if thumbnails.settings['enabled']:
+        thumbnails.prune_orphans(shards.primary().client, shards.primary().bucket)
 
+# Helper Functions
 def increment_download_count(filename):
-    """Counting be ready accumulative total download file."""
-    counts = get_download_counts()
-    counts[filename] = counts.get(filename, 0) + 1
-    try:
-        os.makedirs(os.path.dirname(DOWNLOAD_COUNT_FILE), exist_ok=True)
-        with open(DOWNLOAD_COUNT_FILE, 'w') as f:
-            json.dump(counts, f, indent=4)
-    except IOError as e:
-        app.logger.error(f"Failed to write download count: {e}")
-
-def get_upload_history():
-    if not os.path.exists(UPLOAD_HISTORY_FILE):
-        return {}
-    try:
-        with open(UPLOAD_HISTORY_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return {}
+    """Counting be ready accumulative total download file (buffered, flushed in batches)."""
+    counter_store.record_download(filename)
+    analytics.record_download(filename)
 
-def save_upload_history(history):
-    try:
-        os.makedirs(os.path.dirname(UPLOAD_HISTORY_FILE), exist_ok=True)
-        with open(UPLOAD_HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=4)
-    except IOError as e:
-        app.logger.error(f"Failed to write upload history: {e}")
+def publish_download_counts(downloads):
+    """Change feed event with the new totals of the files just counted (after a counter flush)."""
+    keys = list(downloads)
+    counts = {}
+    for start in range(0, len(keys), 500):
+        batch = keys[start:start + 500]
+        rows = metadata_index.get_connection().execute(
+            f"SELECT key, download_count FROM objects WHERE key IN ({','.join('?' * len(batch))})", batch
+        )
+        counts.update({row['key']: row['download_count'] for row in rows})
+    if counts:
+        change_feed.publish('downloads', {'counts': counts})
+
+def publish_bucket_stats():
+    invalidate_bucket_stats()
+    change_feed.publish('stats', get_bucket_stats())
 
 def get_current_period_start():
     now = datetime.now()
@@ -235,53 +442,46 @@ def format_file_size(bytes):
         i = len(sizes) - 1
     return f"{round(bytes / math.pow(k, i), 2)} {sizes[i]}"
 
+def invalidate_bucket_stats():
+    stats_cache["expires"] = 0.0
+
 def get_bucket_stats():
-    """Counting a total size file & limit kuota R2."""
+    """Bucket stats through a TTL cache; only one caller recomputes when it expires."""
+    if stats_cache["value"] is not None and time.time() < stats_cache["expires"]:
+        return stats_cache["value"]
+    with stats_cache_lock:
+        if stats_cache["value"] is None or time.time() >= stats_cache["expires"]:
+            stats_cache["value"] = compute_bucket_stats()
+            stats_cache["expires"] = time.time() + STATS_CACHE_TTL
+        return stats_cache["value"]
+
+@metrics.timed('bucket_stats')
+def compute_bucket_stats():
+    """Counting a total size file & limit kuota R2 (running aggregates in the local index)."""
     try:
-        objects = s3_client.list_objects_v2(Bucket=R2_BUCKET_NAME)
-        if 'Contents' not in objects:
-            return {
-                "total_files": 0, "total_size": 0, "formatted_total_size": "0 Bytes",
-                "current_period_size": 0, "formatted_current_period_size": "0 Bytes",
-                "remaining_quota": 10 * 1024 * 1024 * 1024, "formatted_remaining": "10 GB",
-                "days_until_reset": get_days_until_reset()
-            }
-        
-        current_period_start = get_current_period_start()
-        upload_history = get_upload_history()
-        
-        total_files = len(objects['Contents'])
-        total_size = 0
-        current_period_size = 0
-        
-        for obj in objects['Contents']:
-            file_size = obj['Size']
-            total_size += file_size
-            file_key = obj['Key']
-            
-            if file_key in upload_history:
-                try:
-                    upload_date = datetime.fromisoformat(upload_history[file_key])
-                    if upload_date >= current_period_start:
-                        current_period_size += file_size
-                except (ValueError, TypeError):
-                    current_period_size += file_size
-            else:
-                try:
-                    last_modified = obj['LastModified'].replace(tzinfo=None)
-                    if last_modified >= current_period_start:
-                        current_period_size += file_size
-                except:
-                    pass
-        
-        quota_limit = 10 * 1024 * 1024 * 1024
+        totals = metadata_index.get_totals(get_current_period_start())
+        # Logical bytes count every file; physical bytes are what R2 stores (deduplicated aliases
+        # excluded, compressed files at their compressed size)
+        logical_size = totals['total_size']
+        total_size = logical_size - totals['alias_size'] - totals['compressed_saved']
+        current_period_size = (totals['current_period_size'] - totals['alias_period_size']
+                               - totals['compressed_period_saved'])
+
+        # The free tier is per account; shards in other accounts add theirs
+        quota_limit = 10 * 1024 * 1024 * 1024 * len(R2_ENDPOINTS)
         remaining_quota = max(0, quota_limit - current_period_size)
         
         return {
-            "total_files": total_files, "total_size": total_size, "formatted_total_size": format_file_size(total_size),
+            "total_files": totals['total_files'], "total_size": total_size, "formatted_total_size": format_file_size(total_size),
             "current_period_size": current_period_size, "formatted_current_period_size": format_file_size(current_period_size),
             "remaining_quota": remaining_quota, "formatted_remaining": format_file_size(remaining_quota),
-            "days_until_reset": get_days_until_reset()
+            "days_until_reset": get_days_until_reset(),
+            "logical_size": logical_size, "formatted_logical_size": format_file_size(logical_size),
+            "physical_size": total_size, "deduplicated_files": totals['alias_files'],
+            "deduplicated_size": totals['alias_size'], "formatted_deduplicated_size": format_file_size(totals['alias_size']),
+            "compressed_files": totals['compressed_files'],
+            "compression_saved_size": totals['compressed_saved'],
+            "formatted_compression_saved_size": format_file_size(totals['compressed_saved'])
         }
     except Exception as e:
         app.logger.error(f"Bucket stats error: {e}")
@@ -289,37 +489,246 @@ def get_bucket_stats():
             "total_files": 0, "total_size": 0, "formatted_total_size": "0 Bytes",
             "current_period_size": 0, "formatted_current_period_size": "0 Bytes",
             "remaining_quota": 10 * 1024 * 1024 * 1024, "formatted_remaining": "10 GB",
-            "days_until_reset": get_days_until_reset()
+            "days_until_reset": get_days_until_reset(),
+            "logical_size": 0, "formatted_logical_size": "0 Bytes",
+            "physical_size": 0, "deduplicated_files": 0,
+            "deduplicated_size": 0, "formatted_deduplicated_size": "0 Bytes",
+            "compressed_files": 0, "compression_saved_size": 0, "formatted_compression_saved_size": "0 Bytes"
         }
 
 # R2 Streaming Generator
-def stream_r2_file(key):
-    """Stream file from R2 with chunk-by-chunk 1MB"""
+def stream_r2_file(key, byte_range=None):
+    """Stream file (or an inclusive (start, end) byte range) from R2 with chunk-by-chunk 1MB"""
     try:
-        obj = s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=key)
+        shard = shards.locate(key)
+        params = {'Bucket': shard.bucket, 'Key': key}
+        if byte_range is not None:
+            params['Range'] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        obj = shard.client.get_object(**params)
         for chunk in obj['Body'].iter_chunks(chunk_size=1024 * 1024):
             yield chunk
     except Exception as e:
         app.logger.error(f"Stream generator error for {key}: {e}")
         yield b""  # blank if error
 
+def fetch_r2_range(shard, key, start, end):
+    obj = shard.client.get_object(Bucket=shard.bucket, Key=key, Range=f"bytes={start}-{end}")
+    return obj['Body'].read()
+
+def stream_r2_file_parallel(key, start, end):
+    """Fetch several ranges concurrently and yield them in order.
+
+    At most PARALLEL_DOWNLOAD_WORKERS parts (of PARALLEL_DOWNLOAD_PART_SIZE) are in memory at once.
+    """
+    part_size = PARALLEL_DOWNLOAD_PART_SIZE
+    parts = [(offset, min(offset + part_size, end + 1) - 1) for offset in range(start, end + 1, part_size)]
+    shard = shards.locate(key)
+    pending = []
+    try:
+        next_part = 0
+        while next_part < len(parts) or pending:
+            while next_part < len(parts) and len(pending) < PARALLEL_DOWNLOAD_WORKERS:
+                # Runs on the shared transfer pool rather than a pool per request
+                pending.append(transfer_manager.executor.submit(fetch_r2_range, shard, key, *parts[next_part]))
+                next_part += 1
+            yield pending.pop(0).result()
+    except Exception as e:
+        app.logger.error(f"Parallel stream error for {key}: {e}")
+        yield b""
+    finally:
+        for future in pending:
+            future.cancel()
+
+def resolve_byte_ranges(range_header, length):
+    """Turn a parsed Range header into inclusive (start, end) pairs, dropping unsatisfiable ones."""
+    resolved = []
+    for start, stop in range_header.ranges:
+        if start < 0:  # suffix range: last N bytes
+            start, stop = max(0, length + start), length
+        elif stop is None or stop > length:
+            stop = length
+        if start < length and start < stop:
+            resolved.append((start, stop - 1))
+    return resolved
+
+def multipart_byteranges_layout(ranges, content_type, length, boundary):
+    """Part headers and closing delimiter of a multipart/byteranges body, plus its exact Content-Length."""
+    part_headers = [
+        (f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+         f"Content-Range: bytes {start}-{end}/{length}\r\n\r\n").encode('latin-1')
+        for start, end in ranges
+    ]
+    closing = f"\r\n--{boundary}--\r\n".encode('latin-1')
+    total = sum(len(h) for h in part_headers) + sum(end - start + 1 for start, end in ranges) + len(closing)
+    return part_headers, closing, total
+
+def plan_download(filename, head, range_header, if_range, if_none_match, accept_encoding=None):
+    """Work out status, headers and byte ranges for a download, from a head_object result.
+
+    range_header, if_range, if_none_match and accept_encoding are werkzeug's parsed header
+    objects (or None), so the Flask and ASGI servers share the same HTTP semantics.
+    A compressed object goes out as stored to clients that accept its encoding; for the
+    rest the plan decompresses it (`decode`), and lengths and ranges count original bytes.
+    """
+    content_type = head.get('ContentType', 'application/octet-stream')
+    content_length = head['ContentLength']
+    etag = head.get('ETag', '').strip('"')
+    last_modified = head.get('LastModified')
+
+    encoding = compression.stored_encoding(head)
+    decode = None
+    if encoding and not compression.accepts(accept_encoding, encoding) and compression.original_size(head) is not None:
+        decode = encoding
+        content_length = compression.original_size(head)
+        if etag:
+            etag = f"{etag}-identity"  # a different representation: never mix its ranges with the stored bytes
+
+    headers = {
+        'Content-Type': content_type,
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-store, no-cache, must-revalidate',
+        'Pragma': 'no-cache',
+        'Expires': '0'
+    }
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    if encoding:
+        headers['Vary'] = 'Accept-Encoding'
+        if not decode:
+            headers['Content-Encoding'] = encoding
+    plan = {'status': 200, 'headers': headers, 'ranges': None, 'length': content_length, 'counts_as_download': False,
+            'head': head, 'decode': decode}
+
+    # Conditional GET: client already holds this exact version
+    if etag and if_none_match and if_none_match.contains_weak(etag):
+        plan['status'] = 304
+        plan['headers'] = {k: v for k, v in headers.items() if k != 'Content-Type'}
+        return plan
+
+    # If-Range: only honour Range when the client's validator still matches
+    ranges = None
+    if range_header and range_header.units == 'bytes':
+        if not if_range or (not if_range.etag and not if_range.date) or \
+                (if_range.etag and if_range.etag == etag) or \
+                (if_range.date and last_modified and if_range.date == last_modified.replace(microsecond=0)):
+            ranges = resolve_byte_ranges(range_header, content_length)
+            if not ranges:
+                plan['status'] = 416
+                plan['headers'] = {'Content-Range': f"bytes */{content_length}"}
+                return plan
+            if 'Content-Encoding' in headers and len(ranges) > 1:
+                ranges = None  # a multipart body cannot label its parts as encoded: send the whole object
+
+    # Resumed/seeking requests are not new downloads
+    plan['counts_as_download'] = not ranges or ranges[0][0] == 0
+    plan['ranges'] = ranges
+
+    if ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        plan['status'] = 206
+        headers['Content-Range'] = f"bytes {start}-{end}/{content_length}"
+        headers['Content-Length'] = str(end - start + 1)
+    elif ranges:
+        boundary = secrets.token_hex(16)
+        part_headers, closing, total = multipart_byteranges_layout(ranges, content_type, content_length, boundary)
+        plan['status'] = 206
+        plan['part_headers'] = part_headers
+        plan['closing'] = closing
+        headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+        headers['Content-Length'] = str(total)
+    else:
+        headers['Content-Length'] = str(content_length)
+    return plan
+
+def cached_head(key):
+    """Metadata of the cached copy when the index says it is still the current version, else None."""
+    if not OBJECT_CACHE_ENABLED:
+        return None
+    entry = object_cache.get_entry(key)
+    if entry is None:
+        return None
+    indexed = metadata_index.get_object(key)
+    if indexed is None or indexed['etag'] != entry['etag']:
+        return None
+    head = object_cache.entry_head(entry)
+    if indexed['encoding']:
+        head.update(compression.object_fields(indexed['encoding'], indexed['size']))
+    return head
+
+def cached_body(filename, plan):
+    """Body for a whole-object or single-range plan served via the object cache, or None to stream from R2."""
+    ranges = plan['ranges']
+    if not OBJECT_CACHE_ENABLED or (ranges and len(ranges) > 1):
+        return None
+    start, end = ranges[0] if ranges else (0, plan['length'] - 1)
+    etag = plan['head'].get('ETag', '')
+
+    def fetch():
+        # IfMatch: never cache bytes of a different version than the one validated
+        shard = shards.locate(filename)
+        obj = shard.client.get_object(Bucket=shard.bucket, Key=filename, IfMatch=etag)
+        return obj['Body'].iter_chunks(chunk_size=1024 * 1024)
+
+    return object_cache.read(
+        filename, plan['head'], start, end, fetch,
+        lambda missing_start, missing_end: stream_r2_file(filename, (missing_start, missing_end))
+    )
+
+def decoded_body(filename, plan):
+    """Body for a plan that decompresses the stored object; ranges are cut from the decompressed stream."""
+    def original():
+        # The whole stored object, through the download cache when it is on
+        stored = cached_body(filename, {**plan, 'ranges': None, 'length': plan['head']['ContentLength']})
+        return compression.decompress(stored if stored is not None else stream_r2_file(filename), plan['decode'])
+
+    ranges = plan['ranges']
+    if ranges and len(ranges) > 1:
+        def generate():
+            for header, (start, end) in zip(plan['part_headers'], ranges):
+                yield header
+                yield from compression.byte_range(original(), start, end)
+            yield plan['closing']
+        return generate()
+    if ranges:
+        return compression.byte_range(original(), *ranges[0])
+    return original()
+
+def download_body(filename, plan):
+    """Streaming body generator for a 200/206 download plan."""
+    if plan['decode']:
+        return decoded_body(filename, plan)
+    body = cached_body(filename, plan)
+    if body is not None:
+        return body
+
+    ranges = plan['ranges']
+    if ranges and len(ranges) > 1:
+        def generate():
+            for header, byte_range in zip(plan['part_headers'], ranges):
+                yield header
+                yield from stream_r2_file(filename, byte_range)
+            yield plan['closing']
+        return generate()
+
+    start, end = ranges[0] if ranges else (0, plan['length'] - 1)
+    if PARALLEL_DOWNLOADS and end - start + 1 >= PARALLEL_DOWNLOAD_THRESHOLD:
+        return stream_r2_file_parallel(filename, start, end)
+    return stream_r2_file(filename, ranges[0] if ranges else None)
+
 # Authentication Routes
 @app.route('/api/auth/login', methods=['POST'])
 def auth_login():
     """Authenticate admin with password. Sets HttpOnly JWT cookie."""
     client_ip = get_client_ip()
     
-    # Rate limit check
-    if not check_rate_limit(client_ip):
-        remaining = RATE_LIMIT_WINDOW - (time.time() - min(login_attempts.get(client_ip, [time.time()])))
+    # Rate limit check (every attempt counts)
+    allowed, retry_after = check_rate_limit(client_ip)
+    if not allowed:
         app.logger.warning(f"Rate limit exceeded for IP: {client_ip}")
-        return jsonify({
-            "error": "Too many login attempts. Please try again later.",
-            "retry_after": int(remaining)
-        }), 429
-    
-    # Record this attempt
-    record_attempt(client_ip)
+        return rate_limit_response(retry_after, "Too many login attempts. Please try again later.")
     
     # Parse request
     data = request.get_json(silent=True)
@@ -346,9 +755,8 @@ def auth_login():
     is_secure = PUBLIC_BASE_URL.startswith('https')
     
     # Set HttpOnly cookie - __Host- prefix requires Secure + Path=/
-    cookie_name = AUTH_COOKIE_NAME if is_secure else "auth_token"
     response.set_cookie(
-        cookie_name,
+        auth_cookie_name(),
         value=token,
         httponly=True,
         secure=is_secure,
@@ -365,10 +773,8 @@ def auth_logout():
     """Clear auth cookie."""
     response = make_response(jsonify({"success": True}), 200)
     
-    is_secure = PUBLIC_BASE_URL.startswith('https')
-    cookie_name = AUTH_COOKIE_NAME if is_secure else "auth_token"
-    
-    response.delete_cookie(cookie_name, path='/', samesite='Strict')
+    revoke_session(request.cookies.get(auth_cookie_name()))
+    response.delete_cookie(auth_cookie_name(), path='/', samesite='Strict')
     
     app.logger.info(f"Logout from {get_client_ip()}")
     return response
@@ -376,18 +782,15 @@ def auth_logout():
 @app.route('/api/auth/verify', methods=['GET'])
 def auth_verify():
     """Verify current auth session. Used by Nginx auth_request."""
-    is_secure = PUBLIC_BASE_URL.startswith('https')
-    cookie_name = AUTH_COOKIE_NAME if is_secure else "auth_token"
-    
-    token = request.cookies.get(cookie_name)
+    token = request.cookies.get(auth_cookie_name())
     if not token:
         return '', 401
     
-    payload = verify_auth_token(token)
+    payload = verify_session(token)
     if not payload:
         return '', 401
     
-    return '', 200
+    return '', 200, verify_cache_headers(payload)
 
 # Application Routes
 @app.route('/')
@@ -399,8 +802,116 @@ def static_files(filename):
     return send_from_directory('../frontend', filename)
 
 # File Upload Handler
+def allocate_unique_key(original_filename):
+    """Pick a key for a new upload: the filename, or 'name (n).ext' if taken (O(1), reserved locally)."""
+    if original_filename.startswith(thumbnails.RESERVED_PREFIX):
+        original_filename = original_filename.lstrip('.')
+    key = metadata_index.allocate_key(original_filename, UPLOAD_SESSION_TTL)
+    app.logger.info(f"Using unique key for upload: '{key}'")
+    return key
+
+def is_precondition_failed(error):
+    return isinstance(error, ClientError) and \
+        error.response['Error']['Code'] in ('PreconditionFailed', '412')
+
+def upload_encoding(stream, content_type, size):
+    """Encoding to store an upload with (see compression.py), from its type and a sample of its first bytes."""
+    if not compression.settings['enabled']:
+        return None
+    sample = stream.read(compression.SAMPLE_SIZE)
+    stream.seek(0)
+    return compression.choose(content_type, size, sample)
+
+def put_new_object(stream, key, content_type, size, encoding=None):
+    """Write stream to key, on the shard the ring assigns it, only if nothing is stored there yet (If-None-Match: *).
+
+    With `encoding`, the bytes are compressed on their way to R2. Returns (stored size, ETag).
+    """
+    shard = shards.place(key)
+    object_args = {}
+    if encoding:
+        stream = compression.CompressingReader(stream, encoding)
+        object_args = compression.object_fields(encoding, size)
+    if size <= SINGLE_PUT_MAX:
+        # A small compressed body is read whole: put_object needs its length up front
+        body = stream.read() if encoding else stream
+        result = shard.client.put_object(
+            Bucket=shard.bucket, Key=key, Body=body,
+            ContentType=content_type, IfNoneMatch='*', **object_args
+        )
+        return len(body) if encoding else size, result.get('ETag', '').strip('"') or None
+
+    # STREAMING R2 W/ MULTIPART, sized and paced by the shared transfer manager
+    etag = transfer_manager.upload_stream(
+        shard.client, shard.bucket, key, stream, size, content_type, exact=not encoding, **object_args
+    )
+    return stream.stored if encoding else size, etag
+
+def record_completed_upload(key, size, content_type, etag=None, sha256=None, shard=None, encoding=None,
+                            stored_size=None):
+    """Upload history, metadata index and stats for a freshly stored object (on `shard`, default its ring shard).
+
+    `size` is the file's own size; a compressed object also has its `encoding` and `stored_size`.
+    """
+    app.logger.info(f"Saving upload history for '{key}'.")
+    uploaded_at = datetime.now().isoformat()
+    counter_store.record_upload(key, uploaded_at)
+    analytics.record_upload(key, size)
+    metadata_index.upsert_object(
+        key, size, etag=etag, content_type=content_type, uploaded_at=uploaded_at, sha256=sha256,
+        shard=shard or shards.place(key).name, encoding=encoding, stored_size=stored_size if encoding else None
+    )
+    metadata_index.release_key(key)
+    deduplicate_upload(key, size, sha256)
+    change_feed.publish('upload', file_entry(metadata_index.get_object(key)))
+    publish_bucket_stats()
+    thumbnails.enqueue(key, etag)
+    app.logger.info(f"Upload history saved successfully.")
+
+def deduplicate_upload(key, size, sha256):
+    """If identical bytes are already stored under another key, make key an alias of it
+    and delete the copy just uploaded. Returns the alias target, or None."""
+    if not DEDUP_UPLOADS or not sha256:
+        return None
+    target = metadata_index.find_by_content(sha256, size, key)
+    if not target:
+        return None
+    # Alias first: if the delete fails, reads still work and only the space is wasted
+    shard = shards.locate(key)
+    metadata_index.make_alias(key, target)
+    try:
+        shard.client.delete_object(Bucket=shard.bucket, Key=key)
+    except Exception as e:
+        app.logger.warning(f"Could not delete duplicate copy '{key}' (now an alias of '{target}'): {e}")
+    app.logger.info(f"'{key}' has the same content as '{target}'; stored as an alias ({size} bytes saved)")
+    return target
+
+def public_urls(stored_key):
+    """(/files/ link via nginx, direct R2 link) for stored bytes; nginx's /files/ redirect only knows the primary shard."""
+    shard = shards.locate(stored_key)
+    public_url = f"{shard.public_url}/{stored_key}"
+    if shard.name != shards.primary().name:
+        return public_url, public_url
+    return f"{PUBLIC_BASE_URL}/files/{stored_key}", public_url
+
+def upload_success_payload(key):
+    # An alias has no object of its own: public links point at the bytes it shares
+    local_proxy_url, public_r2_url = public_urls(metadata_index.storage_key(key))
+    
+    app.logger.info(f"Upload process completed successfully for '{key}'.")
+    return {
+        "message": "File uploaded successfully!",
+        "filename": key,
+        "local_url": local_proxy_url,
+        "public_url": public_r2_url
+    }
+
+def upload_success_response(key):
+    return jsonify(upload_success_payload(key)), 200
+
 @app.route('/api/upload', methods=['POST'])
 @require_auth
+@rate_limited(UPLOAD_LIMIT)
 def upload_file():
     if 'file' not in request.files:
         app.logger.warning("Upload request failed: No file part in request")
@@ -411,135 +922,747 @@ def upload_file():
         app.logger.warning("Upload request failed: No selected file")
         return jsonify({"error": "No selected file"}), 400
 
+    original_filename = file.filename
+    key = None
     try:
-        original_filename = file.filename
-        key = original_filename
-        counter = 1
-        while True:
+        file.stream.seek(0, os.SEEK_END)
+        file_size = file.stream.tell()
+        content_type = file.content_type or 'application/octet-stream'
+        file.stream.seek(0)
+        encoding = upload_encoding(file.stream, content_type, file_size)
+
+        for attempt in range(KEY_ALLOCATION_ATTEMPTS):
+            key = allocate_unique_key(original_filename)
+            file.stream.seek(0)
+            stream = dedup.HashingReader(file.stream) if DEDUP_UPLOADS else file.stream
+            app.logger.info(f"Attempting to upload '{key}' to R2 bucket '{shards.place(key).bucket}'")
             try:
-                s3_client.head_object(Bucket=R2_BUCKET_NAME, Key=key)
-                app.logger.info(f"File with key '{key}' already exists. Generating a new name.")
-                name, ext = os.path.splitext(original_filename)
-                key = f"{name} ({counter}){ext}"
-                counter += 1
+                with metrics.transfer('upload', file_size):
+                    stored_size, etag = put_new_object(stream, key, content_type, file_size, encoding)
+                break
             except ClientError as e:
-                if e.response['Error']['Code'] == '404':
-                    app.logger.info(f"Using unique key for upload: '{key}'")
-                    break
-                else:
+                # Key was written behind the index's back; its reservation keeps it taken
+                if not is_precondition_failed(e) or attempt == KEY_ALLOCATION_ATTEMPTS - 1:
                     raise
+                app.logger.info(f"Key '{key}' already exists in R2. Allocating another.")
+        app.logger.info(f"Successfully uploaded '{key}' to R2"
+                        + (f" ({encoding}, {stored_size} of {file_size} bytes stored)." if encoding else "."))
 
-        # STREAMING R2 W/ MULTIPART 10MB
-        file.stream.seek(0)
-        app.logger.info(f"Attempting to upload '{key}' to R2 bucket '{R2_BUCKET_NAME}'")
-        s3_client.upload_fileobj(
-            file.stream,
-            R2_BUCKET_NAME,
-            key,
-            ExtraArgs={'ContentType': file.content_type or 'application/octet-stream'},
-            Config=boto3.s3.transfer.TransferConfig(
-                multipart_threshold=1024 * 1024 * 10,  # 10MB threshold
-                max_concurrency=10,
-                multipart_chunksize=1024 * 1024 * 10, # 10MB chunk size
-                use_threads=True
-            )
+        sha256 = stream.hexdigest(file_size) if DEDUP_UPLOADS else None
+        record_completed_upload(
+            key, file_size, content_type, etag=etag, sha256=sha256, encoding=encoding, stored_size=stored_size
         )
-        app.logger.info(f"Successfully uploaded '{key}' to R2.")
+        return upload_success_response(key)
 
-        app.logger.info(f"Saving upload history for '{key}'.")
-        upload_history = get_upload_history()
-        upload_history[key] = datetime.now().isoformat()
-        save_upload_history(upload_history)
-        app.logger.info(f"Upload history saved successfully.")
-        
-        local_proxy_url = f"{PUBLIC_BASE_URL}/files/{key}"
-        public_r2_url = f"{R2_PUBLIC_URL}/{key}"
-        
-        app.logger.info(f"Upload process completed successfully for '{key}'.")
+    except Exception as e:
+        if key and not is_precondition_failed(e):
+            metadata_index.release_key(key)
+        app.logger.error(f"Upload failed for file '{original_filename}': {e}", exc_info=True)
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+# Resumable Chunked Uploads
+# initiate -> PUT parts (any order, in parallel, retry freely) -> complete | abort
+def chunked_session_or_404(session_id):
+    session = multipart_uploads.get_session(session_id)
+    if not session:
+        return None, (jsonify({"error": "Upload session not found or expired"}), 404)
+    return session, None
+
+@app.route('/api/uploads', methods=['POST'])
+@require_auth
+@rate_limited(UPLOAD_LIMIT)
+def create_chunked_upload():
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get('filename') or '').strip()
+    size = data.get('size')
+    content_type = data.get('content_type') or 'application/octet-stream'
+    if not filename:
+        return jsonify({"error": "No selected file"}), 400
+    if not isinstance(size, int) or size < 0:
+        return jsonify({"error": "Invalid file size"}), 400
+
+    try:
+        key = allocate_unique_key(filename)
+        part_size = multipart_uploads.choose_part_size(size)
+        shard = shards.place(key)
+        upload = shard.client.create_multipart_upload(Bucket=shard.bucket, Key=key, ContentType=content_type)
+        session_id = multipart_uploads.create_session(
+            upload['UploadId'], key, filename, content_type, size, part_size, shard=shard.name
+        )
+        app.logger.info(f"Started chunked upload {session_id} for '{key}' ({size} bytes, {part_size} per part)")
         return jsonify({
-            "message": "File uploaded successfully!",
-            "filename": key,
-            "local_url": local_proxy_url,
-            "public_url": public_r2_url
-        }), 200
+            "upload_id": session_id,
+            "key": key,
+            "part_size": part_size,
+            "part_count": multipart_uploads.part_count(size, part_size)
+        }), 201
+    except Exception as e:
+        app.logger.error(f"Chunked upload init failed for '{filename}': {e}", exc_info=True)
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
+@app.route('/api/uploads/<session_id>', methods=['GET'])
+@require_auth
+def get_chunked_upload(session_id):
+    session, error = chunked_session_or_404(session_id)
+    if error:
+        return error
+    try:
+        parts = [] if multipart_uploads.is_single_put(session) else \
+            multipart_uploads.list_uploaded_parts(session)
     except Exception as e:
-        app.logger.error(f"Upload failed for file '{original_filename}': {e}", exc_info=True)
+        app.logger.error(f"List parts failed for {session_id}: {e}")
+        return jsonify({"error": f"Failed to list parts: {str(e)}"}), 500
+    return jsonify({
+        "upload_id": session_id,
+        "key": session['key'],
+        "size": session['size'],
+        "part_size": session['part_size'],
+        "part_count": multipart_uploads.part_count(session['size'], session['part_size']),
+        "parts": [{"part_number": p['PartNumber'], "size": p['Size'], "etag": p['ETag']} for p in parts]
+    }), 200
+
+@app.route('/api/uploads/<session_id>/parts/<int:part_number>', methods=['PUT'])
+@require_auth
+def upload_chunk(session_id, part_number):
+    session, error = chunked_session_or_404(session_id)
+    if error:
+        return error
+    expected = multipart_uploads.expected_part_length(session, part_number)
+    if multipart_uploads.is_single_put(session) or expected is None:
+        return jsonify({"error": "Invalid part number"}), 400
+    if request.content_length != expected:
+        return jsonify({"error": f"Part {part_number} must be exactly {expected} bytes"}), 400
+
+    try:
+        # Forwarded to R2 as it arrives; nothing is spooled to disk
+        shard = multipart_uploads.session_shard(session)
+        with metrics.transfer('upload', expected):
+            result = shard.client.upload_part(
+                Bucket=shard.bucket, Key=session['key'], UploadId=session['upload_id'],
+                PartNumber=part_number, ContentLength=expected,
+                Body=multipart_uploads.PartStream(request.stream, expected)
+            )
+        multipart_uploads.touch_session(session_id)
+        return jsonify({"part_number": part_number, "etag": result['ETag']}), 200
+    except Exception as e:
+        app.logger.error(f"Part {part_number} of {session_id} failed: {e}")
+        return jsonify({"error": f"Part upload failed: {str(e)}"}), 502
+
+@app.route('/api/uploads/<session_id>/complete', methods=['POST'])
+@require_auth
+def complete_chunked_upload(session_id):
+    session, error = chunked_session_or_404(session_id)
+    if error:
+        return error
+    try:
+        if multipart_uploads.is_single_put(session):
+            return complete_direct_put(session)
+
+        parts = multipart_uploads.list_uploaded_parts(session)
+        uploaded = {p['PartNumber'] for p in parts}
+        count = multipart_uploads.part_count(session['size'], session['part_size'])
+        missing = [n for n in range(1, count + 1) if n not in uploaded]
+        if missing:
+            return jsonify({"error": "Upload is missing parts", "missing_parts": missing}), 409
+
+        shard = multipart_uploads.session_shard(session)
+        try:
+            result = shard.client.complete_multipart_upload(
+                Bucket=shard.bucket, Key=session['key'], UploadId=session['upload_id'],
+                MultipartUpload={'Parts': [
+                    {'PartNumber': p['PartNumber'], 'ETag': p['ETag']} for p in parts if p['PartNumber'] <= count
+                ]},
+                IfNoneMatch='*'
+            )
+        except ClientError as e:
+            if not is_precondition_failed(e):
+                raise
+            # Someone else created this key meanwhile; the parts cannot be renamed
+            shard.client.abort_multipart_upload(Bucket=shard.bucket, Key=session['key'], UploadId=session['upload_id'])
+            multipart_uploads.delete_session(session_id)
+            app.logger.warning(f"Key '{session['key']}' was taken before upload {session_id} completed")
+            return jsonify({"error": "File name was taken by another upload. Please upload again."}), 409
+        multipart_uploads.delete_session(session_id)
+        app.logger.info(f"Successfully uploaded '{session['key']}' to R2 in {count} parts.")
+
+        record_completed_upload(
+            session['key'], session['size'], session['content_type'],
+            etag=result.get('ETag', '').strip('"') or None, shard=shard.name
+        )
+        return upload_success_response(session['key'])
+    except Exception as e:
+        app.logger.error(f"Completing upload {session_id} failed: {e}", exc_info=True)
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+@app.route('/api/uploads/<session_id>', methods=['DELETE'])
+@require_auth
+def abort_chunked_upload(session_id):
+    session, error = chunked_session_or_404(session_id)
+    if error:
+        return error
+    try:
+        if not multipart_uploads.is_single_put(session):
+            shard = multipart_uploads.session_shard(session)
+            shard.client.abort_multipart_upload(Bucket=shard.bucket, Key=session['key'], UploadId=session['upload_id'])
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('NoSuchUpload', '404'):
+            app.logger.error(f"Abort of {session_id} failed: {e}")
+            return jsonify({"error": f"Abort failed: {str(e)}"}), 500
+    multipart_uploads.delete_session(session_id)
+    metadata_index.release_key(session['key'])
+    app.logger.info(f"Aborted chunked upload {session_id} for '{session['key']}'")
+    return jsonify({"success": True}), 200
+
+# Direct-to-R2 Transfers (presigned URLs)
+# Small files: one presigned PUT. Large files: a multipart session whose part URLs
+# are presigned on demand. Either way the client finishes with /api/uploads/<id>/complete.
+def direct_transfers_enabled():
+    return DIRECT_TRANSFERS
+
+def complete_direct_put(session):
+    """Confirm a presigned single PUT landed in R2 and record it."""
+    shard = multipart_uploads.session_shard(session)
+    try:
+        head = shard.client.head_object(Bucket=shard.bucket, Key=session['key'])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return jsonify({"error": "Object has not been uploaded yet"}), 409
+        raise
+    if head['ContentLength'] != session['size']:
+        return jsonify({"error": "Uploaded size does not match"}), 409
+
+    multipart_uploads.delete_session(session['id'])
+    app.logger.info(f"Direct upload of '{session['key']}' confirmed.")
+    record_completed_upload(
+        session['key'], head['ContentLength'], head.get('ContentType') or session['content_type'],
+        etag=head.get('ETag', '').strip('"') or None, shard=shard.name
+    )
+    return upload_success_response(session['key'])
+
+@app.route('/api/transfer-config', methods=['GET'])
+@require_auth
+def transfer_config():
+    return jsonify({"direct": DIRECT_TRANSFERS, "direct_single_put_max": DIRECT_SINGLE_PUT_MAX}), 200
+
+@app.route('/api/direct/uploads', methods=['POST'])
+@require_auth
+def create_direct_upload():
+    if not direct_transfers_enabled():
+        return jsonify({"error": "Direct transfers are disabled"}), 404
+
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get('filename') or '').strip()
+    size = data.get('size')
+    content_type = data.get('content_type') or 'application/octet-stream'
+    if not filename:
+        return jsonify({"error": "No selected file"}), 400
+    if not isinstance(size, int) or size < 0:
+        return jsonify({"error": "Invalid file size"}), 400
+
+    try:
+        key = allocate_unique_key(filename)
+        shard = shards.place(key)
+        if size <= DIRECT_SINGLE_PUT_MAX:
+            session_id = multipart_uploads.create_session(
+                '', key, filename, content_type, size, max(size, 1), shard=shard.name
+            )
+            url = shard.client.generate_presigned_url(
+                'put_object',
+                Params={'Bucket': shard.bucket, 'Key': key, 'ContentType': content_type, 'IfNoneMatch': '*'},
+                ExpiresIn=DIRECT_URL_EXPIRES
+            )
+            app.logger.info(f"Issued presigned PUT for '{key}' ({size} bytes)")
+            return jsonify({
+                "mode": "single", "upload_id": session_id, "key": key,
+                "url": url, "headers": {"Content-Type": content_type, "If-None-Match": "*"}
+            }), 201
+
+        part_size = multipart_uploads.choose_part_size(size)
+        upload = shard.client.create_multipart_upload(Bucket=shard.bucket, Key=key, ContentType=content_type)
+        session_id = multipart_uploads.create_session(
+            upload['UploadId'], key, filename, content_type, size, part_size, shard=shard.name
+        )
+        app.logger.info(f"Started direct multipart upload {session_id} for '{key}' ({size} bytes)")
+        return jsonify({
+            "mode": "multipart", "upload_id": session_id, "key": key,
+            "part_size": part_size, "part_count": multipart_uploads.part_count(size, part_size)
+        }), 201
+    except Exception as e:
+        app.logger.error(f"Direct upload init failed for '{filename}': {e}", exc_info=True)
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
 
+@app.route('/api/direct/uploads/<session_id>/part-urls', methods=['POST'])
+@require_auth
+def direct_part_urls(session_id):
+    if not direct_transfers_enabled():
+        return jsonify({"error": "Direct transfers are disabled"}), 404
+    session, error = chunked_session_or_404(session_id)
+    if error:
+        return error
+    if multipart_uploads.is_single_put(session):
+        return jsonify({"error": "Not a multipart upload"}), 400
+
+    data = request.get_json(silent=True) or {}
+    part_numbers = data.get('part_numbers') or []
+    if not isinstance(part_numbers, list) or len(part_numbers) > 100 or not all(
+            isinstance(n, int) and multipart_uploads.expected_part_length(session, n) is not None for n in part_numbers):
+        return jsonify({"error": "Invalid part numbers"}), 400
+
+    shard = multipart_uploads.session_shard(session)
+    urls = {
+        str(n): shard.client.generate_presigned_url(
+            'upload_part',
+            Params={'Bucket': shard.bucket, 'Key': session['key'], 'UploadId': session['upload_id'], 'PartNumber': n},
+            ExpiresIn=DIRECT_URL_EXPIRES
+        )
+        for n in part_numbers
+    }
+    multipart_uploads.touch_session(session_id)
+    return jsonify({"urls": urls}), 200
+
+@app.route('/api/direct/download/<path:filename>', methods=['GET'])
+@require_auth
+def direct_download(filename):
+    if not direct_transfers_enabled():
+        return jsonify({"error": "Direct transfers are disabled"}), 404
+    obj = metadata_index.get_object(filename)
+    if obj is None:
+        return jsonify({"error": "File not found in R2. Check key: " + filename}), 404
+
+    stored_key = metadata_index.storage_key(filename)
+    shard = shards.locate(stored_key)
+    url = shard.client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': shard.bucket, 'Key': stored_key,
+            'ResponseContentDisposition': f'attachment; filename="{filename}"'
+        },
+        ExpiresIn=DIRECT_URL_EXPIRES
+    )
+    increment_download_count(filename)
+    # R2 serves the bytes; count the whole object, as if the download completes
+    analytics.record_bytes_out(filename, obj['size'])
+    return jsonify({"url": url, "expires_in": DIRECT_URL_EXPIRES}), 200
+
 # File Listing and Statistics
+def encode_cursor(state):
+    """Opaque continuation token for /api/files."""
+    raw = json.dumps(state, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    padded = token + '=' * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+
+def parse_files_query(args):
+    """Validate /api/files query args. Raises ValueError with a client-facing message."""
+    query = {
+        'sort': args.get('sort', 'mtime'),
+        'order': args.get('order', 'desc'),
+        'q': args.get('q', '').strip(),
+        'match': args.get('match', 'substring'),
+        'cursor': args.get('cursor'),
+        'after': None,
+    }
+    if query['sort'] not in metadata_index.SORT_COLUMNS or query['order'] not in ('asc', 'desc') \
+            or query['match'] not in ('prefix', 'substring'):
+        raise ValueError("Invalid sort, order or match parameter")
+    try:
+        query['limit'] = min(max(int(args.get('limit', FILES_PAGE_DEFAULT)), 1), FILES_PAGE_MAX)
+    except ValueError:
+        raise ValueError("Invalid limit")
+
+    if query['cursor']:
+        try:
+            state = decode_cursor(query['cursor'])
+            if (state['s'], state['o'], state['q'], state['m']) != \
+                    (query['sort'], query['order'], query['q'], query['match']):
+                raise ValueError("cursor does not match query")
+            query['after'] = (state['v'], state['k'])
+        except Exception:
+            raise ValueError("Invalid cursor")
+    return query
+
+@metrics.timed('files_page')
+def fetch_files_page(query):
+    """Rows (lazy, one extra to detect a next page) and, for first pages, the bucket stats."""
+    rows = metadata_index.query_objects(
+        query['sort'], query['order'], query['q'], query['match'], query['limit'] + 1, query['after']
+    )
+    stats = get_bucket_stats() if not query['cursor'] else None
+    return rows, stats
+
+def file_entry(obj):
+    thumbnail = thumbnails.ready_version(obj['key'])
+    local_url, public_url = public_urls(obj.get('alias_of') or obj['key'])
+    return {
+        "key": obj['key'],
+        "last_modified": obj['last_modified'],
+        "size": obj['size'],
+        "local_url": local_url,
+        "public_url": public_url,
+        "download_count": obj['download_count'],
+        "thumbnail_url": thumbnails.thumbnail_url(obj['key'], thumbnail) if thumbnail else None
+    }
+
+def generate_files_page(query, rows, stats):
+    """JSON body of one /api/files page, yielded row by row."""
+    limit = query['limit']
+    yield '{"files":['
+    last = None
+    for count, obj in enumerate(rows):
+        if count == limit:
+            break
+        yield (',' if count else '') + json.dumps(file_entry(obj))
+        last = obj
+    else:
+        last = None  # exhausted before limit+1: no further page
+
+    next_cursor = None
+    if last is not None:
+        next_cursor = encode_cursor({
+            's': query['sort'], 'o': query['order'], 'q': query['q'], 'm': query['match'],
+            'v': last[metadata_index.SORT_COLUMNS[query['sort']]], 'k': last['key']
+        })
+    tail = {"next_cursor": next_cursor}
+    if stats is not None:
+        tail["stats"] = stats
+    yield '],' + json.dumps(tail)[1:]
+
 @app.route('/api/files', methods=['GET'])
 @require_auth
 def list_files():
     try:
-        objects = s3_client.list_objects_v2(Bucket=R2_BUCKET_NAME)
-        if 'Contents' not in objects:
-            return jsonify({"files": [], "stats": get_bucket_stats()}), 200
-        
-        download_counts = get_download_counts()
-        file_list = []
-        for obj in objects['Contents']:
-            file_list.append({
-                "key": obj['Key'], 
-                "last_modified": obj['LastModified'].isoformat(), 
-                "size": obj['Size'],
-                "local_url": f"{PUBLIC_BASE_URL}/files/{obj['Key']}",
-                "public_url": f"{R2_PUBLIC_URL}/{obj['Key']}",
-                "download_count": download_counts.get(obj['Key'], 0)
-            })
-            
-        file_list.sort(key=lambda x: x['last_modified'], reverse=True)
-        
-        return jsonify({"files": file_list, "stats": get_bucket_stats()}), 200
+        query = parse_files_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
+    try:
+        rows, stats = fetch_files_page(query)
     except Exception as e:
         app.logger.error(f"List files error: {e}")
         return jsonify({"error": f"Failed to fetch file list: {str(e)}"}), 500
 
-# File Download Handler
-@app.route('/api/serve-file/<path:filename>', methods=['GET'])
+    return Response(generate_files_page(query, rows, stats), mimetype='application/json', status=200)
+
+# Live Updates (Server-Sent Events)
+feed_streams = {'open': 0}
+feed_streams_lock = threading.Lock()
+
+def release_feed_stream():
+    with feed_streams_lock:
+        feed_streams['open'] -= 1
+
+@app.route('/api/events', methods=['GET'])
 @require_auth
-def serve_file(filename):
+def change_events():
+    """Upload, delete, download-count, thumbnail and stats events for open dashboards.
+
+    Resumes after Last-Event-ID (sent by EventSource on reconnect) or ?since=<seq>.
+    """
+    with feed_streams_lock:
+        if feed_streams['open'] >= CHANGE_FEED_MAX_STREAMS:
+            response = jsonify({"error": "Too many live update streams"})
+            response.headers['Retry-After'] = '60'
+            return response, 503
+        feed_streams['open'] += 1
+    since = change_feed.parse_since(request.headers.get('Last-Event-ID'), request.args.get('since'))
+    response = Response(change_feed.stream(since), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(release_feed_stream)
+    return response
+
+# File Download Handler
+def send_download(filename, ticket=None):
+    """Streaming download response for serve_file and ticket downloads (which also record progress)."""
     try:
         app.logger.info(f"Received download request for file: {filename}")
         app.logger.info(f"Encoded filename: {filename}")
         
-        head = s3_client.head_object(Bucket=R2_BUCKET_NAME, Key=filename)
-        content_type = head.get('ContentType', 'application/octet-stream')
-        content_length = head['ContentLength']
-        app.logger.info(f"File metadata: {content_type}, size: {content_length}")
-
-        # Increment count
-        increment_download_count(filename)
-        app.logger.info(f"Successfully incremented count for file: {filename}")
-
-        return Response(
-            stream_r2_file(filename),
-            headers={
-                'Content-Type': content_type,
-                'Content-Disposition': f'attachment; filename="{filename}"',
-                'Content-Length': str(content_length),
-                'Cache-Control': 'no-store, no-cache, must-revalidate',
-                'Pragma': 'no-cache',
-                'Expires': '0'
-            },
-            status=200
+        stored_key = metadata_index.storage_key(filename)
+        shard = shards.locate(stored_key)
+        head = cached_head(stored_key) or shard.client.head_object(Bucket=shard.bucket, Key=stored_key)
+        app.logger.info(f"File metadata: {head.get('ContentType')}, size: {head['ContentLength']}")
+
+        plan = plan_download(
+            filename, head, request.range, request.if_range, request.if_none_match, request.accept_encodings
         )
+        if plan['status'] in (304, 416):
+            return Response(status=plan['status'], headers=plan['headers'])
+
+        if plan['counts_as_download']:
+            increment_download_count(filename)
+            app.logger.info(f"Successfully incremented count for file: {filename}")
+
+        body = analytics.metered(download_body(stored_key, plan), filename)
+        progress = ticket_progress(ticket, plan)
+        if progress:
+            body = download_tickets.tracked(body, progress)
+        return Response(metrics.metered_body(body), headers=plan['headers'], status=plan['status'])
     except ClientError as e:
         error_code = e.response['Error']['Code']
         app.logger.error(f"ClientError for {filename}: {error_code} - {e}")
-        if error_code == 'NoSuchKey':
+        if error_code in ('NoSuchKey', '404'):
             return jsonify({"error": "File not found in R2. Check key: " + filename}), 404
         return jsonify({"error": "R2 access failed: " + str(e)}), 500
     except Exception as e:
         app.logger.error(f"Download error for {filename}: {e}", exc_info=True)
         return jsonify({"error": "Internal server error: " + str(e)}), 500
 
+def ticket_progress(ticket, plan):
+    """Progress tracker for a ticket download of the whole file or one range (multi-range requests are not tracked)."""
+    ranges = plan['ranges']
+    if not ticket or (ranges and len(ranges) > 1):
+        return None
+    return download_tickets.Progress(ticket['id'], ranges[0][0] if ranges else 0, plan['length'])
+
+@app.route('/api/serve-file/<path:filename>', methods=['GET'])
+@require_auth
+@rate_limited(DOWNLOAD_LIMIT)
+def serve_file(filename):
+    return send_download(filename)
+
+# Ticket Downloads
+# The dashboard asks for a ticket, then hands its URL to the browser's download manager:
+# the file streams straight to disk (no Blob in page memory) and pauses/resumes with Range requests.
+# Ticket URLs carry no cookie, so nginx passes /api/dl/ through without the session check.
+@app.route('/api/download-tickets', methods=['POST'])
+@require_auth
+def create_download_ticket():
+    data = request.get_json(silent=True) or {}
+    key = data.get('key')
+    if not isinstance(key, str) or not key:
+        return jsonify({"error": "key is required"}), 400
+    obj = metadata_index.get_object(key)
+    if obj is None:
+        return jsonify({"error": "File not found in R2. Check key: " + key}), 404
+
+    session = verify_session(request.cookies.get(auth_cookie_name()))
+    ticket_id, token = download_tickets.issue(key, obj['size'], session['jti'], session['exp'])
+    return jsonify({
+        "id": ticket_id,
+        "url": f"/api/dl/{token}/{quote(key)}",
+        "status_url": f"/api/download-tickets/{ticket_id}",
+        "expires_in": DOWNLOAD_TICKET_TTL
+    }), 201
+
+@app.route('/api/download-tickets/<ticket_id>', methods=['GET'])
+@require_auth
+def download_ticket_status(ticket_id):
+    status = download_tickets.status(ticket_id)
+    if status is None:
+        return jsonify({"error": "Unknown download ticket"}), 404
+    return jsonify(status), 200
+
+@app.route('/api/dl/<token>/<path:filename>', methods=['GET'])
+@rate_limited(DOWNLOAD_LIMIT)
+def ticket_download(token, filename):
+    ticket = download_tickets.redeem(token, filename)
+    if ticket is None:
+        return jsonify({"error": "Download link is invalid or has expired"}), 403
+    return send_download(filename, ticket)
+
+# Analytics
+# ?period=24h (hourly), 7d (daily) or 12m (monthly), counting the current hour/day/month
+@app.route('/api/analytics/top', methods=['GET'])
+@require_auth
+def analytics_top():
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), ANALYTICS_TOP_MAX)
+        files = analytics.top_keys(
+            request.args.get('period', '7d'), request.args.get('metric', 'downloads'), limit
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    for entry in files:
+        entry['formatted_bytes_out'] = format_file_size(entry['bytes_out'])
+        entry['formatted_bytes_in'] = format_file_size(entry['bytes_in'])
+    return jsonify({"files": files}), 200
+
+@app.route('/api/analytics/series', methods=['GET'])
+@require_auth
+def analytics_series():
+    """Time series for ?key=<file>, or the whole bucket without a key."""
+    try:
+        resolution, points = analytics.series(request.args.get('period', '7d'), request.args.get('key'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"resolution": resolution, "points": points}), 200
+
+@app.route('/api/shards', methods=['GET'])
+@require_auth
+def shard_stats():
+    """Stored files and bytes per shard (from the index), with each shard's share of new keys."""
+    ring_share = {name: 0 for name in shards.shards}
+    for index, (point, name) in enumerate(shards.ring):
+        previous = shards.ring[index - 1][0] if index else shards.ring[-1][0] - 2 ** 64
+        ring_share[name] += point - previous
+    totals = {name: {"files": 0, "size": 0, "period_size": 0} for name in shards.shards}
+    for row in metadata_index.shard_totals(get_current_period_start()):
+        shard_totals = totals[shards.get(row['shard']).name]
+        for field in ("files", "size", "period_size"):
+            shard_totals[field] += row[field]
+    return jsonify({"shards": [
+        {
+            "name": shard.name, "bucket": shard.bucket, "primary": shard.name == shards.primary().name,
+            "files": totals[shard.name]["files"],
+            "size": totals[shard.name]["size"], "formatted_size": format_file_size(totals[shard.name]["size"]),
+            "current_period_size": totals[shard.name]["period_size"],
+            "formatted_current_period_size": format_file_size(totals[shard.name]["period_size"]),
+            "ring_share": round(ring_share[shard.name] / 2 ** 64, 4)
+        }
+        for shard in shards.shards.values()
+    ]}), 200
+
+# Multi-file ZIP Download
+def zip_entries(keys, prefix):
+    """Indexed objects for a ZIP request, or raise ValueError with a client-facing message."""
+    if keys is not None:
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            raise ValueError("keys must be a list of file names")
+        entries = [metadata_index.get_object(key) for key in dict.fromkeys(keys)]
+        entries = [entry for entry in entries if entry]
+    elif isinstance(prefix, str):
+        entries = metadata_index.objects_with_prefix(prefix, ZIP_MAX_FILES + 1)
+    else:
+        raise ValueError("Send keys or prefix")
+    if len(entries) > ZIP_MAX_FILES:
+        raise ValueError(f"Too many files for one archive (max {ZIP_MAX_FILES})")
+    return entries
+
+def record_zip_entry(entry):
+    increment_download_count(entry['key'])
+    analytics.record_bytes_out(entry['key'], entry['size'])
+
+def open_zip_body(key, offset):
+    stored_key = metadata_index.storage_key(key)
+    shard = shards.locate(stored_key)  # prefetched entries on different shards download side by side
+    params = {'Bucket': shard.bucket, 'Key': stored_key}
+    # Archives hold the files themselves: compressed objects are decompressed (and resumed by skipping)
+    stored = metadata_index.get_object(stored_key)
+    if offset and not (stored and stored['encoding']):
+        params['Range'] = f"bytes={offset}-"
+    obj = shard.client.get_object(**params)
+    encoding = compression.stored_encoding(obj)
+    if encoding and 'Range' not in params:
+        return compression.DecompressingReader(obj['Body'], encoding, skip=offset)
+    return obj['Body']
+
+@app.route('/api/download/zip', methods=['POST'])
+@require_auth
+@rate_limited(DOWNLOAD_LIMIT)
+def download_zip():
+    """Stream a ZIP of the given keys, or of every file under a prefix.
+
+    Accepts JSON ({"keys": [...]} or {"prefix": "..."}) or an HTML form with the
+    same fields, so the browser can download the archive natively while it streams.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {'keys': request.form.getlist('keys') or None, 'prefix': request.form.get('prefix')}
+    try:
+        entries = zip_entries(data.get('keys'), data.get('prefix'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not entries:
+        return jsonify({"error": "No matching files"}), 404
+
+    name = ''.join(c if c.isascii() and (c.isalnum() or c in '-_.') else '-' for c in (data.get('prefix') or '').strip('/'))
+    name = name or R2_BUCKET_NAME or 'files'
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    app.logger.info(f"Streaming ZIP '{filename}' of {len(entries)} files")
+    body = zip_stream.stream_zip(
+        entries, open_zip_body, prefetch=max(1, ZIP_PREFETCH_FILES),
+        on_entry=record_zip_entry
+    )
+    return Response(metrics.metered_body(body), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no',
+    })
+
+# Thumbnails
+# The URL carries the source ETag (?v=...), so a thumbnail never changes under its URL
+THUMBNAIL_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+@app.route('/api/thumbnails/<path:filename>', methods=['GET'])
+@require_auth
+def serve_thumbnail(filename):
+    thumbnail = thumbnails.get(filename) if thumbnails.settings['enabled'] else None
+    if not thumbnail or thumbnail['status'] != 'ready':
+        return jsonify({"error": "No thumbnail for this file"}), 404
+
+    etag = f'"{thumbnail["source_etag"] or int(thumbnail["updated_at"])}-{THUMBNAIL_SIZE}"'
+    headers = {'ETag': etag, 'Cache-Control': THUMBNAIL_CACHE_CONTROL}
+    if request.if_none_match and request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers=headers)
+    try:
+        obj = shards.primary().client.get_object(Bucket=shards.primary().bucket, Key=thumbnail['thumb_key'])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            thumbnails.enqueue(filename, thumbnail['source_etag'], force=True)
+            return jsonify({"error": "No thumbnail for this file"}), 404
+        raise
+    return Response(obj['Body'].read(), mimetype='image/webp', headers=headers)
+
+@app.route('/api/thumbnails/backfill', methods=['POST'])
+@require_auth
+def backfill_thumbnails():
+    if not thumbnails.settings['enabled']:
+        return jsonify({"error": "Thumbnails are disabled"}), 404
+    return jsonify({"queued": thumbnails.backfill()}), 202
+
+# Object Cache Stats
+@app.route('/api/cache/stats', methods=['GET'])
+@require_auth
+def cache_stats():
+    if not OBJECT_CACHE_ENABLED:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **object_cache.stats()}), 200
+
+# Prometheus Metrics
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if METRICS_TOKEN and not hmac.compare_digest(
+            request.headers.get('Authorization', '').encode('utf-8'), f"Bearer {METRICS_TOKEN}".encode('utf-8')):
+        return jsonify({"error": "Authentication required"}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Health Check
 @app.route('/health')
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
+# Background Workers
+metadata_index.init_index()
+multipart_uploads.init_sessions()
+auth_sessions.init_store()
+download_tickets.init_tickets(AUTH_SECRET_KEY, DOWNLOAD_TICKET_TTL, DOWNLOAD_RESUME_WINDOW)
+change_feed.init_feed(CHANGE_FEED_RETENTION)
+analytics.init_analytics(
+    ANALYTICS_HOURLY_RETENTION_DAYS, ANALYTICS_DAILY_RETENTION_DAYS, ANALYTICS_MONTHLY_RETENTION_MONTHS
+)
+rate_limiter.init_limiter()
+if COMPRESSION_ENABLED:
+    compression.init_compression(
+        COMPRESSION_ENCODING, COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE, COMPRESSION_MAX_RATIO
+    )
+if OBJECT_CACHE_ENABLED:
+    object_cache.init_cache(OBJECT_CACHE_DIR, OBJECT_CACHE_MAX_BYTES, OBJECT_CACHE_MAX_OBJECT_BYTES)
+    metrics.collectors.append(object_cache.metric_lines)
+metrics.collectors.append(transfer_manager.metric_lines)
+if THUMBNAILS_ENABLED and thumbnails.init_thumbnails(THUMBNAIL_SIZE, THUMBNAIL_MAX_SOURCE_BYTES):
+    thumbnails.start_workers(shards.primary().client, shards.primary().bucket, THUMBNAIL_WORKERS)
+    metrics.collectors.append(thumbnails.metric_lines)
+counter_store.migrate_json(DOWNLOAD_COUNT_FILE, UPLOAD_HISTORY_FILE)
+counter_store.start_flusher(COUNTER_FLUSH_INTERVAL, COUNTER_COMPACT_INTERVAL)
+analytics.start_flusher(COUNTER_FLUSH_INTERVAL)
+metadata_index.start_reconciler(reconcile_index, INDEX_SYNC_INTERVAL)
+change_feed.start_poller()
+counter_store.flush_listeners.append(publish_download_counts)
+multipart_uploads.start_janitor(UPLOAD_JANITOR_INTERVAL, UPLOAD_SESSION_TTL)
+
 if __name__ == '__main__':
     os.makedirs('data', exist_ok=True)
     app.run(host='0.0.0.0', port=5000, debug=False)
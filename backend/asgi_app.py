@@ -0,0 +1,738 @@
+"""ASGI server mode with non-blocking R2 I/O.
+
+The hot routes (/api/files, /api/events, /api/upload, /api/serve-file, /api/dl, /api/auth/*) run on
+asyncio with an aiobotocore client, so many slow transfers share one process.
+Every other route falls through to the Flask app, which stays the default
+entry point (gunicorn app:app).
+
+Run with: uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from aiobotocore.session import get_session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+try:
+    from python_multipart import MultipartParser
+except ImportError:  # python-multipart before 0.0.13
+    from multipart import MultipartParser
+from werkzeug.http import (
+    parse_accept_header, parse_etags, parse_if_range_header, parse_options_header, parse_range_header
+)
+
+import analytics
+import app as backend
+import change_feed
+import compression
+import dedup
+import download_tickets
+import metadata_index
+import metrics
+import rate_limiter
+import shards
+import transfer_manager
+
+logger = logging.getLogger(__name__)
+
+ASGI_R2_POOL_SIZE = int(os.getenv("ASGI_R2_POOL_SIZE", "64"))
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "8"))
+STREAM_CHUNK_SIZE = 1024 * 1024
+PART_SLOT_POLL = 0.05  # seconds between checks for a free upload part slot
+
+r2 = {}  # shard name -> async client
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    async with AsyncExitStack() as stack:
+        # Same shards as the Flask side (backend.SHARD_CONFIGS), each with its own async pool
+        for config in backend.SHARD_CONFIGS:
+            client = await stack.enter_async_context(get_session().create_client(
+                's3',
+                endpoint_url=config['endpoint_url'],
+                aws_access_key_id=config['access_key_id'],
+                aws_secret_access_key=config['secret_access_key'],
+                region_name='auto',
+                config=Config(max_pool_connections=ASGI_R2_POOL_SIZE)
+            ))
+            metrics.instrument_s3_client(client)
+            transfer_manager.attach(client)
+            r2[config['name']] = client
+        yield
+
+
+def client_for(shard):
+    return r2[shard.name]
+
+
+# Authentication
+def get_client_ip(request):
+    """Get real client IP, considering proxy headers."""
+    return rate_limiter.client_ip_from(request.headers, request.client.host if request.client else None)
+
+
+def rate_limit_response(retry_after, message="Too many requests. Please try again later."):
+    return JSONResponse(
+        {"error": message, "retry_after": retry_after}, status_code=429, headers={'Retry-After': str(retry_after)}
+    )
+
+
+def rate_limited(limit):
+    """Async counterpart of app.rate_limited."""
+    def decorator(handler):
+        async def wrapped(request):
+            if limit:
+                client_ip = get_client_ip(request)
+                allowed, retry_after = await asyncio.to_thread(rate_limiter.consume, limit, client_ip)
+                if not allowed:
+                    logger.warning(f"{limit.scope.capitalize()} rate limit exceeded for IP: {client_ip}")
+                    return rate_limit_response(retry_after)
+            return await handler(request)
+        return wrapped
+    return decorator
+
+
+def require_auth(handler):
+    """Async counterpart of app.require_auth."""
+    async def wrapped(request):
+        token = request.cookies.get(backend.auth_cookie_name())
+        if not token:
+            return JSONResponse({"error": "Authentication required"}, status_code=401)
+        if not await asyncio.to_thread(backend.verify_session, token):
+            response = JSONResponse({"error": "Invalid or expired session"}, status_code=401)
+            response.delete_cookie(backend.auth_cookie_name(), path='/', samesite='strict')
+            return response
+        return await handler(request)
+    return wrapped
+
+
+async def auth_login(request):
+    """Authenticate admin with password. Sets HttpOnly JWT cookie."""
+    client_ip = get_client_ip(request)
+    allowed, retry_after = await asyncio.to_thread(backend.check_rate_limit, client_ip)
+    if not allowed:
+        logger.warning(f"Rate limit exceeded for IP: {client_ip}")
+        return rate_limit_response(retry_after, "Too many login attempts. Please try again later.")
+
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    if not isinstance(data, dict) or 'password' not in data:
+        logger.warning(f"Login attempt with missing credentials from {client_ip}")
+        return JSONResponse({"error": "Invalid credentials"}, status_code=401)
+    if not backend.verify_password(str(data.get('password', ''))):
+        logger.warning(f"Failed login attempt from {client_ip}")
+        return JSONResponse({"error": "Invalid credentials"}, status_code=401)
+
+    is_secure = backend.PUBLIC_BASE_URL.startswith('https')
+    response = JSONResponse({"success": True})
+    response.set_cookie(
+        backend.auth_cookie_name(),
+        value=backend.generate_auth_token(),
+        httponly=True,
+        secure=is_secure,
+        samesite='strict',
+        path='/',
+        max_age=backend.AUTH_SESSION_HOURS * 3600
+    )
+    logger.info(f"Successful login from {client_ip}")
+    return response
+
+
+async def auth_logout(request):
+    """Clear auth cookie."""
+    response = JSONResponse({"success": True})
+    await asyncio.to_thread(backend.revoke_session, request.cookies.get(backend.auth_cookie_name()))
+    response.delete_cookie(backend.auth_cookie_name(), path='/', samesite='strict')
+    logger.info(f"Logout from {get_client_ip(request)}")
+    return response
+
+
+async def auth_verify(request):
+    """Verify current auth session. Used by Nginx auth_request."""
+    token = request.cookies.get(backend.auth_cookie_name())
+    payload = await asyncio.to_thread(backend.verify_session, token) if token else None
+    if not payload:
+        return Response(status_code=401)
+    return Response(status_code=200, headers=backend.verify_cache_headers(payload))
+
+
+# File Listing
+@require_auth
+async def list_files(request):
+    try:
+        query = backend.parse_files_query(request.query_params)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    def render():
+        rows, stats = backend.fetch_files_page(query)
+        return ''.join(backend.generate_files_page(query, rows, stats))
+
+    try:
+        # SQLite is synchronous; keep it off the event loop
+        body = await asyncio.to_thread(render)
+    except Exception as e:
+        logger.error(f"List files error: {e}")
+        return JSONResponse({"error": f"Failed to fetch file list: {str(e)}"}, status_code=500)
+    return Response(body, media_type='application/json')
+
+
+# File Upload
+class StreamedUpload:
+    """The `file` field of a multipart/form-data request, parsed as the body arrives (nothing is spooled).
+
+    open() reads up to the field, then read(n) / peek(n) return its bytes; `size` counts those read.
+    """
+
+    def __init__(self, request):
+        _, options = parse_options_header(request.headers.get('content-type'))
+        if 'boundary' not in options:
+            raise ValueError("Expected a multipart/form-data body")
+        self.trailer_size = len(options['boundary']) + 8  # \r\n--boundary--\r\n
+        self.chunks = request.stream()
+        self.parser = MultipartParser(options['boundary'].encode('latin-1'), {
+            'on_part_begin': self.on_part_begin,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+            'on_part_data': self.on_part_data,
+            'on_part_end': self.on_part_end,
+        })
+        self.received = 0      # body bytes parsed so far
+        self.chunk_offset = 0  # body offset of the chunk being parsed
+        self.data_start = None
+        self.headers, self.header = {}, [b'', b'']
+        self.filename = self.content_type = None
+        self.in_file = self.file_ended = False
+        self.buffer = bytearray()
+        self.size = 0
+
+    # Parser callbacks
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data, start, end):
+        self.header[0] += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header[1] += data[start:end]
+
+    def on_header_end(self):
+        name, value = self.header
+        self.headers[name.decode('latin-1').lower()] = value.decode('utf-8', 'replace')
+        self.header = [b'', b'']
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get('content-disposition'))
+        if self.filename is None and options.get('name') == 'file' and 'filename' in options:
+            self.filename = options['filename']
+            self.content_type = self.headers.get('content-type')
+            self.in_file = True
+
+    def on_part_data(self, data, start, end):
+        if self.in_file:
+            if self.data_start is None:
+                self.data_start = self.chunk_offset + start
+            self.buffer += data[start:end]
+
+    def on_part_end(self):
+        if self.in_file:
+            self.in_file, self.file_ended = False, True
+
+    # Reading
+    async def feed(self):
+        """Parse the next chunk of the body. False once it has ended."""
+        try:
+            chunk = await self.chunks.__anext__()
+        except StopAsyncIteration:
+            return False
+        self.chunk_offset = self.received
+        self.received += len(chunk)
+        self.parser.write(chunk)
+        return True
+
+    async def open(self):
+        """Parse up to the file field. False if the form has none."""
+        while self.filename is None:
+            if not await self.feed():
+                return False
+        return True
+
+    async def fill(self, size):
+        while not self.file_ended and (size < 0 or len(self.buffer) < size):
+            if not await self.feed():
+                raise ValueError("Request body ended inside the file")
+
+    async def peek(self, size):
+        await self.fill(size)
+        return bytes(self.buffer[:size])
+
+    async def read(self, size=-1):
+        await self.fill(size)
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = bytes(self.buffer), bytearray()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        self.size += len(data)
+        return data
+
+    async def declared_size(self, content_length):
+        """The file's size as implied by the request's Content-Length, for a form whose last field it is
+        (how browsers and curl send a single file). put_new_object checks it once the file is read."""
+        await self.fill(1)
+        if self.data_start is None:
+            return 0
+        return max(0, content_length - self.data_start - self.trailer_size)
+
+
+class BufferedUpload:
+    """Async read() over a small upload already held in memory, so a taken key can be retried."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    async def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.position + size
+        data = self.data[self.position:end]
+        self.position += len(data)
+        return data
+
+
+async def acquire_part(nbytes):
+    """Async counterpart of transfer_manager.acquire: waits for a slot without holding a thread."""
+    while not transfer_manager.try_acquire(nbytes):
+        await asyncio.sleep(PART_SLOT_POLL)
+
+
+async def upload_part(s3, bucket, key, upload_id, part_number, data):
+    """Async counterpart of transfer_manager.upload_part (shared pacing and throttle back-off).
+
+    The caller releases the part's slot.
+    """
+    for attempt in range(transfer_manager.PART_RETRIES):
+        delay = transfer_manager.pace_delay(len(data))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            result = await s3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data
+            )
+            transfer_manager.record_part(len(data))
+            return {'PartNumber': part_number, 'ETag': result['ETag']}
+        except ClientError as e:
+            if not transfer_manager.is_throttle(e) or attempt == transfer_manager.PART_RETRIES - 1:
+                raise
+            await asyncio.sleep(transfer_manager.retry_delay(attempt))
+
+
+async def put_new_object(upload, key, content_type, size, encoding=None):
+    """Async twin of app.put_new_object: conditional single PUT or a multipart paced by transfer_manager.
+
+    Returns (stored size, ETag); the stored size is smaller than `size` when compressed with `encoding`.
+    A multipart upload reads `upload` to its end and fails (aborted) if that is not `size` bytes.
+    """
+    shard = shards.place(key)
+    s3, bucket = client_for(shard), shard.bucket
+    object_args = {}
+    reader = upload
+    if encoding:
+        reader = compression.AsyncCompressingReader(upload, encoding)
+        object_args = compression.object_fields(encoding, size)
+    if size <= backend.SINGLE_PUT_MAX:
+        body = await reader.read()
+        result = await s3.put_object(
+            Bucket=bucket, Key=key, Body=body,
+            ContentType=content_type, IfNoneMatch='*', **object_args
+        )
+        return len(body), result.get('ETag', '').strip('"') or None
+
+    # Same size-scaled parts as the Flask path, under the same process-wide part and memory limits
+    part_size = transfer_manager.part_size_for(size)
+    mpu = await s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type, **object_args)
+    upload_id = mpu['UploadId']
+    tasks = []
+    held = {}  # part number -> bytes acquired, until that part's upload ends
+
+    async def send_part(part_number, data):
+        try:
+            return await upload_part(s3, bucket, key, upload_id, part_number, data)
+        finally:
+            transfer_manager.release(held.pop(part_number))
+
+    try:
+        part_number, read = 1, 0
+        while True:
+            await acquire_part(part_size)
+            try:
+                data = await reader.read(part_size)
+            except BaseException:
+                transfer_manager.release(part_size)
+                raise
+            read += len(data)
+            if not data and part_number > 1:
+                transfer_manager.release(part_size)
+                break
+            transfer_manager.shrink(part_size, len(data))
+            held[part_number] = len(data)
+            tasks.append(asyncio.create_task(send_part(part_number, data)))
+            part_number += 1
+            if len(data) < part_size:
+                break
+            # Fail fast instead of reading the rest of a large body after a part has failed
+            failed = next((task for task in tasks if task.done() and task.exception()), None)
+            if failed:
+                failed.result()
+        parts = await asyncio.gather(*tasks)
+        if encoding:
+            read = reader.original
+        if read != size:
+            raise ValueError(f"File was {read} bytes, not the {size} its request declared")
+        result = await s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': parts}, IfNoneMatch='*'
+        )
+        return reader.stored if encoding else size, result.get('ETag', '').strip('"') or None
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for length in held.values():
+            transfer_manager.release(length)  # cancelled before they started
+        await s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+
+@require_auth
+@rate_limited(backend.UPLOAD_LIMIT)
+async def upload_file(request):
+    # The file is sent to R2 while it is still arriving; only small ones are held whole
+    try:
+        content_length = int(request.headers['content-length'])
+        file = StreamedUpload(request)
+        found = await file.open()
+    except (KeyError, ValueError) as e:
+        logger.warning(f"Upload request failed: {e!r}")
+        return JSONResponse({"error": "Expected a multipart/form-data body with a Content-Length"}, status_code=400)
+    if not found:
+        logger.warning("Upload request failed: No file part in request")
+        return JSONResponse({"error": "No file part"}, status_code=400)
+    if not file.filename:
+        logger.warning("Upload request failed: No selected file")
+        return JSONResponse({"error": "No selected file"}, status_code=400)
+
+    original_filename = file.filename
+    key = None
+    try:
+        file_size = await file.declared_size(content_length)
+        content_type = file.content_type or 'application/octet-stream'
+        encoding = None
+        if compression.settings['enabled']:
+            sample = await file.peek(compression.SAMPLE_SIZE)
+            encoding = await asyncio.to_thread(compression.choose, content_type, file_size, sample)
+
+        # A streamed file cannot be sent twice: if its key turns out to be taken behind the
+        # index's back, the upload fails (small files are held, so they get another key)
+        data = await file.read() if file_size <= backend.SINGLE_PUT_MAX else None
+        if data is not None:
+            file_size = len(data)
+        attempts = backend.KEY_ALLOCATION_ATTEMPTS if data is not None else 1
+        for attempt in range(attempts):
+            key = await asyncio.to_thread(backend.allocate_unique_key, original_filename)
+            source = BufferedUpload(data) if data is not None else file
+            upload = dedup.AsyncHashingReader(source) if backend.DEDUP_UPLOADS else source
+            logger.info(f"Attempting to upload '{key}' to R2 bucket '{shards.place(key).bucket}'")
+            try:
+                with metrics.transfer('upload', file_size):
+                    stored_size, etag = await put_new_object(upload, key, content_type, file_size, encoding)
+                break
+            except ClientError as e:
+                if not backend.is_precondition_failed(e) or attempt == attempts - 1:
+                    raise
+                logger.info(f"Key '{key}' already exists in R2. Allocating another.")
+        logger.info(f"Successfully uploaded '{key}' to R2.")
+
+        sha256 = upload.hexdigest(file_size) if backend.DEDUP_UPLOADS else None
+        await asyncio.to_thread(
+            backend.record_completed_upload, key, file_size, content_type,
+            etag=etag, sha256=sha256, encoding=encoding, stored_size=stored_size
+        )
+        return JSONResponse(await asyncio.to_thread(backend.upload_success_payload, key))
+    except Exception as e:
+        if key and not backend.is_precondition_failed(e):
+            await asyncio.to_thread(metadata_index.release_key, key)
+        logger.error(f"Upload failed for file '{original_filename}': {e}", exc_info=True)
+        return JSONResponse({"error": f"Upload failed: {str(e)}"}, status_code=500)
+
+
+# Live Updates
+async def feed_stream(since, heartbeat=15):
+    """Async counterpart of change_feed.stream: one asyncio.Event per client instead of a thread."""
+    notify = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def listener():
+        loop.call_soon_threadsafe(notify.set)
+
+    change_feed.listeners.append(listener)
+    try:
+        yield "retry: 3000\n\n"
+        seq = change_feed.latest_seq() if since is None else since
+        while True:
+            notify.clear()
+            events = await asyncio.to_thread(change_feed.events_after, seq)
+            if events is None:
+                seq = change_feed.latest_seq()
+                yield change_feed.format_event(seq, 'resync', '{}')
+                continue
+            for event in events:
+                yield change_feed.format_event(*event)
+                seq = event[0]
+            if events:
+                continue
+            try:
+                await asyncio.wait_for(notify.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+    finally:
+        change_feed.listeners.remove(listener)
+
+
+@require_auth
+async def change_events(request):
+    since = change_feed.parse_since(request.headers.get('Last-Event-ID'), request.query_params.get('since'))
+    return StreamingResponse(feed_stream(since), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+# File Download
+async def stream_r2_file(shard, key, byte_range=None):
+    """Stream file (or an inclusive byte range) from R2 in 1MB chunks without blocking the loop."""
+    try:
+        params = {'Bucket': shard.bucket, 'Key': key}
+        if byte_range is not None:
+            params['Range'] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        obj = await client_for(shard).get_object(**params)
+        async with obj['Body'] as body:
+            while True:
+                chunk = await body.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    except Exception as e:
+        logger.error(f"Stream generator error for {key}: {e}")
+        yield b""
+
+
+async def fetch_r2_range(shard, key, start, end):
+    obj = await client_for(shard).get_object(Bucket=shard.bucket, Key=key, Range=f"bytes={start}-{end}")
+    async with obj['Body'] as body:
+        return await body.read()
+
+
+async def stream_r2_file_parallel(shard, key, start, end):
+    """Prefetch up to PARALLEL_DOWNLOAD_WORKERS ranges concurrently, yield them in order."""
+    part_size = backend.PARALLEL_DOWNLOAD_PART_SIZE
+    parts = [(offset, min(offset + part_size, end + 1) - 1) for offset in range(start, end + 1, part_size)]
+    pending = []
+    try:
+        next_part = 0
+        while next_part < len(parts) or pending:
+            while next_part < len(parts) and len(pending) < backend.PARALLEL_DOWNLOAD_WORKERS:
+                pending.append(asyncio.create_task(fetch_r2_range(shard, key, *parts[next_part])))
+                next_part += 1
+            yield await pending.pop(0)
+    except Exception as e:
+        logger.error(f"Parallel stream error for {key}: {e}")
+        yield b""
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def download_body(shard, filename, plan):
+    ranges = plan['ranges']
+    if ranges and len(ranges) > 1:
+        for header, byte_range in zip(plan['part_headers'], ranges):
+            yield header
+            async for chunk in stream_r2_file(shard, filename, byte_range):
+                yield chunk
+        yield plan['closing']
+        return
+
+    start, end = ranges[0] if ranges else (0, plan['length'] - 1)
+    if backend.PARALLEL_DOWNLOADS and end - start + 1 >= backend.PARALLEL_DOWNLOAD_THRESHOLD:
+        body = stream_r2_file_parallel(shard, filename, start, end)
+    else:
+        body = stream_r2_file(shard, filename, ranges[0] if ranges else None)
+    async for chunk in body:
+        yield chunk
+
+
+async def metered_body(body, key):
+    """Async counterpart of analytics.metered."""
+    sent = 0
+    try:
+        async for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        analytics.record_bytes_out(key, sent)
+
+
+async def tracked_body(body, progress):
+    """Async counterpart of download_tickets.tracked."""
+    try:
+        await asyncio.to_thread(progress.flush)
+        async for chunk in body:
+            if progress.add(len(chunk)):
+                await asyncio.to_thread(progress.flush)
+            yield chunk
+    finally:
+        await asyncio.to_thread(progress.finish)
+
+
+async def send_download(request, filename, ticket=None):
+    try:
+        logger.info(f"Received download request for file: {filename}")
+        stored_key = await asyncio.to_thread(metadata_index.storage_key, filename)
+        shard = await asyncio.to_thread(shards.locate, stored_key)
+        head = await asyncio.to_thread(backend.cached_head, stored_key) \
+            or await client_for(shard).head_object(Bucket=shard.bucket, Key=stored_key)
+
+        if_none_match = request.headers.get('If-None-Match')
+        plan = backend.plan_download(
+            filename, head,
+            parse_range_header(request.headers.get('Range')),
+            parse_if_range_header(request.headers.get('If-Range')),
+            parse_etags(if_none_match) if if_none_match else None,
+            parse_accept_header(request.headers.get('Accept-Encoding'))
+        )
+        if plan['status'] in (304, 416):
+            return Response(status_code=plan['status'], headers=plan['headers'])
+
+        if plan['counts_as_download']:
+            await asyncio.to_thread(backend.increment_download_count, filename)
+
+        # Cache hits are plain file reads and decompression is CPU work: both are sync bodies,
+        # which Starlette iterates on its thread pool
+        if plan['decode']:
+            body = await asyncio.to_thread(backend.decoded_body, stored_key, plan)
+        else:
+            body = await asyncio.to_thread(backend.cached_body, stored_key, plan)
+        progress = backend.ticket_progress(ticket, plan)
+        if body is None:
+            body = metered_body(download_body(shard, stored_key, plan), filename)
+            if progress:
+                body = tracked_body(body, progress)
+            body = metrics.metered_async_body(body)
+        else:
+            body = analytics.metered(body, filename)
+            if progress:
+                body = download_tickets.tracked(body, progress)
+            body = metrics.metered_body(body)
+        return StreamingResponse(body, status_code=plan['status'], headers=plan['headers'])
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        logger.error(f"ClientError for {filename}: {error_code} - {e}")
+        if error_code in ('NoSuchKey', '404'):
+            return JSONResponse({"error": "File not found in R2. Check key: " + filename}, status_code=404)
+        return JSONResponse({"error": "R2 access failed: " + str(e)}, status_code=500)
+    except Exception as e:
+        logger.error(f"Download error for {filename}: {e}", exc_info=True)
+        return JSONResponse({"error": "Internal server error: " + str(e)}, status_code=500)
+
+
+@require_auth
+@rate_limited(backend.DOWNLOAD_LIMIT)
+async def serve_file(request):
+    return await send_download(request, request.path_params['filename'])
+
+
+@rate_limited(backend.DOWNLOAD_LIMIT)
+async def ticket_download(request):
+    filename = request.path_params['filename']
+    ticket = await asyncio.to_thread(download_tickets.redeem, request.path_params['token'], filename)
+    if ticket is None:
+        return JSONResponse({"error": "Download link is invalid or has expired"}, status_code=403)
+    return await send_download(request, filename, ticket)
+
+
+class SecurityHeadersMiddleware:
+    """Apply app.SECURITY_HEADERS to the async routes (Flask adds its own)."""
+
+    def __init__(self, asgi_app):
+        self.app = asgi_app
+        self.headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in backend.SECURITY_HEADERS.items()]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                present = {name for name, _ in message.get('headers', [])}
+                message['headers'] = list(message.get('headers', [])) + [
+                    (name, value) for name, value in self.headers if name not in present
+                ]
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+class RequestMetricsMiddleware:
+    """Latency of the async routes; requests mounted on Flask are timed by its own hooks."""
+
+    def __init__(self, asgi_app, routes):
+        self.app = asgi_app
+        self.route_paths = {route.endpoint: route.path for route in routes if isinstance(route, Route)}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = {'code': 500}
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router records the matched endpoint in the (shared) scope
+            route = self.route_paths.get(scope.get('endpoint'))
+            if route:
+                metrics.http_request_duration.observe(
+                    time.perf_counter() - started, method=scope['method'], route=route, status=status['code'])
+
+
+routes = [
+    Route('/api/auth/login', auth_login, methods=['POST']),
+    Route('/api/auth/logout', auth_logout, methods=['POST']),
+    Route('/api/auth/verify', auth_verify, methods=['GET']),
+    Route('/api/files', list_files, methods=['GET']),
+    Route('/api/events', change_events, methods=['GET']),
+    Route('/api/upload', upload_file, methods=['POST']),
+    Route('/api/serve-file/{filename:path}', serve_file, methods=['GET']),
+    Route('/api/dl/{token}/{filename:path}', ticket_download, methods=['GET']),
+    # Everything else: the synchronous Flask app, run on a thread pool
+    Mount('/', app=WSGIMiddleware(backend.app, workers=ASGI_WSGI_THREADS)),
+]
+
+app = SecurityHeadersMiddleware(RequestMetricsMiddleware(Starlette(routes=routes, lifespan=lifespan), routes))
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+import metadata_index
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revoked_sessions (
+    jti TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+"""
+
+MAX_CACHED_TOKENS = 10000
+REVOCATION_REFRESH = 2  # seconds between reloads of the revocation list (other workers may log out)
+
+# token -> verified JWT payload, until the token's own exp
+verified = OrderedDict()
+revoked = set()
+revoked_loaded = {'at': 0.0}
+lock = threading.Lock()
+
+
+def init_store():
+    metadata_index.get_connection().executescript(SCHEMA)
+    prune()
+    refresh_revocations()
+
+
+def prune():
+    metadata_index.get_connection().execute("DELETE FROM revoked_sessions WHERE expires_at < ?", (time.time(),))
+
+
+def refresh_revocations():
+    rows = metadata_index.get_connection().execute(
+        "SELECT jti FROM revoked_sessions WHERE expires_at >= ?", (time.time(),)
+    ).fetchall()
+    with lock:
+        revoked.clear()
+        revoked.update(row['jti'] for row in rows)
+        revoked_loaded['at'] = time.monotonic()
+
+
+def is_revoked(jti):
+    if time.monotonic() - revoked_loaded['at'] > REVOCATION_REFRESH:
+        refresh_revocations()
+    with lock:
+        return jti in revoked
+
+
+def cached_payload(token):
+    """Payload of a token verified earlier, if it has neither expired nor been revoked."""
+    with lock:
+        payload = verified.get(token)
+        if payload is None:
+            return None
+        if payload['exp'] <= time.time():
+            del verified[token]
+            return None
+        verified.move_to_end(token)
+    if is_revoked(payload['jti']):
+        return None
+    return payload
+
+
+def remember(token, payload):
+    with lock:
+        verified[token] = payload
+        verified.move_to_end(token)
+        while len(verified) > MAX_CACHED_TOKENS:
+            verified.popitem(last=False)
+
+
+def revoke(jti, expires_at):
+    """Reject this session from now on, in every worker, until it would have expired anyway."""
+    prune()
+    metadata_index.get_connection().execute(
+        "INSERT OR IGNORE INTO revoked_sessions (jti, expires_at) VALUES (?, ?)", (jti, expires_at)
+    )
+    with lock:
+        revoked.add(jti)
+        for token in [t for t, payload in verified.items() if payload['jti'] == jti]:
+            del verified[token]
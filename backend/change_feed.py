@@ -0,0 +1,162 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import metadata_index
+
+logger = logging.getLogger(__name__)
+
+# Events are rows in the shared metadata DB, so every worker (and the ASGI
+# server) sees every other worker's events under one sequence. Each process
+# runs a single poller that reads new rows into memory and wakes its
+# subscribers: a thousand open dashboards cost one indexed query per interval.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS change_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_change_events_created ON change_events (created_at);
+"""
+
+POLL_INTERVAL = 0.5
+RECENT_EVENTS = 2000   # kept in memory for reconnecting clients
+PRUNE_EVERY = 600      # seconds between deletions of expired rows
+
+settings = {'retention': 3600}
+recent = deque(maxlen=RECENT_EVENTS)   # (seq, type, data json)
+state = {'latest': 0}
+changed = threading.Condition()
+wakeup = threading.Event()
+listeners = []         # callables run by the poller after new events arrive (ASGI subscribers)
+
+
+def init_feed(retention):
+    metadata_index.get_connection().executescript(SCHEMA)
+    settings['retention'] = retention
+    row = metadata_index.get_connection().execute("SELECT MAX(seq) AS seq FROM change_events").fetchone()
+    state['latest'] = row['seq'] or 0
+
+
+def publish(event_type, data):
+    """Append an event for every connected dashboard. Never raises into the caller."""
+    try:
+        metadata_index.get_connection().execute(
+            "INSERT INTO change_events (type, data, created_at) VALUES (?, ?, ?)",
+            (event_type, json.dumps(data, separators=(',', ':')), time.time())
+        )
+        wakeup.set()
+    except Exception as e:
+        logger.warning(f"Could not publish '{event_type}' event: {e}")
+
+
+def latest_seq():
+    return state['latest']
+
+
+def events_after(seq):
+    """Events with sequence > seq, or None if some of them have already been pruned."""
+    with changed:
+        latest = state['latest']
+        if seq > latest:
+            return None  # a sequence from another database (e.g. restored or reset)
+        if seq == latest:
+            return []
+        if recent and recent[0][0] <= seq + 1:
+            return [event for event in recent if event[0] > seq]
+    rows = metadata_index.get_connection().execute(
+        "SELECT seq, type, data FROM change_events WHERE seq > ? AND seq <= ? ORDER BY seq", (seq, latest)
+    ).fetchall()
+    if not rows or rows[0]['seq'] != seq + 1:
+        return None
+    return [(row['seq'], row['type'], row['data']) for row in rows]
+
+
+def wait(seq, timeout):
+    """Block until an event newer than seq exists or timeout passes."""
+    with changed:
+        changed.wait_for(lambda: state['latest'] > seq, timeout)
+        return state['latest']
+
+
+def poll():
+    rows = metadata_index.get_connection().execute(
+        "SELECT seq, type, data FROM change_events WHERE seq > ? ORDER BY seq LIMIT 1000", (state['latest'],)
+    ).fetchall()
+    if not rows:
+        return False
+    with changed:
+        recent.extend((row['seq'], row['type'], row['data']) for row in rows)
+        state['latest'] = rows[-1]['seq']
+        changed.notify_all()
+    for listener in list(listeners):
+        listener()
+    return True
+
+
+def prune():
+    metadata_index.get_connection().execute(
+        "DELETE FROM change_events WHERE created_at < ?", (time.time() - settings['retention'],)
+    )
+
+
+def start_poller():
+    def loop():
+        last_prune = 0
+        while True:
+            try:
+                if poll():
+                    continue  # drain bursts before sleeping
+                if time.time() - last_prune > PRUNE_EVERY:
+                    prune()
+                    last_prune = time.time()
+            except Exception as e:
+                logger.error(f"Change feed poll failed: {e}")
+            wakeup.wait(POLL_INTERVAL)
+            wakeup.clear()
+
+    thread = threading.Thread(target=loop, name='change-feed', daemon=True)
+    thread.start()
+    return thread
+
+
+def format_event(seq, event_type, data):
+    return f"id: {seq}\nevent: {event_type}\ndata: {data}\n\n"
+
+
+def parse_since(last_event_id, since):
+    """Resume point from EventSource's Last-Event-ID header or ?since=; None means 'from now'."""
+    for value in (last_event_id, since):
+        try:
+            if value not in (None, ''):
+                return max(0, int(value))
+        except ValueError:
+            pass
+    return None
+
+
+def stream(since, heartbeat=15, max_duration=300):
+    """SSE body for a blocking server (one thread per connection).
+
+    Ends after max_duration so threads are recycled; EventSource reconnects with
+    Last-Event-ID and loses nothing.
+    """
+    yield "retry: 3000\n\n"
+    seq = latest_seq() if since is None else since
+    deadline = time.monotonic() + max_duration
+    while time.monotonic() < deadline:
+        events = events_after(seq)
+        if events is None:
+            # Too far behind: the client must reload its state, then follow from here
+            seq = latest_seq()
+            yield format_event(seq, 'resync', '{}')
+            continue
+        for event in events:
+            yield format_event(*event)
+            seq = event[0]
+        if not events:
+            if wait(seq, heartbeat) == seq:
+                yield ": ping\n\n"
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd needs the zstandard package; gzip is always available
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Compressible uploads are stored encoded (gzip or zstd) and marked like a static file
+# would be: the object's Content-Encoding says how, and its `original-size` metadata
+# keeps the size of the file itself. Downloads that accept the encoding get the stored
+# bytes as they are; everything else is decompressed on the way out.
+ENCODINGS = ('gzip', 'zstd')
+ORIGINAL_SIZE = 'original-size'
+SAMPLE_SIZE = 256 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+# Already compressed (or media the thumbnail workers read directly): never probed
+SKIP_PREFIXES = ('image/', 'video/', 'audio/', 'font/woff', 'application/vnd.openxmlformats',
+                 'application/vnd.oasis.opendocument')
+SKIP_TYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-bzip2', 'application/x-xz',
+    'application/zstd', 'application/x-zstd', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/vnd.rar', 'application/pdf', 'application/epub+zip', 'application/java-archive',
+    'application/x-apple-diskimage',
+}
+
+settings = {'enabled': False, 'encoding': 'gzip', 'level': 6, 'min_size': 64 * 1024, 'max_ratio': 0.8}
+
+
+def init_compression(encoding, level, min_size, max_ratio):
+    if encoding not in ENCODINGS:
+        raise ValueError(f"COMPRESSION_ENCODING must be one of {', '.join(ENCODINGS)}")
+    if encoding == 'zstd' and zstandard is None:
+        logger.warning("zstandard is not installed: compressing uploads with gzip instead")
+        encoding = 'gzip'
+    settings.update(enabled=True, encoding=encoding, level=level, min_size=min_size, max_ratio=max_ratio)
+    return encoding
+
+
+def compressor(encoding, level):
+    """Object with compress(data) and flush(), zlib-style."""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+
+
+# Upload side
+def choose(content_type, size, sample):
+    """Encoding to store an upload with, or None to store it as-is.
+
+    Known compressed types are skipped outright; anything else must shrink its first
+    SAMPLE_SIZE bytes to at most `max_ratio` of their size.
+    """
+    if not settings['enabled'] or size < settings['min_size'] or not sample:
+        return None
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in SKIP_TYPES or content_type.startswith(SKIP_PREFIXES):
+        return None
+    # The probe uses a fast level: it only has to tell text-like data from noise
+    probe = compressor(settings['encoding'], 1)
+    ratio = (len(probe.compress(sample)) + len(probe.flush())) / len(sample)
+    return settings['encoding'] if ratio <= settings['max_ratio'] else None
+
+
+def object_fields(encoding, original_size):
+    """put_object / create_multipart_upload arguments (and head_object fields) marking a stored encoding."""
+    return {'ContentEncoding': encoding, 'Metadata': {ORIGINAL_SIZE: str(original_size)}}
+
+
+class CompressingReader:
+    """Read-only stream of `stream`'s bytes, compressed. read(n) returns n bytes until the end.
+
+    `stored` counts the compressed bytes handed out so far, `original` the bytes read from `stream`.
+    """
+
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.compressor = compressor(encoding, settings['level'])
+        self.buffer = bytearray()
+        self.finished = False
+        self.stored = 0
+        self.original = 0
+
+    def wants(self, size):
+        return not self.finished and (size < 0 or len(self.buffer) < size)
+
+    def add(self, data):
+        if data:
+            self.original += len(data)
+            self.buffer += self.compressor.compress(data)
+        else:
+            self.buffer += self.compressor.flush()
+            self.finished = True
+
+    def take(self, size):
+        if size < 0 or size >= len(self.buffer):
+            data, self.buffer = bytes(self.buffer), bytearray()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        self.stored += len(data)
+        return data
+
+    def read(self, size=-1):
+        while self.wants(size):
+            self.add(self.stream.read(CHUNK_SIZE))
+        return self.take(size)
+
+
+class AsyncCompressingReader(CompressingReader):
+    """CompressingReader for the ASGI server's sequential `await upload.read(n)` calls.
+
+    Compression runs on a worker thread so it never stalls the event loop.
+    """
+
+    async def read(self, size=-1):
+        while self.wants(size):
+            await asyncio.to_thread(self.add, await self.stream.read(CHUNK_SIZE))
+        return self.take(size)
+
+
+# Download side
+def stored_encoding(head):
+    """Encoding an object was stored with (from a head_object result), or None."""
+    encoding = (head.get('ContentEncoding') or '').strip().lower()
+    return encoding if encoding in ENCODINGS else None
+
+
+def original_size(head):
+    value = (head.get('Metadata') or {}).get(ORIGINAL_SIZE)
+    return int(value) if value is not None else None
+
+
+def accepts(accept_encoding, encoding):
+    """Whether a parsed Accept-Encoding header (werkzeug) allows `encoding`."""
+    return bool(accept_encoding) and accept_encoding[encoding] > 0
+
+
+def decompress(chunks, encoding):
+    """Decompress an iterable of stored chunks, yielding the original bytes at most CHUNK_SIZE at a time
+    (a highly compressed chunk never inflates in memory all at once)."""
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is not installed: cannot decompress a zstd object")
+        reader = zstandard.ZstdDecompressor().stream_reader(ChunkReader(chunks))
+        while True:
+            data = reader.read(CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+    decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = decoder.decompress(chunk, CHUNK_SIZE)
+            chunk = decoder.unconsumed_tail
+            if data:
+                yield data
+    data = decoder.flush()
+    if data:
+        yield data
+
+
+class ChunkReader:
+    """read(n) over an iterable of byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def byte_range(chunks, start, end=None):
+    """Bytes start..end (inclusive; None = to the end) of a chunk stream, reading no further than end."""
+    position = 0
+    for chunk in chunks:
+        chunk_end = position + len(chunk)
+        if chunk_end > start:
+            yield chunk[max(0, start - position):None if end is None else end + 1 - position]
+        position = chunk_end
+        if end is not None and position > end:
+            return
+
+
+class DecompressingReader(ChunkReader):
+    """File-like read(n) over a stored body, decompressed, starting `skip` original bytes in."""
+
+    def __init__(self, body, encoding, skip=0):
+        chunks = decompress(iter(lambda: body.read(CHUNK_SIZE), b''), encoding)
+        super().__init__(byte_range(chunks, skip) if skip else chunks)
+        self.body = body
+
+    def close(self):
+        self.body.close()
@@ -0,0 +1,169 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+import metadata_index
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Increments are buffered in memory and applied in one transaction per flush.
+# Writes are additive (count = count + n), so several gunicorn workers can
+# flush into the same WAL database without losing each other's updates.
+pending_downloads = Counter()
+pending_uploads = {}
+pending_lock = threading.Lock()
+# Called with {key: downloads added} after each successful flush
+flush_listeners = []
+
+
+def record_download(key, count=1):
+    with pending_lock:
+        pending_downloads[key] += count
+
+
+def record_upload(key, uploaded_at):
+    with pending_lock:
+        pending_uploads[key] = uploaded_at
+
+
+@metrics.timed('counter_flush')
+def flush():
+    """Write buffered counters to SQLite. Returns the number of keys written."""
+    with pending_lock:
+        downloads = dict(pending_downloads)
+        uploads = dict(pending_uploads)
+        pending_downloads.clear()
+        pending_uploads.clear()
+    if not downloads and not uploads:
+        return 0
+
+    try:
+        with metadata_index.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO download_counts (key, count) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET count = count + excluded.count",
+                downloads.items()
+            )
+            conn.executemany(
+                "UPDATE objects SET download_count = download_count + ? WHERE key = ?",
+                [(n, key) for key, n in downloads.items()]
+            )
+            conn.executemany(
+                "INSERT INTO upload_history (key, uploaded_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET uploaded_at = excluded.uploaded_at",
+                uploads.items()
+            )
+    except Exception as e:
+        # Put the increments back so the next flush retries them
+        logger.error(f"Counter flush failed: {e}")
+        with pending_lock:
+            for key, n in downloads.items():
+                pending_downloads[key] += n
+            for key, uploaded_at in uploads.items():
+                pending_uploads.setdefault(key, uploaded_at)
+        return 0
+    if downloads:
+        for listener in flush_listeners:
+            listener(downloads)
+    return len(downloads) + len(uploads)
+
+
+def compact():
+    """Flush, then fold the WAL back into the main database file and truncate it."""
+    flush()
+    metadata_index.get_connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def get_download_counts():
+    counts = Counter({
+        row['key']: row['count']
+        for row in metadata_index.get_connection().execute("SELECT key, count FROM download_counts")
+    })
+    with pending_lock:
+        counts.update(pending_downloads)
+    return dict(counts)
+
+
+def get_upload_history():
+    history = {
+        row['key']: row['uploaded_at']
+        for row in metadata_index.get_connection().execute("SELECT key, uploaded_at FROM upload_history")
+    }
+    with pending_lock:
+        history.update(pending_uploads)
+    return history
+
+
+# One-time Migration
+def load_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        logger.warning(f"Skipping unreadable {path}: {e}")
+        return {}
+
+
+def migrate_json(download_count_file, upload_history_file):
+    """Import the legacy JSON files once, then rename them to *.migrated."""
+    files = [path for path in (download_count_file, upload_history_file) if os.path.exists(path)]
+    if not files:
+        return
+
+    with metadata_index.transaction() as conn:
+        # Another worker may have finished the import while we waited for the lock
+        if conn.execute("SELECT 1 FROM index_meta WHERE name = 'json_migrated'").fetchone() is None:
+            counts = load_json(download_count_file) if os.path.exists(download_count_file) else {}
+            history = load_json(upload_history_file) if os.path.exists(upload_history_file) else {}
+            conn.executemany(
+                "INSERT INTO download_counts (key, count) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET count = count + excluded.count",
+                [(key, int(n)) for key, n in counts.items()]
+            )
+            conn.executemany(
+                "UPDATE objects SET download_count = download_count + ? WHERE key = ?",
+                [(int(n), key) for key, n in counts.items()]
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO upload_history (key, uploaded_at) VALUES (?, ?)",
+                history.items()
+            )
+            conn.executemany(
+                "UPDATE objects SET uploaded_at = ? WHERE key = ? AND uploaded_at IS NULL",
+                [(uploaded_at, key) for key, uploaded_at in history.items()]
+            )
+            conn.execute(
+                "INSERT INTO index_meta (name, value) VALUES ('json_migrated', ?)", (str(time.time()),)
+            )
+            logger.info(f"Migrated {len(counts)} download counts and {len(history)} upload records from JSON")
+
+    for path in files:
+        try:
+            os.replace(path, path + '.migrated')
+        except OSError:
+            pass
+
+
+def start_flusher(interval, compact_interval):
+    """Flush every `interval` seconds and compact every `compact_interval` seconds."""
+    def loop():
+        last_compact = time.time()
+        while True:
+            time.sleep(interval)
+            try:
+                flush()
+                if time.time() - last_compact >= compact_interval:
+                    compact()
+                    last_compact = time.time()
+            except Exception as e:
+                logger.error(f"Counter store maintenance failed: {e}")
+
+    thread = threading.Thread(target=loop, name='counter-flusher', daemon=True)
+    thread.start()
+    atexit.register(flush)
+    return thread
@@ -0,0 +1,59 @@
+import hashlib
+
+
+class HashingReader:
+    """Upload stream wrapper that SHA-256s the bytes as they are read on their way to R2.
+
+    Tracks the read position so botocore's seeks (length probes, retries) cannot
+    corrupt the digest: every byte is hashed once, in order, and a skipped range
+    leaves no digest at all rather than a wrong one.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+        self.position = stream.tell()
+        self.hashed = 0
+        self.broken = False
+
+    def read(self, size=-1):
+        start = self.position
+        data = self.stream.read(size)
+        self.position += len(data)
+        if start <= self.hashed < self.position:
+            self.sha256.update(memoryview(data)[self.hashed - start:])
+            self.hashed = self.position
+        elif start > self.hashed:
+            self.broken = True
+        return data
+
+    def seek(self, offset, whence=0):
+        self.position = self.stream.seek(offset, whence)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def hexdigest(self, size):
+        """Digest of the whole upload, or None if not every byte passed through in order."""
+        if self.broken or self.hashed != size:
+            return None
+        return self.sha256.hexdigest()
+
+
+class AsyncHashingReader:
+    """HashingReader for the ASGI server's sequential `await upload.read(n)` calls."""
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.sha256 = hashlib.sha256()
+        self.hashed = 0
+
+    async def read(self, size=-1):
+        data = await self.upload.read(size)
+        self.sha256.update(data)
+        self.hashed += len(data)
+        return data
+
+    def hexdigest(self, size):
+        return self.sha256.hexdigest() if self.hashed == size else None
@@ -1,58 +1,271 @@
+import argparse
+import json
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
+import shards
+
 load_dotenv()
 
-# Config S3 client, coz this compatible R2 use too
-s3_client = boto3.client(
-    's3',
-    endpoint_url=f"https://{os.getenv('R2_ACCOUNT_ID')}.r2.cloudflarestorage.com",
-    aws_access_key_id=os.getenv("R2_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("R2_SECRET_ACCESS_KEY"),
-    region_name='auto'
-)
-
-def delete_all_objects(bucket_name):
-    """Delete all objects in your Buckets"""
-    try:
-        objects_to_delete = []
-        paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    objects_to_delete.append({'Key': obj['Key']})
-
-        if not objects_to_delete:
-            print(f"Bucket '{bucket_name}' already empty")
+BATCH_SIZE = 1000          # DeleteObjects accepts at most 1000 keys per call
+MAX_RETRIES = 6
+RETRYABLE_CODES = {'SlowDown', 'InternalError', 'ServiceUnavailable', 'RequestTimeout', 'Throttling', 'TooManyRequests'}
+CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def create_client(config):
+    """S3 client for one shard's bucket, coz this compatible R2 use too"""
+    return boto3.client(
+        's3',
+        endpoint_url=config['endpoint_url'],
+        aws_access_key_id=config['access_key_id'],
+        aws_secret_access_key=config['secret_access_key'],
+        region_name='auto',
+        config=Config(max_pool_connections=64, retries={'max_attempts': 5, 'mode': 'adaptive'})
+    )
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter, capped at 20 seconds"""
+    time.sleep(random.uniform(0, min(20, 0.5 * 2 ** attempt)))
+
+
+def delete_batch(s3_client, bucket_name, keys):
+    """Delete up to 1000 keys, retrying throttled ones. Returns (deleted, [(key, message)] failed)"""
+    pending = keys
+    failed = []
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in pending], 'Quiet': True}
+            )
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code not in RETRYABLE_CODES or attempt == MAX_RETRIES - 1:
+                return len(keys) - len(pending), failed + [(key, str(e)) for key in pending]
+            backoff(attempt)
+            continue
+
+        retry = []
+        for error in response.get('Errors', []):
+            if error.get('Code') in RETRYABLE_CODES and attempt < MAX_RETRIES - 1:
+                retry.append(error['Key'])
+            else:
+                failed.append((error['Key'], error.get('Message', error.get('Code'))))
+        if not retry:
+            break
+        pending = retry
+        backoff(attempt)
+
+    return len(keys) - len(failed), failed
+
+
+class Progress:
+    """Counts results and checkpoints the last key below which every batch has been deleted"""
+
+    def __init__(self, bucket_name, prefix, checkpoint_path, dry_run):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.checkpoint_path = checkpoint_path
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_report = 0
+        self.deleted = 0
+        self.deleted_this_run = 0  # excludes a resumed checkpoint's count, for the rate
+        self.failed = 0
+        self.finished = {}        # batch number -> (last key, clean)
+        self.next_batch = 0
+        self.start_after = None
+        self.blocked = False      # a batch with failures stops the checkpoint advancing
+
+    def load(self):
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                state = json.load(f)
+        except (IOError, json.JSONDecodeError):
+            return None
+        if state.get('bucket') != self.bucket_name or state.get('prefix') != self.prefix:
+            return None
+        self.start_after = state.get('start_after')
+        self.deleted = state.get('deleted', 0)
+        return self.start_after
+
+    def save(self):
+        if self.dry_run or not self.checkpoint_path:
             return
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'bucket': self.bucket_name,
+                'prefix': self.prefix,
+                'start_after': self.start_after,
+                'deleted': self.deleted,
+                'updated_at': time.time(),
+            }, f)
+        os.replace(tmp_path, self.checkpoint_path)
 
-        # Delete all objects w/ one batch
-        print(f"Find {len(objects_to_delete)} objects. removing...")
-        delete_response = s3_client.delete_objects(
-            Bucket=bucket_name,
-            Delete={'Objects': objects_to_delete}
-        )
+    def record(self, batch_number, last_key, deleted, failed):
+        with self.lock:
+            self.deleted += deleted
+            self.deleted_this_run += deleted
+            self.failed += len(failed)
+            for key, message in failed:
+                print(f"  - Failed delete {key}: {message}")
+
+            self.finished[batch_number] = (last_key, not failed)
+            advanced = False
+            while not self.blocked and self.next_batch in self.finished:
+                key, clean = self.finished.pop(self.next_batch)
+                if not clean:
+                    self.blocked = True
+                    break
+                self.start_after = key
+                self.next_batch += 1
+                advanced = True
+            if advanced:
+                self.save()
+
+            now = time.time()
+            if now - self.last_report >= 2:
+                self.last_report = now
+                self.report()
 
-        if 'Deleted' in delete_response:
-            print(f"Succeesfull delete {len(delete_response['Deleted'])} objects.")
-        if 'Errors' in delete_response:
-            print(f"Take place {len(delete_response['Errors'])} error while deleting:")
-            for error in delete_response['Errors']:
-                print(f"  - Failed delete {error['Key']}: {error['Message']}")
+    def rate(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return self.deleted_this_run / elapsed
 
+    def report(self):
+        verb = "Would delete" if self.dry_run else "Deleted"
+        print(f"{self.bucket_name}: {verb} {self.deleted} objects ({self.rate():.0f} objects/sec), {self.failed} failed")
+
+    def clear(self):
+        if not self.dry_run and self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+def delete_all_objects(s3_client, bucket_name, prefix='', workers=8, dry_run=False, checkpoint_path=None, resume=True):
+    """Delete all objects in one bucket (or under a prefix), one listing page per DeleteObjects batch"""
+    progress = Progress(bucket_name, prefix, checkpoint_path, dry_run)
+    start_after = progress.load() if resume and checkpoint_path else None
+    if start_after:
+        print(f"Resuming after '{start_after}' ({progress.deleted} objects already deleted)")
+
+    # Bound the listed-but-not-deleted backlog so memory stays flat on huge buckets
+    in_flight = threading.BoundedSemaphore(workers * 2)
+
+    def run(batch_number, keys):
+        try:
+            if dry_run:
+                progress.record(batch_number, keys[-1], len(keys), [])
+            else:
+                deleted, failed = delete_batch(s3_client, bucket_name, keys)
+                progress.record(batch_number, keys[-1], deleted, failed)
+        except Exception as e:
+            progress.record(batch_number, keys[-1], 0, [(key, str(e)) for key in keys])
+        finally:
+            in_flight.release()
+
+    listed = 0
+    params = {'Bucket': bucket_name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': BATCH_SIZE}}
+    if start_after:
+        params['StartAfter'] = start_after
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            paginator = s3_client.get_paginator('list_objects_v2')
+            batch_number = 0  # only submitted batches are numbered: the checkpoint waits for each in turn
+            for page in paginator.paginate(**params):
+                keys = [obj['Key'] for obj in page.get('Contents', [])]
+                if not keys:
+                    continue
+                listed += len(keys)
+                in_flight.acquire()
+                executor.submit(run, batch_number, keys)
+                batch_number += 1
+    except KeyboardInterrupt:
+        progress.report()
+        print("Interrupted. Run again to resume from the last checkpoint.")
+        raise
     except Exception as e:
         print(f"An error occurred: {e}")
+        progress.report()
+        return False
+
+    if not listed and not start_after:
+        print(f"Bucket '{bucket_name}' already empty")
+        return True
+
+    progress.report()
+    if progress.failed:
+        print(f"Take place {progress.failed} error while deleting. Run again to retry them.")
+        return False
+
+    progress.clear()
+    if not dry_run:
+        print(f"Succeesfull delete {progress.deleted} objects.")
+    return True
+
+
+def delete_shards(configs, prefix='', workers=8, dry_run=False, resume=True):
+    """Empty every shard's bucket at once, each with its own client and checkpoint. True if all completed"""
+    def run(config):
+        checkpoint_path = os.path.join(CHECKPOINT_DIR, f"delete-{config['bucket']}.json")
+        return delete_all_objects(
+            create_client(config), config['bucket'], prefix=prefix, workers=workers,
+            dry_run=dry_run, checkpoint_path=checkpoint_path, resume=resume
+        )
+
+    if len(configs) == 1:
+        return run(configs[0])
+    with ThreadPoolExecutor(max_workers=len(configs)) as executor:
+        return all(list(executor.map(run, configs)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Delete every object in the R2 bucket (every shard's bucket with R2_SHARDS)")
+    parser.add_argument('--prefix', default='', help="only delete keys starting with this prefix")
+    parser.add_argument('--shard', action='append', help="only this shard (by name, repeatable)")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent DeleteObjects batches per bucket (default 8)")
+    parser.add_argument('--dry-run', action='store_true', help="list and count what would be deleted")
+    parser.add_argument('--restart', action='store_true', help="ignore any saved checkpoint")
+    parser.add_argument('--yes', action='store_true', help="skip the confirmation prompt")
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
-    bucket_name = os.getenv("R2_BUCKET_NAME")
-    if not bucket_name:
-        print("Error: R2_BUCKET_NAME not found in file .env")
-    else:
-        print(f"Initiates deletion of all objects in the bucket server global: {bucket_name}")
-        confirm = input("Are you sure? This cannot be undone. (yes/no): ")
+    args = parse_args()
+    try:
+        configs = [c for c in shards.configs_from_env() if not args.shard or c['name'] in args.shard]
+    except ValueError as e:
+        configs = None
+        print(f"Error: {e} (set R2_BUCKET_NAME or R2_SHARDS in file .env)")
+    if configs == []:
+        print(f"Error: no shard named {', '.join(args.shard)} in R2_SHARDS")
+    elif configs:
+        target = f"'{args.prefix}*' in" if args.prefix else "all objects in"
+        buckets = ', '.join(config['bucket'] for config in configs)
+        print(f"Initiates deletion of {target} the bucket server global: {buckets}")
+        confirm = 'yes' if args.yes or args.dry_run else input("Are you sure? This cannot be undone. (yes/no): ")
         if confirm.lower() == 'yes':
-            delete_all_objects(bucket_name)
-            print("NOTE: The process's global server cloud storage has complete! Now delete the totalLy bucket from your Cloudflare dashboard..")
+            completed = delete_shards(
+                configs,
+                prefix=args.prefix,
+                workers=max(1, args.workers),
+                dry_run=args.dry_run,
+                resume=not args.restart
+            )
+            if completed and not args.dry_run and not args.prefix:
+                print("NOTE: The process's global server cloud storage has complete! Now delete the totalLy bucket from your Cloudflare dashboard..")
         else:
             print("Cancelled.")
@@ -0,0 +1,170 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+
+import auth_sessions
+import metadata_index
+
+# A ticket is a signed, cookie-free capability for one file, so the browser's own
+# download manager (which does not replay fetch() credentials) can fetch and resume it.
+# The signature covers the ticket id, its start deadline and the key; the row holds
+# the owning session (logout revokes its tickets, and none outlives it) and the
+# progress the status endpoint reports.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS download_tickets (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    session TEXT,
+    session_expires REAL,
+    size INTEGER NOT NULL,
+    received INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_download_tickets_created ON download_tickets (created_at);
+"""
+
+PROGRESS_INTERVAL = 0.5  # seconds between progress writes per download
+
+settings = {'secret': b'', 'ttl': 60, 'resume_window': 3600}
+
+
+def init_tickets(secret, ttl, resume_window):
+    conn = metadata_index.get_connection()
+    conn.executescript(SCHEMA)
+    existing = {row['name'] for row in conn.execute("PRAGMA table_info(download_tickets)")}
+    if 'session_expires' not in existing:
+        conn.execute("ALTER TABLE download_tickets ADD COLUMN session_expires REAL")
+    settings.update(secret=secret.encode('utf-8'), ttl=ttl, resume_window=resume_window)
+    prune()
+
+
+def sign(ticket_id, expires, key):
+    message = f"{ticket_id}.{expires}.{key}".encode('utf-8')
+    digest = hmac.new(settings['secret'], message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def issue(key, size, session=None, session_expires=None):
+    """Create a ticket for `key`; returns (ticket id, token). The token must be used within the TTL,
+    and stops working when the session that asked for it expires (`session_expires`, a timestamp)."""
+    prune()
+    ticket_id = secrets.token_urlsafe(12)
+    expires = int(time.time()) + settings['ttl']
+    now = time.time()
+    metadata_index.get_connection().execute(
+        "INSERT INTO download_tickets (id, key, session, session_expires, size, status, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, 'issued', ?, ?)",
+        (ticket_id, key, session, session_expires, size, now, now)
+    )
+    return ticket_id, f"{ticket_id}.{expires}.{sign(ticket_id, expires, key)}"
+
+
+def redeem(token, key):
+    """Ticket row for a download request, or None if the token is forged, expired or revoked.
+
+    A ticket has to be started before its TTL runs out; once started, the same URL keeps
+    working for resumed (ranged) requests until `resume_window` after the first byte.
+    Never past the owning session's expiry.
+    """
+    try:
+        ticket_id, expires, signature = token.split('.')
+        expires = int(expires)
+    except ValueError:
+        return None
+    if not hmac.compare_digest(signature, sign(ticket_id, expires, key)):
+        return None
+    ticket = get(ticket_id)
+    if ticket is None or ticket['key'] != key:
+        return None
+    if ticket['session'] and auth_sessions.is_revoked(ticket['session']):
+        return None
+    now = time.time()
+    if ticket['session_expires'] is not None and now > ticket['session_expires']:
+        return None
+    if ticket['started_at'] is None:
+        if now > expires:
+            return None
+        metadata_index.get_connection().execute(
+            "UPDATE download_tickets SET started_at = ? WHERE id = ? AND started_at IS NULL", (now, ticket_id)
+        )
+        ticket['started_at'] = now
+    elif now > ticket['started_at'] + settings['resume_window']:
+        return None
+    return ticket
+
+
+def get(ticket_id):
+    row = metadata_index.get_connection().execute(
+        "SELECT * FROM download_tickets WHERE id = ?", (ticket_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def status(ticket_id):
+    """Progress for the status endpoint, or None for an unknown ticket."""
+    ticket = get(ticket_id)
+    if ticket is None:
+        return None
+    return {
+        'id': ticket['id'],
+        'key': ticket['key'],
+        'status': ticket['status'],
+        'size': ticket['size'],
+        'received': ticket['received'],
+        'percent': round(100 * ticket['received'] / ticket['size'], 1) if ticket['size'] else 100.0,
+        'updated_at': ticket['updated_at'],
+    }
+
+
+def prune():
+    """Forget tickets that can no longer be started or resumed."""
+    metadata_index.get_connection().execute(
+        "DELETE FROM download_tickets WHERE created_at < ?",
+        (time.time() - settings['ttl'] - settings['resume_window'],)
+    )
+
+
+class Progress:
+    """Bytes served for one ticket request starting at `offset`, written at most every PROGRESS_INTERVAL.
+
+    Usable from sync and async bodies alike: add() only counts and says when a write is due.
+    """
+
+    def __init__(self, ticket_id, offset, size):
+        self.ticket_id = ticket_id
+        self.size = size
+        self.received = offset
+        self.flushed_at = 0.0
+
+    def add(self, count):
+        self.received += count
+        return time.monotonic() - self.flushed_at >= PROGRESS_INTERVAL
+
+    def flush(self, state='downloading'):
+        self.flushed_at = time.monotonic()
+        # size is what this response sends: a compressed file passed through encoded is smaller than the file
+        metadata_index.get_connection().execute(
+            "UPDATE download_tickets SET received = ?, size = ?, status = ?, updated_at = ? WHERE id = ?",
+            (min(self.received, self.size), self.size, state, time.time(), self.ticket_id)
+        )
+
+    def finish(self):
+        # Anything short of the last byte is a pause (or a dropped connection) the browser may resume
+        self.flush('complete' if self.received >= self.size else 'paused')
+
+
+def tracked(body, progress):
+    """Pass a sync download body through, recording progress (closed early = paused)."""
+    try:
+        progress.flush()
+        for chunk in body:
+            if progress.add(len(chunk)):
+                progress.flush()
+            yield chunk
+    finally:
+        progress.finish()
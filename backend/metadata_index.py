@@ -0,0 +1,538 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+INDEX_DB_FILE = os.getenv("INDEX_DB_FILE", "data/metadata.db")
+RECONCILE_PAGE_SIZE = 1000
+
+# API sort name -> indexed column
+SORT_COLUMNS = {
+    'mtime': 'last_modified',
+    'size': 'size',
+    'name': 'key',
+    'downloads': 'download_count',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    last_modified TEXT NOT NULL,
+    etag TEXT,
+    content_type TEXT,
+    uploaded_at TEXT,
+    download_count INTEGER NOT NULL DEFAULT 0,
+    seen_run INTEGER NOT NULL DEFAULT 0,
+    indexed_at REAL NOT NULL DEFAULT 0,
+    sha256 TEXT,
+    alias_of TEXT,
+    shard TEXT,
+    encoding TEXT,
+    stored_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_objects_mtime ON objects (last_modified, key);
+CREATE INDEX IF NOT EXISTS idx_objects_size ON objects (size, key);
+CREATE INDEX IF NOT EXISTS idx_objects_downloads ON objects (download_count, key);
+
+CREATE TABLE IF NOT EXISTS index_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- Lifetime counters, kept even while a key is missing from objects (see counter_store)
+CREATE TABLE IF NOT EXISTS download_counts (
+    key TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS upload_history (
+    key TEXT PRIMARY KEY,
+    uploaded_at TEXT NOT NULL
+);
+
+-- Unique-key allocation: next ' (n)' suffix per original filename, and keys
+-- handed to in-flight uploads that are not in objects yet
+CREATE TABLE IF NOT EXISTS key_counters (
+    filename TEXT PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS key_reservations (
+    key TEXT PRIMARY KEY,
+    reserved_at REAL NOT NULL
+);
+
+-- Running aggregates, kept current by the triggers below
+CREATE TABLE IF NOT EXISTS bucket_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    total_files INTEGER NOT NULL DEFAULT 0,
+    total_size INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO bucket_totals (id) VALUES (1);
+
+-- Bytes of live objects per upload month ('YYYY-MM')
+CREATE TABLE IF NOT EXISTS monthly_uploads (
+    period TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_objects_insert AFTER INSERT ON objects BEGIN
+    UPDATE bucket_totals SET total_files = total_files + 1, total_size = total_size + NEW.size WHERE id = 1;
+    INSERT INTO monthly_uploads (period) SELECT substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7)
+        WHERE NOT EXISTS (SELECT 1 FROM monthly_uploads
+                          WHERE period = substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7));
+    UPDATE monthly_uploads SET size = size + NEW.size
+        WHERE period = substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_objects_delete AFTER DELETE ON objects BEGIN
+    UPDATE bucket_totals SET total_files = total_files - 1, total_size = total_size - OLD.size WHERE id = 1;
+    UPDATE monthly_uploads SET size = size - OLD.size
+        WHERE period = substr(COALESCE(OLD.uploaded_at, OLD.last_modified), 1, 7);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_objects_update AFTER UPDATE OF size, uploaded_at, last_modified ON objects
+WHEN OLD.size != NEW.size
+  OR substr(COALESCE(OLD.uploaded_at, OLD.last_modified), 1, 7) != substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7)
+BEGIN
+    UPDATE bucket_totals SET total_size = total_size - OLD.size + NEW.size WHERE id = 1;
+    UPDATE monthly_uploads SET size = size - OLD.size
+        WHERE period = substr(COALESCE(OLD.uploaded_at, OLD.last_modified), 1, 7);
+    INSERT INTO monthly_uploads (period) SELECT substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7)
+        WHERE NOT EXISTS (SELECT 1 FROM monthly_uploads
+                          WHERE period = substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7));
+    UPDATE monthly_uploads SET size = size + NEW.size
+        WHERE period = substr(COALESCE(NEW.uploaded_at, NEW.last_modified), 1, 7);
+END;
+"""
+
+# Upload deduplication: content hashes of stored objects, and keys that are only an
+# alias of another object's bytes (no object of their own in R2). Created after
+# ADDED_COLUMNS so indexes built before these columns existed are upgraded first.
+# objects.shard: the bucket (see shards.py) holding the object; NULL in indexes from before sharding.
+# objects.encoding / stored_size: how a compressed object is stored and its size in R2
+# (see compression.py); `size` is always the file's own size. NULL for objects stored as-is.
+ADDED_COLUMNS = {'sha256': 'TEXT', 'alias_of': 'TEXT', 'shard': 'TEXT', 'encoding': 'TEXT', 'stored_size': 'INTEGER'}
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_objects_sha256 ON objects (sha256) WHERE sha256 IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_objects_alias ON objects (alias_of) WHERE alias_of IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_objects_encoding ON objects (encoding) WHERE encoding IS NOT NULL;
+"""
+
+_local = threading.local()
+
+
+def get_connection():
+    """Per-thread SQLite connection to the metadata index (WAL mode)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        directory = os.path.dirname(INDEX_DB_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(INDEX_DB_FILE, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+
+def init_index():
+    """Create the index tables if they do not exist yet."""
+    conn = get_connection()
+    conn.executescript(SCHEMA)
+    existing = {row['name'] for row in conn.execute("PRAGMA table_info(objects)")}
+    for column, column_type in ADDED_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE objects ADD COLUMN {column} {column_type}")
+    conn.executescript(ADDED_INDEXES)
+    if get_meta('totals_recounted') is None:
+        # Index built before the aggregate triggers existed
+        recount_totals()
+
+
+@contextmanager
+def transaction():
+    """Explicit write transaction on the autocommit connection."""
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def to_iso(dt):
+    """Normalize a datetime to a sortable UTC ISO string (second precision)."""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def utc_now_iso():
+    return to_iso(datetime.now(timezone.utc))
+
+
+def set_meta(name, value):
+    get_connection().execute(
+        "INSERT INTO index_meta (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+        (name, str(value))
+    )
+
+
+def get_meta(name, default=None):
+    row = get_connection().execute("SELECT value FROM index_meta WHERE name = ?", (name,)).fetchone()
+    return row['value'] if row else default
+
+
+# Object Records
+def upsert_object(key, size, last_modified=None, etag=None, content_type=None, uploaded_at=None, sha256=None,
+                  shard=None, encoding=None, stored_size=None):
+    """Insert or refresh one object after a successful upload."""
+    get_connection().execute(
+        """
+        INSERT INTO objects (key, size, last_modified, etag, content_type, uploaded_at, indexed_at, sha256, shard,
+                             encoding, stored_size)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            size = excluded.size,
+            last_modified = excluded.last_modified,
+            etag = COALESCE(excluded.etag, objects.etag),
+            content_type = COALESCE(excluded.content_type, objects.content_type),
+            uploaded_at = COALESCE(excluded.uploaded_at, objects.uploaded_at),
+            indexed_at = excluded.indexed_at,
+            sha256 = COALESCE(excluded.sha256, objects.sha256),
+            shard = COALESCE(excluded.shard, objects.shard),
+            encoding = excluded.encoding,
+            stored_size = excluded.stored_size
+        """,
+        (key, size, last_modified or utc_now_iso(), etag, content_type, uploaded_at, time.time(), sha256, shard,
+         encoding, stored_size)
+    )
+
+
+def delete_object(key):
+    get_connection().execute("DELETE FROM objects WHERE key = ?", (key,))
+
+
+def get_object(key):
+    row = get_connection().execute("SELECT * FROM objects WHERE key = ?", (key,)).fetchone()
+    return dict(row) if row else None
+
+
+# Deduplication
+def find_by_content(sha256, size, exclude_key):
+    """Key of another stored (non-alias) object with exactly this content, or None."""
+    row = get_connection().execute(
+        "SELECT key FROM objects WHERE sha256 = ? AND size = ? AND alias_of IS NULL AND key != ? LIMIT 1",
+        (sha256, size, exclude_key)
+    ).fetchone()
+    return row['key'] if row else None
+
+
+def make_alias(key, target):
+    """Point key at target's bytes; key keeps its own name, dates and download count."""
+    get_connection().execute(
+        "UPDATE objects SET alias_of = ?, etag = (SELECT etag FROM objects WHERE key = ?), "
+        "encoding = NULL, stored_size = NULL WHERE key = ?",
+        (target, target, key)
+    )
+
+
+def storage_key(key):
+    """The R2 key holding key's bytes: its alias target, or key itself."""
+    row = get_connection().execute("SELECT alias_of FROM objects WHERE key = ?", (key,)).fetchone()
+    return row['alias_of'] if row and row['alias_of'] else key
+
+
+# Sharding
+def move_object(key, source, target, etag, target_etag=None):
+    """Point key's row from shard `source` (as stored, may be NULL) at `target`, unless the object changed meanwhile.
+
+    `target_etag` is the copy's ETag when it differs (a streamed copy may be split into different parts).
+    """
+    return get_connection().execute(
+        "UPDATE objects SET shard = ?, etag = COALESCE(?, etag), indexed_at = ? "
+        "WHERE key = ? AND shard IS ? AND etag IS ? AND alias_of IS NULL",
+        (target, target_etag, time.time(), key, source, etag)
+    ).rowcount == 1
+
+
+def shard_totals(period_start):
+    """Stored files and bytes per shard, plus bytes uploaded this period (aliases take no space)."""
+    rows = get_connection().execute(
+        "SELECT shard, COUNT(*) AS files, COALESCE(SUM(COALESCE(stored_size, size)), 0) AS size, "
+        "COALESCE(SUM(CASE WHEN substr(COALESCE(uploaded_at, last_modified), 1, 7) = ? "
+        "THEN COALESCE(stored_size, size) END), 0) AS period_size FROM objects WHERE alias_of IS NULL GROUP BY shard",
+        (period_start.strftime('%Y-%m'),)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+# Unique Key Allocation
+def key_taken(conn, key, reservation_cutoff):
+    return conn.execute(
+        "SELECT 1 FROM objects WHERE key = ? "
+        "UNION ALL SELECT 1 FROM key_reservations WHERE key = ? AND reserved_at >= ? LIMIT 1",
+        (key, key, reservation_cutoff)
+    ).fetchone() is not None
+
+
+def allocate_key(filename, reservation_ttl):
+    """Reserve `filename`, or the next free 'name (n).ext', for a new upload.
+
+    The write lock makes allocation atomic across threads and workers, and the
+    per-filename counter means the number of duplicates does not matter: the
+    first candidate tried is almost always free.
+    """
+    name, ext = os.path.splitext(filename)
+    now = time.time()
+    cutoff = now - reservation_ttl
+    with transaction() as conn:
+        key = filename
+        if key_taken(conn, key, cutoff):
+            row = conn.execute("SELECT next FROM key_counters WHERE filename = ?", (filename,)).fetchone()
+            counter = row['next'] if row else 1
+            while True:
+                key = f"{name} ({counter}){ext}"
+                counter += 1
+                if not key_taken(conn, key, cutoff):
+                    break
+            conn.execute(
+                "INSERT INTO key_counters (filename, next) VALUES (?, ?) "
+                "ON CONFLICT(filename) DO UPDATE SET next = excluded.next",
+                (filename, counter)
+            )
+        conn.execute(
+            "INSERT INTO key_reservations (key, reserved_at) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET reserved_at = excluded.reserved_at",
+            (key, now)
+        )
+    return key
+
+
+def release_key(key):
+    """Drop the reservation once the upload is in objects (or was abandoned)."""
+    get_connection().execute("DELETE FROM key_reservations WHERE key = ?", (key,))
+
+
+def prune_reservations(max_age):
+    return get_connection().execute(
+        "DELETE FROM key_reservations WHERE reserved_at < ?", (time.time() - max_age,)
+    ).rowcount
+
+
+def query_objects(sort='mtime', order='desc', q=None, match='substring', limit=60, after=None):
+    """One keyset-paginated page of objects.
+
+    `after` is the (sort value, key) of the last row of the previous page.
+    Rows are yielded lazily straight from the SQLite cursor.
+    """
+    column = SORT_COLUMNS[sort]
+    direction = 'DESC' if order == 'desc' else 'ASC'
+    compare = '<' if order == 'desc' else '>'
+
+    clauses, params = [], []
+    if q:
+        escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern = f"{escaped}%" if match == 'prefix' else f"%{escaped}%"
+        clauses.append("key LIKE ? ESCAPE '\\'")
+        params.append(pattern)
+    if after is not None:
+        if column == 'key':
+            clauses.append(f"key {compare} ?")
+            params.append(after[1])
+        else:
+            clauses.append(f"({column}, key) {compare} (?, ?)")
+            params.extend(after)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    order_by = "key " + direction if column == 'key' else f"{column} {direction}, key {direction}"
+    cursor = get_connection().execute(
+        "SELECT key, size, last_modified, etag, content_type, uploaded_at, download_count, alias_of "
+        f"FROM objects {where} ORDER BY {order_by} LIMIT ?",
+        (*params, limit)
+    )
+    return (dict(row) for row in cursor)
+
+
+def objects_with_prefix(prefix, limit):
+    """Up to `limit` objects whose key starts with prefix (case-sensitive), in key order."""
+    cursor = get_connection().execute(
+        "SELECT key, size, last_modified, etag FROM objects WHERE key >= ? AND key < ? ORDER BY key LIMIT ?",
+        (prefix, prefix + '\U0010ffff', limit)
+    )
+    return [dict(row) for row in cursor]
+
+
+def get_totals(period_start):
+    """Total files/bytes and bytes uploaded in the month starting at period_start.
+
+    The running aggregates count every key (logical bytes); aliases, which take
+    no space in R2, and the bytes saved by compressed objects are summed separately
+    over their partial indexes.
+    """
+    conn = get_connection()
+    month = period_start.strftime('%Y-%m')
+    totals = conn.execute("SELECT total_files, total_size FROM bucket_totals WHERE id = 1").fetchone()
+    period = conn.execute("SELECT size FROM monthly_uploads WHERE period = ?", (month,)).fetchone()
+    aliases = conn.execute(
+        "SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS size, "
+        "COALESCE(SUM(CASE WHEN substr(COALESCE(uploaded_at, last_modified), 1, 7) = ? THEN size END), 0) AS period_size "
+        "FROM objects WHERE alias_of IS NOT NULL",
+        (month,)
+    ).fetchone()
+    compressed = conn.execute(
+        "SELECT COUNT(*) AS files, COALESCE(SUM(size - stored_size), 0) AS saved, "
+        "COALESCE(SUM(CASE WHEN substr(COALESCE(uploaded_at, last_modified), 1, 7) = ? THEN size - stored_size END), 0) "
+        "AS period_saved FROM objects WHERE encoding IS NOT NULL AND alias_of IS NULL",
+        (month,)
+    ).fetchone()
+    return {
+        "total_files": totals['total_files'],
+        "total_size": totals['total_size'],
+        "current_period_size": period['size'] if period else 0,
+        "alias_files": aliases['files'],
+        "alias_size": aliases['size'],
+        "alias_period_size": aliases['period_size'],
+        "compressed_files": compressed['files'],
+        "compressed_saved": compressed['saved'],
+        "compressed_period_saved": compressed['period_saved'],
+    }
+
+
+def recount_totals():
+    """Rebuild the running aggregates from the objects table to correct any drift."""
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE bucket_totals SET total_files = (SELECT COUNT(*) FROM objects), "
+            "total_size = (SELECT COALESCE(SUM(size), 0) FROM objects) WHERE id = 1"
+        )
+        conn.execute("DELETE FROM monthly_uploads")
+        conn.execute(
+            "INSERT INTO monthly_uploads (period, size) "
+            "SELECT substr(COALESCE(uploaded_at, last_modified), 1, 7), SUM(size) FROM objects GROUP BY 1"
+        )
+    set_meta('totals_recounted', time.time())
+
+
+# Background Reconciler
+# start_reconcile -> reconcile_shard for every shard (in parallel, each on its own
+# thread's connection) -> finish_reconcile
+def start_reconcile(primary_shard):
+    """Begin a walk of every shard. Rows from before sharding are on the primary shard."""
+    get_connection().execute("UPDATE objects SET shard = ? WHERE shard IS NULL", (primary_shard,))
+    return {'id': int(time.time() * 1000), 'started': time.time()}
+
+
+def reconcile_shard(run, s3_client, bucket, shard, skip_prefixes=()):
+    """Walk one bucket page by page and bring its objects' index rows in line with it.
+
+    Keys under `skip_prefixes` (files the backend generates itself) are not indexed.
+    A key listed here whose row names another shard is a stray copy (e.g. a move still
+    in progress) and leaves the row alone. Returns the number of objects seen.
+    """
+    conn = get_connection()
+    seen = 0
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, PaginationConfig={'PageSize': RECONCILE_PAGE_SIZE}):
+        rows = [
+            (
+                obj['Key'], obj['Size'], to_iso(obj['LastModified']), obj.get('ETag', '').strip('"') or None,
+                run['id'], run['started'], shard
+            )
+            for obj in page.get('Contents', [])
+            if not obj['Key'].startswith(tuple(skip_prefixes))
+        ]
+        if not rows:
+            continue
+        with transaction():
+            conn.executemany(
+                """
+                INSERT INTO objects (key, size, last_modified, etag, uploaded_at, download_count, seen_run, indexed_at,
+                                     shard)
+                SELECT new.key, new.size, new.last_modified, new.etag,
+                       (SELECT uploaded_at FROM upload_history WHERE key = new.key),
+                       COALESCE((SELECT count FROM download_counts WHERE key = new.key), 0),
+                       new.seen_run, new.indexed_at, new.shard
+                FROM (SELECT ? AS key, ? AS size, ? AS last_modified, ? AS etag,
+                             ? AS seen_run, ? AS indexed_at, ? AS shard) AS new
+                WHERE true  -- required by SQLite for an upsert fed by SELECT
+                ON CONFLICT(key) DO UPDATE SET
+                    -- Listings show a compressed object's stored size; its row keeps the file's own
+                    size = CASE WHEN objects.encoding IS NOT NULL
+                                     AND (objects.etag IS NULL OR objects.etag = excluded.etag)
+                                THEN objects.size ELSE excluded.size END,
+                    stored_size = CASE WHEN objects.encoding IS NOT NULL
+                                            AND (objects.etag IS NULL OR objects.etag = excluded.etag)
+                                       THEN excluded.size END,
+                    encoding = CASE WHEN objects.etag IS NULL OR objects.etag = excluded.etag
+                                    THEN objects.encoding END,
+                    last_modified = excluded.last_modified,
+                    etag = excluded.etag,
+                    sha256 = CASE WHEN objects.etag IS NULL OR objects.etag = excluded.etag
+                                  THEN objects.sha256 END,
+                    seen_run = excluded.seen_run
+                WHERE objects.shard = excluded.shard
+                """,
+                rows
+            )
+        seen += len(rows)
+    return seen
+
+
+def finish_reconcile(run, seen, on_removed=None):
+    """Drop rows none of the walks saw. `on_removed(keys)` is called with the keys dropped."""
+    conn = get_connection()
+    # Anything not seen during this walk (and not written since it began) is gone from R2.
+    # Aliases have no object of their own; they go when their target does (the bytes they
+    # shared went with it), unless this walk listed an object under the alias's own key.
+    stale = "seen_run != ? AND indexed_at < ? AND alias_of IS NULL"
+    orphaned = ("alias_of IS NOT NULL AND NOT EXISTS (SELECT 1 FROM objects AS target "
+                "WHERE target.key = objects.alias_of AND target.alias_of IS NULL)")
+    with transaction():
+        removed_keys = [row['key'] for row in conn.execute(
+            f"SELECT key FROM objects WHERE {stale}", (run['id'], run['started']))]
+        conn.execute(f"DELETE FROM objects WHERE {stale}", (run['id'], run['started']))
+        conn.execute(f"UPDATE objects SET alias_of = NULL WHERE {orphaned} AND seen_run = ?", (run['id'],))
+        cascaded = conn.execute(f"SELECT key, alias_of FROM objects WHERE {orphaned}").fetchall()
+        conn.execute(f"DELETE FROM objects WHERE {orphaned}")
+    if cascaded:
+        logger.warning(
+            f"{len(cascaded)} deduplicated files removed because the object they shared is gone from storage: "
+            + ', '.join(f"'{row['key']}' (alias of '{row['alias_of']}')" for row in cascaded[:20])
+            + (', ...' if len(cascaded) > 20 else '')
+        )
+    removed_keys += [row['key'] for row in cascaded]
+    removed = len(removed_keys)
+    if removed_keys and on_removed:
+        on_removed(removed_keys)
+    set_meta('last_reconcile', time.time())
+    recount_totals()
+    logger.info(f"Index reconciled: {seen} objects in storage, {removed} stale entries removed "
+                f"({time.time() - run['started']:.1f}s)")
+    return seen, removed
+
+
+def start_reconciler(run, interval):
+    """Run `run()` now and then every `interval` seconds in a daemon thread."""
+    def loop():
+        while True:
+            try:
+                run()
+            except Exception as e:
+                logger.error(f"Index reconcile failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='index-reconciler', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,283 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+Kept dependency-free: the backend runs as a single gunicorn worker (or a single
+uvicorn process), so one registry per process sees every request.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-2, 10))  # 256 KiB/s .. 512 MiB/s
+
+registry = []
+
+
+def label_key(names, labels):
+    return tuple(str(labels.get(name, '')) for name in names)
+
+
+def format_labels(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values)] + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.labels, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(self.labels, labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = label_key(self.labels, labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, {'counts': list(s['counts']), 'sum': s['sum'], 'count': s['count']})
+                           for key, s in self.values.items())
+        lines = self.header()
+        for key, state in items:
+            for bound, n in zip(self.buckets, state['counts']):
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', repr(float(bound)))])} {n}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', '+Inf')])} {state['count']}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {state['sum']}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {state['count']}")
+        return lines
+
+
+# Metrics
+http_request_duration = Histogram(
+    'http_request_duration_seconds', 'Request latency per route, until the last body byte is sent.',
+    ('method', 'route', 'status'))
+r2_call_duration = Histogram(
+    'r2_call_duration_seconds', 'R2 API call latency (for GetObject: until response headers).',
+    ('operation', 'outcome'))
+transfer_bytes = Counter(
+    'transfer_bytes_total', 'Bytes streamed between clients and the backend.', ('direction',))
+transfers_in_flight = Gauge(
+    'transfers_in_flight', 'Uploads and downloads currently streaming through the backend.', ('direction',))
+transfer_throughput = Histogram(
+    'transfer_throughput_bytes_per_second', 'Per-transfer throughput of completed uploads and downloads.',
+    ('direction',), buckets=THROUGHPUT_BUCKETS)
+helper_duration = Histogram(
+    'helper_duration_seconds', 'Time spent in backend helpers (stats, counter flushes, index sync).', ('helper',))
+slow_requests_profiled = Counter(
+    'slow_requests_profiled_total', 'Sampled requests slower than PROFILE_SLOW_REQUEST_MS that were profiled.',
+    ('route',))
+process_start_time = Gauge('process_start_time_seconds', 'Start time of the backend process.')
+process_start_time.set(time.time())
+
+collectors = []  # callables returning extra exposition lines, e.g. object cache stats
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    for collect in collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            logger.warning(f"Metrics collector failed: {e}")
+    return '\n'.join(lines) + '\n'
+
+
+# Instrumentation Helpers
+def timed(helper):
+    """Decorator: observe the wrapped function's duration in helper_duration_seconds."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                helper_duration.observe(time.perf_counter() - start, helper=helper)
+        return wrapper
+    return decorator
+
+
+def instrument_s3_client(client):
+    """Time every API call a boto3 (or aiobotocore) S3 client makes, by operation name."""
+    def before_call(model, context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    def after_call(model, context, http_response=None, **kwargs):
+        started = context.pop('metrics_started', None)
+        if started is not None:
+            status = getattr(http_response, 'status_code', 200)
+            outcome = 'ok' if status < 400 else 'error'
+            r2_call_duration.observe(time.perf_counter() - started, operation=model.name, outcome=outcome)
+
+    def after_call_error(model, context, **kwargs):
+        started = context.pop('metrics_started', None)
+        if started is not None:
+            r2_call_duration.observe(time.perf_counter() - started, operation=model.name, outcome='error')
+
+    events = client.meta.events
+    events.register('before-call.s3', before_call)
+    events.register('after-call.s3', after_call)
+    events.register('after-call-error.s3', after_call_error)
+    return client
+
+
+@contextmanager
+def transfer(direction, size):
+    """Track one transfer of `size` bytes: in-flight gauge, byte counter and throughput."""
+    transfers_in_flight.inc(direction=direction)
+    start = time.perf_counter()
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        transfers_in_flight.dec(direction=direction)
+        if completed:
+            transfer_bytes.inc(size, direction=direction)
+            elapsed = time.perf_counter() - start
+            if elapsed > 0 and size:
+                transfer_throughput.observe(size / elapsed, direction=direction)
+
+
+def metered_body(body, direction='download'):
+    """Wrap a response body iterator so the bytes it yields are counted as a transfer."""
+    transfers_in_flight.inc(direction=direction)
+    start = time.perf_counter()
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        transfers_in_flight.dec(direction=direction)
+        transfer_bytes.inc(sent, direction=direction)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0 and sent:
+            transfer_throughput.observe(sent / elapsed, direction=direction)
+
+
+async def metered_async_body(body, direction='download'):
+    transfers_in_flight.inc(direction=direction)
+    start = time.perf_counter()
+    sent = 0
+    try:
+        async for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        transfers_in_flight.dec(direction=direction)
+        transfer_bytes.inc(sent, direction=direction)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0 and sent:
+            transfer_throughput.observe(sent / elapsed, direction=direction)
+
+
+# Slow Request Profiling
+class RequestProfiler:
+    """Profile a random sample of requests and keep the ones slower than a threshold.
+
+    cProfile allows one active profiler per process, so at most one request is
+    profiled at a time; other sampled requests simply run unprofiled.
+    """
+
+    def __init__(self, sample_rate, slow_ms, directory):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_ms / 1000
+        self.directory = directory
+        self.busy = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def start(self):
+        """Return a running profiler for this request, or None if it is not sampled."""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        if not self.busy.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            self.busy.release()
+            return None
+        return profiler
+
+    def finish(self, profiler, route, elapsed):
+        try:
+            profiler.disable()
+        finally:
+            self.busy.release()
+        if elapsed < self.slow_seconds:
+            return
+        slow_requests_profiled.inc(route=route)
+        os.makedirs(self.directory, exist_ok=True)
+        safe_route = ''.join(c if c.isalnum() else '_' for c in route).strip('_') or 'root'
+        path = os.path.join(self.directory, f"{int(time.time() * 1000)}-{safe_route}.prof")
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(10)
+        logger.warning(f"Slow request {route} took {elapsed * 1000:.0f}ms, profile saved to {path}\n{summary.getvalue()}")
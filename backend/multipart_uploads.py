@@ -0,0 +1,189 @@
+import logging
+import math
+import secrets
+import threading
+import time
+
+import metadata_index
+import shards
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024   # S3/R2 minimum for every part but the last
+MAX_PARTS = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    id TEXT PRIMARY KEY,
+    upload_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    content_type TEXT,
+    size INTEGER NOT NULL,
+    part_size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    shard TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions (updated_at);
+"""
+
+
+class PartStream:
+    """Read-only view of exactly `length` bytes of a request body.
+
+    Deliberately has no seek/tell, so botocore streams it straight through
+    to R2 instead of buffering the part.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.stream.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+
+def init_sessions():
+    conn = metadata_index.get_connection()
+    conn.executescript(SCHEMA)
+    # Sessions from before sharding are on the primary shard (shards.get(None))
+    if 'shard' not in {row['name'] for row in conn.execute("PRAGMA table_info(upload_sessions)")}:
+        conn.execute("ALTER TABLE upload_sessions ADD COLUMN shard TEXT")
+
+
+def choose_part_size(size, preferred=8 * 1024 * 1024):
+    """Smallest whole-MiB part size >= preferred that keeps the upload under MAX_PARTS."""
+    mib = 1024 * 1024
+    needed = math.ceil(size / MAX_PARTS) if size else 0
+    return max(preferred, MIN_PART_SIZE, math.ceil(needed / mib) * mib)
+
+
+def is_single_put(session):
+    """Direct single-PUT sessions carry no multipart UploadId."""
+    return not session['upload_id']
+
+
+def part_count(size, part_size):
+    return max(1, math.ceil(size / part_size))
+
+
+def expected_part_length(session, part_number):
+    """Byte length the given part must have, or None if the part number is out of range."""
+    count = part_count(session['size'], session['part_size'])
+    if part_number < 1 or part_number > count:
+        return None
+    if part_number < count:
+        return session['part_size']
+    return session['size'] - session['part_size'] * (count - 1)
+
+
+# Session Records
+def create_session(upload_id, key, filename, content_type, size, part_size, shard=None):
+    session_id = secrets.token_urlsafe(18)
+    now = time.time()
+    metadata_index.get_connection().execute(
+        "INSERT INTO upload_sessions (id, upload_id, key, filename, content_type, size, part_size, created_at, "
+        "updated_at, shard) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (session_id, upload_id, key, filename, content_type, size, part_size, now, now, shard)
+    )
+    return session_id
+
+
+def get_session(session_id):
+    row = metadata_index.get_connection().execute(
+        "SELECT * FROM upload_sessions WHERE id = ?", (session_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def touch_session(session_id):
+    metadata_index.get_connection().execute(
+        "UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id)
+    )
+
+
+def delete_session(session_id):
+    metadata_index.get_connection().execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+
+
+def session_shard(session):
+    """Shard the session's object is being written to."""
+    return shards.get(session['shard'])
+
+
+def list_uploaded_parts(session):
+    """Parts R2 already holds for this session, as [{PartNumber, ETag, Size}]."""
+    shard = session_shard(session)
+    parts = []
+    paginator = shard.client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=shard.bucket, Key=session['key'], UploadId=session['upload_id']):
+        for part in page.get('Parts', []):
+            parts.append({'PartNumber': part['PartNumber'], 'ETag': part['ETag'], 'Size': part['Size']})
+    return parts
+
+
+# Janitor
+def abort_stale_uploads(max_age):
+    """Abort sessions idle for longer than max_age, plus orphaned R2 multipart uploads on every shard."""
+    cutoff = time.time() - max_age
+    conn = metadata_index.get_connection()
+    aborted = 0
+
+    for row in conn.execute("SELECT * FROM upload_sessions WHERE updated_at < ?", (cutoff,)).fetchall():
+        if is_single_put(row):
+            delete_session(row['id'])
+            metadata_index.release_key(row['key'])
+            continue
+        shard = session_shard(row)
+        try:
+            shard.client.abort_multipart_upload(Bucket=shard.bucket, Key=row['key'], UploadId=row['upload_id'])
+        except Exception as e:
+            logger.warning(f"Abort of stale upload {row['id']} failed: {e}")
+        delete_session(row['id'])
+        metadata_index.release_key(row['key'])
+        aborted += 1
+
+    # Multipart uploads R2 still holds that no session knows about (e.g. lost DB, crashed worker)
+    known = {row['upload_id'] for row in conn.execute("SELECT upload_id FROM upload_sessions")}
+
+    def abort_orphans(shard):
+        count = 0
+        paginator = shard.client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=shard.bucket):
+            for upload in page.get('Uploads', []):
+                if upload['UploadId'] in known or upload['Initiated'].timestamp() >= cutoff:
+                    continue
+                try:
+                    shard.client.abort_multipart_upload(
+                        Bucket=shard.bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+                    count += 1
+                except Exception as e:
+                    logger.warning(f"Abort of orphaned upload {upload['UploadId']} failed: {e}")
+        return count
+
+    aborted += sum(shards.fan_out(abort_orphans).values())
+    metadata_index.prune_reservations(max_age)
+    if aborted:
+        logger.info(f"Upload janitor aborted {aborted} stale multipart uploads")
+    return aborted
+
+
+def start_janitor(interval, max_age):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                abort_stale_uploads(max_age)
+            except Exception as e:
+                logger.error(f"Upload janitor failed: {e}")
+
+    thread = threading.Thread(target=loop, name='upload-janitor', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,340 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import metadata_index
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+WAIT_TIMEOUT = 30  # seconds a reader waits for the fill to make progress
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS object_cache (
+    key TEXT PRIMARY KEY,
+    etag TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_type TEXT,
+    last_modified TEXT,
+    hits INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_object_cache_access ON object_cache (last_access);
+"""
+
+settings = {'directory': None, 'max_bytes': 0, 'max_object_bytes': 0}
+
+# In-flight fills by key; every concurrent miss on a key tails the same fill
+fills = {}
+fills_lock = threading.Lock()
+
+stats_lock = threading.Lock()
+counters = {'hits': 0, 'misses': 0, 'coalesced': 0, 'bytes_saved': 0, 'fills': 0, 'fill_errors': 0, 'evictions': 0}
+
+
+def count(name, n=1):
+    with stats_lock:
+        counters[name] += n
+
+
+class Fill:
+    """One R2 download being written to the cache; readers follow `written` as it grows."""
+
+    def __init__(self, key, etag, head, path):
+        self.key = key
+        self.etag = etag
+        self.head = head
+        self.size = head['ContentLength']
+        self.path = path
+        self.tmp_path = f"{path}.{threading.get_ident()}.{time.monotonic_ns()}.part"
+        self.cond = threading.Condition()
+        self.written = 0
+        self.finished = False
+        self.failed = False
+
+    def run(self, fetch):
+        try:
+            with open(self.tmp_path, 'wb') as f:
+                for chunk in fetch():
+                    f.write(chunk)
+                    f.flush()
+                    with self.cond:
+                        self.written += len(chunk)
+                        self.cond.notify_all()
+            if self.written != self.size:
+                raise IOError(f"expected {self.size} bytes, got {self.written}")
+            with self.cond:
+                # Readers open tmp_path or path under this lock, so the rename never races an open
+                os.replace(self.tmp_path, self.path)
+                self.finished = True
+                self.cond.notify_all()
+            store_entry(self)
+            count('fills')
+        except Exception as e:
+            logger.warning(f"Object cache fill for {self.key} failed: {e}")
+            count('fill_errors')
+            with self.cond:
+                self.failed = True
+                self.finished = True
+                self.cond.notify_all()
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+        finally:
+            with fills_lock:
+                if fills.get(self.key) is self:
+                    del fills[self.key]
+
+    def open(self):
+        with self.cond:
+            if self.failed:
+                return None
+            return open(self.path if self.finished else self.tmp_path, 'rb')
+
+    def wait_for(self, position):
+        """Block until byte `position` is on disk. Returns bytes available, or None if the fill failed."""
+        with self.cond:
+            while self.written <= position and not self.finished:
+                if not self.cond.wait(WAIT_TIMEOUT):
+                    return None
+            if self.failed:
+                return None
+            return self.written
+
+
+# Setup
+def init_cache(directory, max_bytes, max_object_bytes):
+    """Create the cache directory and table, dropping partial files and rows without a file."""
+    settings.update(directory=directory, max_bytes=max_bytes, max_object_bytes=max_object_bytes)
+    os.makedirs(directory, exist_ok=True)
+    conn = metadata_index.get_connection()
+    conn.executescript(SCHEMA)
+
+    known = {}
+    for row in conn.execute("SELECT key FROM object_cache").fetchall():
+        known[entry_path(row['key'])] = row['key']
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path not in known:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    for path, key in known.items():
+        if not os.path.exists(path):
+            conn.execute("DELETE FROM object_cache WHERE key = ?", (key,))
+
+
+def entry_path(key):
+    return os.path.join(settings['directory'], hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def cacheable(size):
+    return 0 < size <= min(settings['max_object_bytes'], settings['max_bytes'])
+
+
+# Entries
+def get_entry(key):
+    row = metadata_index.get_connection().execute(
+        "SELECT * FROM object_cache WHERE key = ?", (key,)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def entry_head(entry):
+    """head_object-shaped metadata for a cached entry, for app.plan_download."""
+    return {
+        'ContentLength': entry['size'],
+        'ContentType': entry['content_type'] or 'application/octet-stream',
+        'ETag': f'"{entry["etag"]}"',
+        'LastModified': datetime.fromisoformat(entry['last_modified']) if entry['last_modified'] else None,
+    }
+
+
+def store_entry(fill):
+    head = fill.head
+    metadata_index.get_connection().execute(
+        """
+        INSERT INTO object_cache (key, etag, size, content_type, last_modified, hits, last_access)
+        VALUES (?, ?, ?, ?, ?, 0, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            etag = excluded.etag, size = excluded.size, content_type = excluded.content_type,
+            last_modified = excluded.last_modified, hits = 0, last_access = excluded.last_access
+        """,
+        (fill.key, fill.etag, fill.size, head.get('ContentType'),
+         metadata_index.to_iso(head.get('LastModified')), time.time())
+    )
+
+
+def touch_entry(key):
+    metadata_index.get_connection().execute(
+        "UPDATE object_cache SET hits = hits + 1, last_access = ? WHERE key = ?", (time.time(), key)
+    )
+
+
+def drop_entry(key):
+    metadata_index.get_connection().execute("DELETE FROM object_cache WHERE key = ?", (key,))
+    try:
+        os.remove(entry_path(key))
+    except OSError:
+        pass
+
+
+def make_room(size):
+    """Evict until `size` more bytes fit next to the cache and in-flight fills. False if they never will.
+
+    Least recently used goes first, but entries that were only ever read once are
+    evicted before anything read twice, so a burst of one-off downloads cannot flush
+    the genuinely hot files.
+    """
+    conn = metadata_index.get_connection()
+    with fills_lock:
+        reserved = sum(fill.size for fill in fills.values())
+    used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM object_cache").fetchone()[0]
+    excess = used + reserved + size - settings['max_bytes']
+    if excess <= 0:
+        return True
+
+    victims = []
+    for row in conn.execute("SELECT key, size FROM object_cache ORDER BY hits > 0, last_access"):
+        victims.append(row['key'])
+        excess -= row['size']
+        if excess <= 0:
+            break
+    if excess > 0:
+        return False
+    for key in victims:
+        drop_entry(key)
+    count('evictions', len(victims))
+    return True
+
+
+# Reads
+def read_file(f, start, end):
+    try:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def tail_fill(fill, f, start, end, fallback):
+    """Follow a fill as it is written; if it fails, fetch what is still missing from `fallback`."""
+    try:
+        position = start
+        while position <= end:
+            available = fill.wait_for(position)
+            if available is None or available <= position:
+                yield from fallback(position, end)
+                return
+            f.seek(position)
+            chunk = f.read(min(CHUNK_SIZE, available - position, end + 1 - position))
+            if not chunk:
+                yield from fallback(position, end)
+                return
+            position += len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def lookup(key, etag):
+    """Cached entry for this exact version of key, or None."""
+    entry = get_entry(key)
+    if entry and entry['etag'] == etag:
+        return entry
+    return None
+
+
+def read(key, head, start, end, fetch, fallback):
+    """Bytes start..end (inclusive) of an object from the cache, filling it on a miss.
+
+    `head` is the current head_object (or entry_head) result. `fetch()` yields the whole
+    object from R2, `fallback(start, end)` yields a range from R2. Returns an iterator,
+    or None when the caller should go to R2 itself.
+    """
+    etag = head.get('ETag', '').strip('"')
+    size = head['ContentLength']
+    if not etag or not cacheable(size):
+        return None
+
+    entry = lookup(key, etag)
+    if entry:
+        try:
+            f = open(entry_path(key), 'rb')
+        except OSError:
+            f = None  # evicted between lookup and open
+            drop_entry(key)
+        if f:
+            touch_entry(key)
+            count('hits')
+            count('bytes_saved', end - start + 1)
+            return read_file(f, start, end)
+
+    with fills_lock:
+        fill = fills.get(key)
+    if fill is None or fill.etag != etag:
+        count('misses')
+        fill = start_fill(key, etag, head, fetch)
+        # Seeking into an object we have not reached yet: serve it from R2 while the fill runs
+        if fill is None or start > 0:
+            return None
+    else:
+        count('coalesced')
+        count('bytes_saved', end - start + 1)
+
+    f = fill.open()
+    if f is None:
+        return None
+    return tail_fill(fill, f, start, end, fallback)
+
+
+def start_fill(key, etag, head, fetch):
+    if not make_room(head['ContentLength']):
+        return None
+    with fills_lock:
+        current = fills.get(key)
+        if current is not None:
+            return current if current.etag == etag else None
+        fill = Fill(key, etag, head, entry_path(key))
+        # Create the file before anyone can look the fill up and try to open it
+        open(fill.tmp_path, 'wb').close()
+        fills[key] = fill
+    threading.Thread(target=fill.run, args=(fetch,), name='object-cache-fill', daemon=True).start()
+    return fill
+
+
+def stats():
+    conn = metadata_index.get_connection()
+    row = conn.execute("SELECT COUNT(*) AS entries, COALESCE(SUM(size), 0) AS bytes FROM object_cache").fetchone()
+    with stats_lock:
+        result = dict(counters)
+    requests = result['hits'] + result['coalesced'] + result['misses']
+    result['hit_rate'] = round((result['hits'] + result['coalesced']) / requests, 4) if requests else 0.0
+    result['entries'] = row['entries']
+    result['bytes'] = row['bytes']
+    result['max_bytes'] = settings['max_bytes']
+    with fills_lock:
+        result['fills_in_flight'] = len(fills)
+    return result
+
+
+def metric_lines():
+    """Cache counters in the Prometheus exposition format, for metrics.collectors."""
+    current = stats()
+    lines = []
+    for name in ('hits', 'misses', 'coalesced', 'bytes_saved', 'fills', 'fill_errors', 'evictions'):
+        lines += [f"# TYPE object_cache_{name}_total counter", f"object_cache_{name}_total {current[name]}"]
+    for name in ('entries', 'bytes', 'max_bytes', 'fills_in_flight'):
+        lines += [f"# TYPE object_cache_{name} gauge", f"object_cache_{name} {current[name]}"]
+    return lines
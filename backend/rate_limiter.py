@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import metadata_index
+
+logger = logging.getLogger(__name__)
+
+# Token buckets in SQLite, so every worker (and the ASGI server) shares one view.
+# A bucket that has refilled completely is equivalent to no row at all, which is
+# what lets idle clients be evicted without changing anyone's limit.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    scope TEXT NOT NULL,
+    client TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (scope, client)
+);
+CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits (updated_at);
+"""
+
+MAX_ENTRIES = 50000    # hard cap on tracked clients across all scopes
+PRUNE_EVERY = 500      # consume() calls between evictions
+
+# capacity: burst size; refill_per_second: sustained rate
+Limit = namedtuple('Limit', ['scope', 'capacity', 'refill_per_second'])
+
+limits = {}  # scope -> Limit, so prune() can tell which buckets have refilled
+calls = {'since_prune': 0}
+calls_lock = threading.Lock()
+
+
+def per_window(scope, count, window_seconds):
+    """`count` requests per `window_seconds`, bursting up to `count` at once."""
+    limit = Limit(scope, count, count / window_seconds)
+    limits[scope] = limit
+    return limit
+
+
+def init_limiter():
+    metadata_index.get_connection().executescript(SCHEMA)
+    prune()
+
+
+def client_ip_from(headers, remote_addr):
+    """Client address: nginx's X-Real-IP, else the first (client) hop of X-Forwarded-For."""
+    real_ip = headers.get('X-Real-IP', '').strip()
+    if real_ip:
+        return real_ip
+    forwarded = headers.get('X-Forwarded-For', '')
+    first_hop = forwarded.split(',', 1)[0].strip()
+    return first_hop or remote_addr or 'unknown'
+
+
+def consume(limit, client, cost=1):
+    """Take `cost` tokens from the client's bucket. Returns (allowed, retry_after_seconds)."""
+    now = time.time()
+    with metadata_index.transaction() as conn:
+        row = conn.execute(
+            "SELECT tokens, updated_at FROM rate_limits WHERE scope = ? AND client = ?", (limit.scope, client)
+        ).fetchone()
+        tokens = limit.capacity
+        if row:
+            tokens = min(limit.capacity, row['tokens'] + (now - row['updated_at']) * limit.refill_per_second)
+
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        conn.execute(
+            "INSERT INTO rate_limits (scope, client, tokens, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(scope, client) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+            (limit.scope, client, tokens, now)
+        )
+
+    with calls_lock:
+        calls['since_prune'] += 1
+        due = calls['since_prune'] >= PRUNE_EVERY
+        if due:
+            calls['since_prune'] = 0
+    if due:
+        prune()
+    if allowed:
+        return True, 0
+    return False, max(1, int((cost - tokens) / limit.refill_per_second + 0.999))
+
+
+def reset(limit, client):
+    metadata_index.get_connection().execute(
+        "DELETE FROM rate_limits WHERE scope = ? AND client = ?", (limit.scope, client)
+    )
+
+
+def prune(idle_seconds=3600):
+    """Drop buckets that have refilled completely (and idle ones of scopes no longer configured).
+
+    Only if that leaves more than MAX_ENTRIES are partly drained buckets evicted, oldest first:
+    a flood of new clients must not be a way to reset the limits of others.
+    """
+    now = time.time()
+    try:
+        with metadata_index.transaction() as conn:
+            for limit in limits.values():
+                conn.execute(
+                    "DELETE FROM rate_limits WHERE scope = ? AND tokens + (? - updated_at) * ? >= ?",
+                    (limit.scope, now, limit.refill_per_second, limit.capacity)
+                )
+            conn.execute(
+                f"DELETE FROM rate_limits WHERE updated_at < ? AND scope NOT IN ({','.join('?' * len(limits))})",
+                (now - idle_seconds, *limits)
+            )
+            evicted = conn.execute(
+                "DELETE FROM rate_limits WHERE rowid IN ("
+                "SELECT rowid FROM rate_limits ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (MAX_ENTRIES,)
+            ).rowcount
+        if evicted > 0:
+            logger.warning(f"Rate limits: {evicted} partly used buckets evicted to stay under {MAX_ENTRIES} clients")
+    except Exception as e:
+        logger.warning(f"Rate limit pruning failed: {e}")
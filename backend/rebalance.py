@@ -0,0 +1,166 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+
+import metadata_index
+import shards
+import thumbnails
+
+load_dotenv()
+
+# Moving an object never takes it offline: it is copied to its ring shard first, then its
+# index row is switched over (only if the object did not change meanwhile), and the old
+# copy is deleted once reads that located it before the switch have had time to finish.
+DEFAULT_GRACE = 900  # seconds; covers presigned download URLs (DIRECT_URL_EXPIRES)
+
+
+def copy_object(key, source, target):
+    """Copy key between shards: server-side within one account, streamed otherwise. Returns the copy's head.
+
+    Content type, stored encoding and metadata (see compression.py) are carried over explicitly:
+    multipart copies would otherwise drop them.
+    """
+    same_account = source.account == target.account
+    read = source.client.head_object if same_account else source.client.get_object
+    obj = read(Bucket=source.bucket, Key=key)
+    extra = {'ContentType': obj.get('ContentType') or 'application/octet-stream', 'Metadata': obj.get('Metadata') or {}}
+    if obj.get('ContentEncoding'):
+        extra['ContentEncoding'] = obj['ContentEncoding']
+    if same_account:
+        target.client.copy(
+            {'Bucket': source.bucket, 'Key': key}, target.bucket, key, ExtraArgs={**extra, 'MetadataDirective': 'REPLACE'}
+        )
+    else:
+        target.client.upload_fileobj(obj['Body'], target.bucket, key, ExtraArgs=extra)
+    return target.client.head_object(Bucket=target.bucket, Key=key)
+
+
+def move(key, stored_shard, target_name):
+    """Copy one object to its ring shard and switch its row over. Returns the source Shard to clean up, or None."""
+    row = metadata_index.get_object(key)
+    if row is None or row['shard'] != stored_shard or row['alias_of'] is not None:
+        return None  # deleted or moved since it was listed
+    source, target = shards.get(stored_shard), shards.get(target_name)
+    head = copy_object(key, source, target)
+    expected = row['stored_size'] if row['encoding'] else row['size']
+    if head['ContentLength'] != expected:
+        target.client.delete_object(Bucket=target.bucket, Key=key)
+        raise RuntimeError(f"size mismatch after copy ({head['ContentLength']} != {expected})")
+
+    target_etag = head.get('ETag', '').strip('"') or None
+    if not metadata_index.move_object(key, stored_shard, target.name, row['etag'], target_etag):
+        # Deleted or replaced while copying: the copy is the stray one
+        target.client.delete_object(Bucket=target.bucket, Key=key)
+        return None
+    return source
+
+
+def delete_copies(copies):
+    """Delete old copies, [(key, source Shard)], batched per shard. Returns the number of failures."""
+    failed = 0
+    for shard in {source.name: source for _, source in copies}.values():
+        keys = [key for key, source in copies if source.name == shard.name]
+        for start in range(0, len(keys), 1000):
+            response = shard.client.delete_objects(
+                Bucket=shard.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+            )
+            for error in response.get('Errors', []):
+                failed += 1
+                print(f"  - Failed delete {error['Key']} on {shard.name}: {error.get('Message', error.get('Code'))}")
+    return failed
+
+
+def stray_copies(shard):
+    """Objects in shard's bucket whose index row says they live on another shard (e.g. an interrupted run)."""
+    strays = []
+    paginator = shard.client.get_paginator('list_objects_v2')
+    conn = metadata_index.get_connection()
+    for page in paginator.paginate(Bucket=shard.bucket, PaginationConfig={'PageSize': 1000}):
+        for obj in page.get('Contents', []):
+            if obj['Key'].startswith(thumbnails.RESERVED_PREFIX):
+                continue
+            row = conn.execute("SELECT shard FROM objects WHERE key = ?", (obj['Key'],)).fetchone()
+            if row is not None and shards.get(row['shard']).name != shard.name:
+                strays.append((obj['Key'], shard))
+    return strays
+
+
+def rebalance(workers=8, dry_run=False, grace=DEFAULT_GRACE):
+    """Move every object the ring places elsewhere. True if nothing failed."""
+    moves = list(shards.misplaced())
+    if not moves:
+        print("Every object is already on its shard.")
+        return True
+    counts = {}
+    for _, stored_shard, target in moves:
+        route = f"{shards.get(stored_shard).name} -> {target}"
+        counts[route] = counts.get(route, 0) + 1
+    for route, count in sorted(counts.items()):
+        print(f"  {route}: {count} objects")
+    if dry_run:
+        print(f"Would move {len(moves)} objects.")
+        return True
+
+    moved, failed, started = [], 0, time.time()
+
+    def run(move_args):
+        try:
+            return move_args[0], move(*move_args), None
+        except (ClientError, RuntimeError) as e:
+            return move_args[0], None, e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for number, (key, source, error) in enumerate(executor.map(run, moves), 1):
+            if error is not None:
+                failed += 1
+                print(f"  - Failed move {key}: {error}")
+            elif source is not None:
+                moved.append((key, source))
+            if number % 100 == 0:
+                print(f"Moved {len(moved)}/{len(moves)} objects ({number / (time.time() - started):.0f} objects/sec)")
+    print(f"Moved {len(moved)} objects, {failed} failed.")
+
+    if moved:
+        print(f"Waiting {grace}s for downloads of the old copies to finish...")
+        time.sleep(grace)
+        failed += delete_copies(moved)
+        print(f"Deleted {len(moved)} old copies.")
+    return not failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Move objects to the shard the ring assigns them (after changing R2_SHARDS)")
+    parser.add_argument('--workers', type=int, default=8, help="concurrent object moves (default 8)")
+    parser.add_argument('--grace', type=int, default=DEFAULT_GRACE,
+                        help=f"seconds to keep old copies readable after the switch (default {DEFAULT_GRACE})")
+    parser.add_argument('--sweep', action='store_true', help="only delete copies left behind by an interrupted run")
+    parser.add_argument('--dry-run', action='store_true', help="count what would be moved")
+    parser.add_argument('--yes', action='store_true', help="skip the confirmation prompt")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    metadata_index.init_index()
+    shards.init_shards(shards.configs_from_env(), lambda config: shards.create_client(config, max(10, args.workers * 2)))
+    print(f"Shards: {', '.join(f'{shard.name} ({shard.bucket})' for shard in shards.shards.values())}")
+
+    if args.sweep:
+        strays = [copy for found in shards.fan_out(stray_copies).values() for copy in found]
+        print(f"Found {len(strays)} stray copies.")
+        if strays and not args.dry_run:
+            confirm = 'yes' if args.yes else input("Delete them? (yes/no): ")
+            if confirm.lower() == 'yes':
+                failed = delete_copies(strays)
+                print(f"Deleted {len(strays) - failed} stray copies.")
+    else:
+        confirm = 'yes' if args.yes or args.dry_run else input("Move misplaced objects now? (yes/no): ")
+        if confirm.lower() == 'yes':
+            if not rebalance(max(1, args.workers), args.dry_run, max(0, args.grace)):
+                print("Some objects failed. Run again to retry them.")
+        else:
+            print("Cancelled.")
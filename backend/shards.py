@@ -0,0 +1,161 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+import metadata_index
+
+logger = logging.getLogger(__name__)
+
+# Storage routing: keys are spread over one or more buckets (in one or more accounts)
+# by consistent hashing, so adding a shard moves only ~1/n of the keys. Where an
+# object actually lives is recorded in the index (objects.shard) and reads always
+# follow that record; the ring only decides where new objects go. Until an object's
+# row names a shard it is on the primary shard (the first configured, which holds
+# everything uploaded before sharding was turned on).
+#
+# One shard, one client: each has its own connection pool and its own request-rate budget.
+Shard = namedtuple('Shard', ['name', 'bucket', 'client', 'account', 'public_url'])
+
+VNODES = 128  # ring points per unit of weight
+
+shards = {}   # name -> Shard
+ring = []     # sorted (point, shard name)
+points = []   # ring points alone, for bisect
+state = {'primary': None}
+
+
+def configs_from_env():
+    """Shard definitions from R2_SHARDS, filled in from the single-bucket R2_* settings.
+
+    R2_SHARDS is a JSON list such as
+        [{"name": "main", "bucket": "files"},
+         {"name": "b2", "bucket": "files-2", "account_id": "...", "access_key_id": "...",
+          "secret_access_key": "...", "public_url": "https://files-2.example.com", "weight": 2}]
+    Unset, there is one shard: R2_BUCKET_NAME.
+    """
+    account_id = os.getenv("R2_ACCOUNT_ID")
+    defaults = {
+        'bucket': os.getenv("R2_BUCKET_NAME"),
+        'endpoint_url': os.getenv("R2_ENDPOINT_URL") or f"https://{account_id}.r2.cloudflarestorage.com",
+        'access_key_id': os.getenv("R2_ACCESS_KEY_ID"),
+        'secret_access_key': os.getenv("R2_SECRET_ACCESS_KEY"),
+        'public_url': os.getenv("R2_PUBLIC_URL"),
+        'weight': 1,
+    }
+    entries = json.loads(os.getenv("R2_SHARDS") or '[{"name": "primary"}]')
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("R2_SHARDS must be a non-empty JSON list")
+
+    configs = []
+    for entry in entries:
+        config = {**defaults, **entry}
+        if 'account_id' in entry and 'endpoint_url' not in entry:
+            config['endpoint_url'] = f"https://{entry['account_id']}.r2.cloudflarestorage.com"
+        if not config.get('name') or not config.get('bucket'):
+            raise ValueError(f"R2_SHARDS entry needs a name and a bucket: {entry.get('name')!r}")
+        if any(c['name'] == config['name'] for c in configs):
+            raise ValueError(f"Duplicate shard name in R2_SHARDS: {config['name']!r}")
+        configs.append(config)
+    return configs
+
+
+def create_client(config, pool_size):
+    return boto3.client(
+        's3',
+        endpoint_url=config['endpoint_url'],
+        aws_access_key_id=config['access_key_id'],
+        aws_secret_access_key=config['secret_access_key'],
+        region_name='auto',
+        config=Config(max_pool_connections=pool_size)
+    )
+
+
+def account_of(config):
+    """Shards with the same account can copy objects between them server-side."""
+    return f"{config['endpoint_url']}|{config['access_key_id']}"
+
+
+def init_shards(configs, make_client):
+    """Build the ring and one client per shard (make_client(config) -> client)."""
+    shards.clear()
+    ring.clear()
+    for config in configs:
+        shards[config['name']] = Shard(
+            config['name'], config['bucket'], make_client(config), account_of(config),
+            (config.get('public_url') or '').rstrip('/')
+        )
+        for replica in range(VNODES * max(1, int(config.get('weight', 1)))):
+            ring.append((ring_point(f"{config['name']}#{replica}"), config['name']))
+    ring.sort()
+    points[:] = [point for point, _ in ring]
+    state['primary'] = configs[0]['name']
+    if len(shards) > 1:
+        logger.info(f"Storage sharded across {len(shards)} buckets: "
+                    + ', '.join(f"{shard.name} ({shard.bucket})" for shard in shards.values()))
+
+
+def ring_point(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+# Routing
+def ring_shard(key):
+    """Name of the shard the ring assigns key to."""
+    index = bisect.bisect(points, ring_point(key)) % len(points)
+    return ring[index][1]
+
+
+def primary():
+    return shards[state['primary']]
+
+
+def get(name):
+    """Shard by name; rows without one (or naming a shard no longer configured) mean the primary."""
+    return shards.get(name) or primary()
+
+
+def place(key):
+    """Shard a new object under key is written to."""
+    return shards[ring_shard(key)]
+
+
+def locate(key):
+    """Shard holding the R2 object `key` (resolve aliases with metadata_index.storage_key first)."""
+    if len(shards) == 1:
+        return primary()
+    row = metadata_index.get_connection().execute("SELECT shard FROM objects WHERE key = ?", (key,)).fetchone()
+    return place(key) if row is None else get(row['shard'])
+
+
+def fan_out(fn, targets=None):
+    """fn(shard) on every shard at once; returns {shard name: result}. The first error is raised."""
+    targets = list(targets or shards.values())
+    if len(targets) == 1:
+        return {targets[0].name: fn(targets[0])}
+    with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix='shard') as pool:
+        futures = {shard.name: pool.submit(fn, shard) for shard in targets}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def misplaced(batch_size=1000):
+    """(key, shard as stored in its row, ring shard) of every stored object the ring now places elsewhere."""
+    after = ''
+    while True:
+        rows = metadata_index.get_connection().execute(
+            "SELECT key, shard FROM objects WHERE alias_of IS NULL AND key > ? ORDER BY key LIMIT ?",
+            (after, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            target = ring_shard(row['key'])
+            if get(row['shard']).name != target:
+                yield row['key'], row['shard'], target
+        after = rows[-1]['key']
@@ -0,0 +1,287 @@
+import io
+import logging
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+import change_feed
+import metadata_index
+import shards
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails stay disabled without Pillow
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Generated files live under this prefix in the bucket given to the workers (the primary
+# shard when storage is sharded); the index reconciler skips it
+RESERVED_PREFIX = '.thumbnails/'
+IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp', 'bmp', 'tif', 'tiff'}
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'm4v', 'webm', 'mkv', 'avi'}
+WORKING_TIMEOUT = 600   # a 'working' job older than this was abandoned by a dead worker
+POLL_INTERVAL = 5
+FFMPEG_TIMEOUT = 60
+
+# One row per source object; doubles as the work queue (status 'pending')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS thumbnails (
+    key TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    source_etag TEXT,
+    thumb_key TEXT,
+    width INTEGER,
+    height INTEGER,
+    size INTEGER,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_thumbnails_status ON thumbnails (status, updated_at);
+"""
+
+settings = {'enabled': False, 'size': 320, 'quality': 80, 'max_source_bytes': 50 * 1024 * 1024}
+wakeup = threading.Event()
+
+
+def init_thumbnails(size, max_source_bytes):
+    if Image is None:
+        logger.warning("Thumbnails disabled: Pillow is not installed")
+        return False
+    metadata_index.get_connection().executescript(SCHEMA)
+    settings.update(enabled=True, size=size, max_source_bytes=max_source_bytes)
+    if not shutil.which('ffmpeg'):
+        logger.info("ffmpeg not found: video files will not get poster frames")
+    return True
+
+
+def media_kind(key):
+    ext = key.rsplit('.', 1)[-1].lower() if '.' in key else ''
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in VIDEO_EXTENSIONS and shutil.which('ffmpeg'):
+        return 'video'
+    return None
+
+
+def thumb_key_for(key):
+    return f"{RESERVED_PREFIX}{key}.webp"
+
+
+# Queue
+def enqueue(key, etag=None, force=False):
+    """Queue a media object for (re)generation. Returns True if a job was queued.
+
+    An existing thumbnail is only redone when it failed, the source ETag changed, or `force`.
+    """
+    if not settings['enabled'] or not media_kind(key) or key.startswith(RESERVED_PREFIX):
+        return False
+    queued = metadata_index.get_connection().execute(
+        "INSERT INTO thumbnails (key, status, source_etag, updated_at) VALUES (?, 'pending', ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET status = 'pending', source_etag = excluded.source_etag, "
+        "attempts = 0, updated_at = excluded.updated_at "
+        "WHERE ? OR thumbnails.status = 'failed' OR (excluded.source_etag IS NOT NULL "
+        "AND thumbnails.source_etag IS NOT excluded.source_etag)",
+        (key, etag, time.time(), force)
+    ).rowcount
+    if queued:
+        wakeup.set()
+    return bool(queued)
+
+
+def backfill():
+    """Queue every indexed media object that has no thumbnail for its current ETag."""
+    if not settings['enabled']:
+        return 0
+    conn = metadata_index.get_connection()
+    rows = conn.execute(
+        "SELECT o.key, o.etag FROM objects o LEFT JOIN thumbnails t ON t.key = o.key "
+        "WHERE t.key IS NULL OR t.status = 'failed' "
+        "OR (t.status = 'ready' AND o.etag IS NOT NULL AND t.source_etag IS NOT o.etag)"
+    ).fetchall()
+    queued = sum(enqueue(row['key'], row['etag']) for row in rows)
+    logger.info(f"Thumbnail backfill queued {queued} objects")
+    return queued
+
+
+def claim():
+    """Take the oldest pending job (or one abandoned mid-way), atomically across workers."""
+    now = time.time()
+    with metadata_index.transaction() as conn:
+        row = conn.execute(
+            "SELECT key FROM thumbnails WHERE (status = 'pending' AND updated_at <= ?) "
+            "OR (status = 'working' AND updated_at < ?) ORDER BY updated_at LIMIT 1",
+            (now, now - WORKING_TIMEOUT)
+        ).fetchone()
+        if not row:
+            return None
+        conn.execute(
+            "UPDATE thumbnails SET status = 'working', attempts = attempts + 1, updated_at = ? WHERE key = ?",
+            (now, row['key'])
+        )
+    return row['key']
+
+
+def finish(key, **fields):
+    fields.setdefault('updated_at', time.time())
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    metadata_index.get_connection().execute(
+        f"UPDATE thumbnails SET {assignments} WHERE key = ?", (*fields.values(), key)
+    )
+
+
+def get(key):
+    row = metadata_index.get_connection().execute("SELECT * FROM thumbnails WHERE key = ?", (key,)).fetchone()
+    return dict(row) if row else None
+
+
+def ready_version(key):
+    """Cache-busting version of a finished thumbnail, or None."""
+    if not settings['enabled'] or not media_kind(key):
+        return None
+    row = metadata_index.get_connection().execute(
+        "SELECT source_etag, updated_at FROM thumbnails WHERE key = ? AND status = 'ready'", (key,)
+    ).fetchone()
+    if not row:
+        return None
+    return row['source_etag'] or str(int(row['updated_at']))
+
+
+def thumbnail_url(key, version):
+    return f"/api/thumbnails/{quote(key)}?v={quote(version)}"
+
+
+# Rendering
+def render_image(source):
+    with Image.open(source) as image:
+        # JPEG can decode at 1/2, 1/4 or 1/8 scale, far cheaper than a full decode
+        image.draft('RGB', (settings['size'], settings['size']))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((settings['size'], settings['size']))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=settings['quality'], method=4)
+        return out.getvalue(), image.size
+
+
+def video_frame(url):
+    """Poster frame as PNG bytes. ffmpeg reads the object over HTTP ranges, so only the
+    container index and the frames around the seek point are downloaded."""
+    for offset in ('1', '0'):  # very short clips have nothing at 1s
+        result = subprocess.run(
+            ['ffmpeg', '-v', 'error', '-ss', offset, '-i', url, '-frames:v', '1',
+             '-vf', f"scale='min({settings['size'] * 2},iw)':-2", '-f', 'image2pipe', '-vcodec', 'png', '-'],
+            capture_output=True, timeout=FFMPEG_TIMEOUT
+        )
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    raise RuntimeError(f"ffmpeg could not extract a frame: {result.stderr.decode(errors='replace')[-300:]}")
+
+
+def generate(s3_client, bucket, key):
+    """Render key's thumbnail from whichever shard holds it, and store it in `bucket`."""
+    kind = media_kind(key)
+    source_key = metadata_index.storage_key(key)  # deduplicated uploads share another key's bytes
+    source = shards.locate(source_key)
+    head = source.client.head_object(Bucket=source.bucket, Key=source_key)
+    etag = head.get('ETag', '').strip('"') or None
+    if head['ContentLength'] > settings['max_source_bytes'] and kind == 'image':
+        finish(key, status='skipped', source_etag=etag, error='source too large')
+        return
+
+    if kind == 'image':
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as spool:
+            body = source.client.get_object(Bucket=source.bucket, Key=source_key)['Body']
+            shutil.copyfileobj(body, spool, 1024 * 1024)
+            spool.seek(0)
+            data, (width, height) = render_image(spool)
+    else:
+        url = source.client.generate_presigned_url(
+            'get_object', Params={'Bucket': source.bucket, 'Key': source_key}, ExpiresIn=FFMPEG_TIMEOUT * 3
+        )
+        data, (width, height) = render_image(io.BytesIO(video_frame(url)))
+
+    thumb_key = thumb_key_for(key)
+    s3_client.put_object(
+        Bucket=bucket, Key=thumb_key, Body=data, ContentType='image/webp',
+        CacheControl='private, max-age=31536000, immutable'
+    )
+    finish(key, status='ready', source_etag=etag, thumb_key=thumb_key,
+           width=width, height=height, size=len(data), error=None)
+    change_feed.publish('thumbnail', {'key': key, 'thumbnail_url': thumbnail_url(key, ready_version(key))})
+    logger.info(f"Thumbnail for '{key}' stored ({len(data)} bytes, {width}x{height})")
+
+
+def run_next(s3_client, bucket, max_attempts=3):
+    key = claim()
+    if key is None:
+        return False
+    try:
+        if metadata_index.get_object(key) is None:
+            metadata_index.get_connection().execute("DELETE FROM thumbnails WHERE key = ?", (key,))
+            return True
+        generate(s3_client, bucket, key)
+    except Exception as e:
+        row = get(key)
+        retry = row and row['attempts'] < max_attempts
+        # A retry waits 30s, then 60s, ... (pending jobs are not claimed before updated_at)
+        finish(key, status='pending' if retry else 'failed', error=str(e)[:500],
+               updated_at=time.time() + (30 * row['attempts'] if retry else 0))
+        logger.warning(f"Thumbnail for '{key}' failed{' (will retry)' if retry else ''}: {e}")
+    return True
+
+
+def start_workers(s3_client, bucket, workers):
+    def loop():
+        while True:
+            try:
+                if run_next(s3_client, bucket):
+                    continue
+            except Exception as e:
+                logger.error(f"Thumbnail worker failed: {e}")
+            wakeup.wait(POLL_INTERVAL)
+            wakeup.clear()
+
+    threads = []
+    for number in range(workers):
+        thread = threading.Thread(target=loop, name=f'thumbnail-worker-{number}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+# Cleanup
+def prune_orphans(s3_client, bucket):
+    """Delete thumbnails whose source object is no longer in the index."""
+    conn = metadata_index.get_connection()
+    rows = conn.execute(
+        "SELECT key, thumb_key FROM thumbnails t WHERE NOT EXISTS (SELECT 1 FROM objects o WHERE o.key = t.key)"
+    ).fetchall()
+    for start in range(0, len(rows), 1000):
+        batch = rows[start:start + 1000]
+        objects = [{'Key': row['thumb_key']} for row in batch if row['thumb_key']]
+        if objects:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': objects, 'Quiet': True})
+        conn.executemany("DELETE FROM thumbnails WHERE key = ?", [(row['key'],) for row in batch])
+    return len(rows)
+
+
+def stats():
+    rows = metadata_index.get_connection().execute(
+        "SELECT status, COUNT(*) AS count FROM thumbnails GROUP BY status"
+    ).fetchall()
+    return {row['status']: row['count'] for row in rows}
+
+
+def metric_lines():
+    """Thumbnail jobs by status in the Prometheus exposition format, for metrics.collectors."""
+    current = stats()
+    lines = ["# TYPE thumbnails gauge"]
+    for status in ('pending', 'working', 'ready', 'failed', 'skipped'):
+        lines.append(f'thumbnails{{status="{status}"}} {current.get(status, 0)}')
+    return lines
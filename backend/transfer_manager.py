@@ -0,0 +1,290 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import multipart_uploads
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+MAX_PREFERRED_PART_SIZE = 512 * MIB
+TARGET_PARTS = 1000
+PART_RETRIES = 4
+THROTTLE_STATUS = {429, 503}
+THROTTLE_CODES = {'SlowDown', 'ServiceUnavailable', 'TooManyRequests', 'RequestLimitExceeded', 'Throttling'}
+
+# Shared by every upload in the process: one thread pool, a limit on parts in
+# flight (adapted to R2's behaviour) and on the bytes those parts hold in memory.
+settings = {'min_concurrency': 2, 'max_concurrency': 16, 'max_inflight_bytes': 256 * MIB, 'max_bandwidth': 0}
+executor = None
+
+state_lock = threading.Condition()
+state = {
+    'target': 4,             # parts allowed in flight right now (AIMD between min and max)
+    'parts_in_flight': 0,
+    'bytes_in_flight': 0,
+    'round_bytes': 0,        # throughput measured over one "round" of `target` parts
+    'round_parts': 0,
+    'round_started': 0.0,
+    'last_round_rate': 0.0,
+    'throttles': 0,
+    'parts_uploaded': 0,
+}
+
+bandwidth_lock = threading.Lock()
+bandwidth = {'next_free': 0.0}
+
+
+def configure(min_concurrency, max_concurrency, max_inflight_bytes, max_bandwidth):
+    """Set the process-wide limits and create the shared pool. Call once at startup."""
+    global executor
+    settings.update(
+        min_concurrency=max(1, min_concurrency), max_concurrency=max(min_concurrency, max_concurrency),
+        max_inflight_bytes=max_inflight_bytes, max_bandwidth=max_bandwidth
+    )
+    with state_lock:
+        state['target'] = min(max(settings['min_concurrency'], state['target']), settings['max_concurrency'])
+    executor = ThreadPoolExecutor(max_workers=settings['max_concurrency'], thread_name_prefix='r2-transfer')
+
+
+def connection_pool_size(extra=0):
+    """botocore max_pool_connections that lets every pool thread (plus `extra` callers) hold a connection."""
+    return settings['max_concurrency'] + extra
+
+
+def attach(s3_client):
+    """Count 429/503 responses, including ones botocore retries internally, as throttling.
+
+    This is the only place throttles are recorded: every response passes through it once.
+    """
+    def on_retry_check(response=None, **kwargs):
+        if response and getattr(response[0], 'status_code', None) in THROTTLE_STATUS:
+            record_throttle()
+        return None  # never change botocore's own retry decision
+
+    s3_client.meta.events.register('needs-retry.s3.UploadPart', on_retry_check)
+    s3_client.meta.events.register('needs-retry.s3.PutObject', on_retry_check)
+    return s3_client
+
+
+def part_size_for(size):
+    """Part size scaled to the object: 8 MiB for small files, growing so uploads stay near
+    TARGET_PARTS parts, and never beyond S3's 10,000-part limit."""
+    preferred = 8 * MIB
+    while preferred * TARGET_PARTS < size and preferred < MAX_PREFERRED_PART_SIZE:
+        preferred *= 2
+    return multipart_uploads.choose_part_size(size, preferred)
+
+
+# Adaptive Concurrency
+def record_throttle():
+    with state_lock:
+        state['throttles'] += 1
+        state['target'] = max(settings['min_concurrency'], state['target'] // 2)
+        start_round()
+        state_lock.notify_all()
+
+
+def start_round():
+    state['round_bytes'] = 0
+    state['round_parts'] = 0
+    state['round_started'] = time.monotonic()
+
+
+def record_part(nbytes):
+    """After each full round of parts: grow by one while throughput holds, shrink if it fell."""
+    with state_lock:
+        state['parts_uploaded'] += 1
+        state['round_bytes'] += nbytes
+        state['round_parts'] += 1
+        if state['round_parts'] < state['target']:
+            return
+        elapsed = max(time.monotonic() - state['round_started'], 1e-6)
+        rate = state['round_bytes'] / elapsed
+        if rate >= state['last_round_rate'] * 0.9:
+            state['target'] = min(settings['max_concurrency'], state['target'] + 1)
+        else:
+            state['target'] = max(settings['min_concurrency'], state['target'] - 1)
+        state['last_round_rate'] = rate
+        start_round()
+        state_lock.notify_all()
+
+
+def admits(nbytes):
+    """Whether one more part of nbytes fits in the limits right now (state_lock held)."""
+    return state['parts_in_flight'] < state['target'] and not (
+        state['parts_in_flight'] and state['bytes_in_flight'] + nbytes > settings['max_inflight_bytes'])
+
+
+def take_slot(nbytes):
+    if not state['round_started']:
+        start_round()
+    state['parts_in_flight'] += 1
+    state['bytes_in_flight'] += nbytes
+
+
+def acquire(nbytes):
+    """Block until one more part of nbytes may be in flight process-wide."""
+    with state_lock:
+        while not admits(nbytes):
+            state_lock.wait()
+        take_slot(nbytes)
+
+
+def try_acquire(nbytes):
+    """acquire() without waiting (for the ASGI server's event loop). True if the part may go now."""
+    with state_lock:
+        if not admits(nbytes):
+            return False
+        take_slot(nbytes)
+        return True
+
+
+def release(nbytes):
+    with state_lock:
+        state['parts_in_flight'] -= 1
+        state['bytes_in_flight'] -= nbytes
+        state_lock.notify_all()
+
+
+def shrink(acquired, actual):
+    """A part acquired for `acquired` bytes turned out to hold only `actual`."""
+    with state_lock:
+        state['bytes_in_flight'] -= acquired - actual
+        state_lock.notify_all()
+
+
+def pace_delay(nbytes):
+    """Reserve nbytes of the max_bandwidth budget (0 = unlimited). Returns the seconds to wait before sending them."""
+    rate = settings['max_bandwidth']
+    if rate <= 0:
+        return 0
+    with bandwidth_lock:
+        now = time.monotonic()
+        start = max(now, bandwidth['next_free'])
+        bandwidth['next_free'] = start + nbytes / rate
+    return start - now
+
+
+def pace(nbytes):
+    """Delay so all parts together stay under max_bandwidth bytes/s."""
+    delay = pace_delay(nbytes)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def retry_delay(attempt):
+    """Back-off before retrying a throttled part."""
+    return min(10, 0.5 * 2 ** attempt)
+
+
+def is_throttle(error):
+    return isinstance(error, ClientError) and (
+        error.response.get('Error', {}).get('Code') in THROTTLE_CODES
+        or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in THROTTLE_STATUS
+    )
+
+
+# Uploads
+def upload_part(s3_client, bucket, key, upload_id, part_number, data):
+    try:
+        for attempt in range(PART_RETRIES):
+            pace(len(data))
+            try:
+                result = s3_client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data
+                )
+                record_part(len(data))
+                return {'PartNumber': part_number, 'ETag': result['ETag']}
+            except ClientError as e:
+                if not is_throttle(e) or attempt == PART_RETRIES - 1:
+                    raise
+                # Already counted by the needs-retry hook (see attach): only back off here
+                time.sleep(retry_delay(attempt))
+    finally:
+        release(len(data))
+
+
+def upload_stream(s3_client, bucket, key, stream, size, content_type, conditional=True, exact=True, **object_args):
+    """Multipart-upload `size` bytes read sequentially from stream. Returns the completed object's ETag.
+
+    Parts are read here (the request thread) and sent on the shared pool; acquire()
+    bounds how many are in memory across all concurrent uploads. With exact=False,
+    `size` only bounds the stream's length (a compressed upload): parts are sized
+    for it and the stream is read until it ends. `object_args` go to
+    create_multipart_upload (e.g. ContentEncoding, Metadata).
+    """
+    part_size = part_size_for(size)
+    mpu = s3_client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type, **object_args)
+    upload_id = mpu['UploadId']
+    futures = []
+    try:
+        part_count = multipart_uploads.part_count(size, part_size)
+        part_number, ended = 0, False
+        while not ended:
+            part_number += 1
+            length = min(part_size, size - part_size * (part_number - 1)) if exact else part_size
+            acquire(length)
+            try:
+                data = stream.read(length)
+                if exact and len(data) != length:
+                    raise IOError(f"Upload stream ended early at part {part_number}")
+            except BaseException:
+                release(length)
+                raise
+            if exact:
+                ended = part_number == part_count
+            elif len(data) < length:
+                ended = True
+                if not data and part_number > 1:
+                    release(length)
+                    break
+                shrink(length, len(data))
+                length = len(data)
+            futures.append((executor.submit(upload_part, s3_client, bucket, key, upload_id, part_number, data), length))
+            # Fail fast instead of reading the rest of a large body after a part has failed
+            failed = next((f for f, _ in futures if f.done() and f.exception()), None)
+            if failed:
+                failed.result()
+
+        parts = [future.result() for future, _ in futures]
+        params = {'Bucket': bucket, 'Key': key, 'UploadId': upload_id, 'MultipartUpload': {'Parts': parts}}
+        if conditional:
+            params['IfNoneMatch'] = '*'
+        result = s3_client.complete_multipart_upload(**params)
+        return result.get('ETag', '').strip('"') or None
+    except BaseException:
+        for future, length in futures:
+            if future.cancel():
+                release(length)  # never ran, so upload_part did not release its slot
+        try:
+            s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            logger.warning(f"Abort of multipart upload for '{key}' failed: {e}")
+        raise
+
+
+def stats():
+    with state_lock:
+        return {
+            'target_concurrency': state['target'],
+            'parts_in_flight': state['parts_in_flight'],
+            'bytes_in_flight': state['bytes_in_flight'],
+            'parts_uploaded': state['parts_uploaded'],
+            'throttles': state['throttles'],
+            'last_round_bytes_per_second': round(state['last_round_rate'], 1),
+        }
+
+
+def metric_lines():
+    """Transfer manager state in the Prometheus exposition format, for metrics.collectors."""
+    current = stats()
+    lines = []
+    for name in ('parts_uploaded', 'throttles'):
+        lines += [f"# TYPE transfer_manager_{name}_total counter", f"transfer_manager_{name}_total {current[name]}"]
+    for name in ('target_concurrency', 'parts_in_flight', 'bytes_in_flight', 'last_round_bytes_per_second'):
+        lines += [f"# TYPE transfer_manager_{name} gauge", f"transfer_manager_{name} {current[name]}"]
+    return lines
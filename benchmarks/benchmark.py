@@ -0,0 +1,611 @@
+"""Throughput benchmarks for the backend against a local S3-compatible emulator.
+
+Starts an emulator (moto by default, or any endpoint via --endpoint, e.g. MinIO),
+starts the backend against it with the same server command as the Docker image,
+then drives scripted workloads over HTTP and records p50/p95/p99 latency, MB/s
+and the backend's peak RSS. Results are saved as JSON so runs can be compared:
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/benchmark.py                              # all workloads, default sizes
+    python benchmarks/benchmark.py --workloads list --list-keys 1000000
+    python benchmarks/benchmark.py --server asgi --env OBJECT_CACHE=true
+    python benchmarks/benchmark.py --compare benchmarks/results/<earlier run>.json
+
+Settings from a .env file are not used for the backend: every R2/auth variable
+is set explicitly so a benchmark can never touch the real bucket.
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
+
+import boto3
+from botocore.config import Config
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(REPO_DIR, 'backend')
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+
+MIB = 1024 * 1024
+ACCESS_KEY = 'bench'
+SECRET_KEY = 'bench-secret'
+PASSWORD = 'bench-password'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until(check, timeout, what):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return
+        except Exception:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Timed out after {timeout}s waiting for {what}")
+
+
+def port_open(port):
+    with socket.socket() as s:
+        return s.connect_ex(('127.0.0.1', port)) == 0
+
+
+# Processes
+def process_tree(pid):
+    """pid plus all of its descendants (Linux /proc)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def rss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler:
+    """Samples the summed RSS of a process tree in the background and keeps the peak."""
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+        self.supported = os.path.isdir('/proc')
+
+    def __enter__(self):
+        self.peak = rss_bytes(self.pid) if self.supported else 0
+        self.running = self.supported
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def loop(self):
+        while self.running:
+            self.peak = max(self.peak, rss_bytes(self.pid))
+            time.sleep(self.interval)
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+    @property
+    def peak_mb(self):
+        return round(self.peak / MIB, 1) if self.supported else None
+
+
+class Emulator:
+    """moto's S3 server on a free local port, or an already running endpoint."""
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.process = None
+
+    def start(self):
+        if self.endpoint:
+            return self.endpoint
+        port = free_port()
+        try:
+            import moto.server  # noqa: F401
+        except ImportError:
+            sys.exit("moto is not installed: pip install -r benchmarks/requirements.txt, or pass --endpoint")
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        wait_until(lambda: port_open(port), 30, "the S3 emulator")
+        self.endpoint = f"http://127.0.0.1:{port}"
+        return self.endpoint
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+
+
+class Backend:
+    """The backend, launched like the Docker image does, in a scratch data directory."""
+
+    def __init__(self, server, endpoint, bucket, workdir, extra_env):
+        self.server = server
+        self.endpoint = endpoint
+        self.bucket = bucket
+        self.workdir = workdir
+        self.extra_env = extra_env
+        self.port = free_port()
+        self.process = None
+
+    def env(self):
+        env = dict(os.environ)
+        env.update({
+            'R2_ENDPOINT_URL': self.endpoint,
+            'R2_ACCOUNT_ID': 'bench',
+            'R2_ACCESS_KEY_ID': ACCESS_KEY,
+            'R2_SECRET_ACCESS_KEY': SECRET_KEY,
+            'R2_BUCKET_NAME': self.bucket,
+            'R2_PUBLIC_URL': f"{self.endpoint}/{self.bucket}",
+            'PUBLIC_BASE_URL': f"http://127.0.0.1:{self.port}",
+            'ADMIN_PASSWORD': PASSWORD,
+            'AUTH_SECRET_KEY': secrets.token_hex(32),
+            'INDEX_DB_FILE': os.path.join(self.workdir, 'data', 'metadata.db'),
+            'INDEX_SYNC_INTERVAL': '3600',
+        })
+        env.update(self.extra_env)
+        return env
+
+    def start(self):
+        os.makedirs(os.path.join(self.workdir, 'data'), exist_ok=True)
+        env = self.env()
+        if self.server == 'asgi':
+            command = [sys.executable, '-m', 'uvicorn', '--app-dir', BACKEND_DIR, 'asgi_app:app',
+                       '--host', '127.0.0.1', '--port', str(self.port), '--timeout-keep-alive', '300',
+                       '--log-level', 'warning']
+        else:
+            # Threaded like the Docker image, so concurrent requests are not served one at a time
+            command = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--worker-class', 'gthread',
+                       '--threads', env.get('GUNICORN_THREADS') or '32', '--bind', f"127.0.0.1:{self.port}",
+                       '--timeout', '300', '--log-level', 'warning', '--pythonpath', BACKEND_DIR, 'app:app']
+        log = open(os.path.join(self.workdir, 'backend.log'), 'ab')
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=env, stdout=log, stderr=log)
+        wait_until(lambda: HttpClient(self.port).get('/health')[0] == 200, 60, "the backend")
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+# HTTP
+class HttpClient:
+    """Keep-alive HTTP/1.1 client, one connection per thread."""
+
+    def __init__(self, port, cookie=''):
+        self.port = port
+        self.cookie = cookie
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        return conn
+
+    def request(self, method, path, body=None, headers=None, body_parts=None, length=None):
+        """Send a request and drain the response. Returns (status, body bytes, body or None if discarded)."""
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        conn = self.connection()
+        try:
+            if body_parts is None:
+                conn.request(method, path, body=body, headers=headers)
+            else:
+                conn.putrequest(method, path)
+                headers['Content-Length'] = str(length)
+                for name, value in headers.items():
+                    conn.putheader(name, value)
+                conn.endheaders()
+                for part in body_parts:
+                    conn.send(part)
+            response = conn.getresponse()
+            keep = response.getheader('Content-Type', '').startswith('application/json')
+            received, chunks = 0, []
+            while True:
+                chunk = response.read(MIB)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if keep:
+                    chunks.append(chunk)
+            return response.status, received, b''.join(chunks) if keep else None
+        except Exception:
+            conn.close()
+            self.local.conn = None
+            raise
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def login(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        conn.request('POST', '/api/auth/login', body=json.dumps({'password': PASSWORD}),
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Login failed with HTTP {response.status}")
+        token = response.getheader('Set-Cookie').split(';', 1)[0].split('=', 1)[1]
+        # The plain-HTTP cookie name, plus the __Host- name require_auth reads behind HTTPS
+        self.cookie = f"auth_token={token}; __Host-auth_token={token}"
+
+    def upload(self, filename, size):
+        """Multipart POST /api/upload of `size` generated bytes, streamed without buffering the file."""
+        boundary = uuid.uuid4().hex
+        preamble = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+        closing = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        status, _, _ = self.request(
+            'POST', '/api/upload',
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+            body_parts=[preamble, *generated_bytes(size), closing],
+            length=len(preamble) + size + len(closing)
+        )
+        return status
+
+
+def generated_bytes(size):
+    """`size` bytes that are unique per call (fresh random block) but cheap to produce."""
+    block = os.urandom(min(size, MIB))
+    remaining = size
+    while remaining > 0:
+        chunk = block[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+
+
+# Measurement
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, total_bytes, duration, errors, peak_rss_mb, **extra):
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None  # noqa: E731
+    result = {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'duration_s': round(duration, 3),
+        'p50_ms': ms(percentile(ordered, 50)),
+        'p95_ms': ms(percentile(ordered, 95)),
+        'p99_ms': ms(percentile(ordered, 99)),
+        'max_ms': ms(ordered[-1] if ordered else None),
+        'ops_per_s': round(len(latencies) / duration, 2) if duration else None,
+        'mb_per_s': round(total_bytes / MIB / duration, 2) if duration and total_bytes else None,
+        'peak_rss_mb': peak_rss_mb,
+    }
+    result.update(extra)
+    return result
+
+
+def run_concurrent(task, items, concurrency, pid):
+    """Run task(item) -> (ok, bytes) over items with `concurrency` threads; returns a summary."""
+    latencies, lock = [], threading.Lock()
+    counters = {'bytes': 0, 'errors': 0}
+
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            ok, moved = task(item)
+        except Exception:
+            ok, moved = False, 0
+        elapsed = time.perf_counter() - start
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+                counters['bytes'] += moved
+            else:
+                counters['errors'] += 1
+
+    with RssSampler(pid) as sampler:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, items))
+        duration = time.perf_counter() - start
+    return summarize(latencies, counters['bytes'], duration, counters['errors'], sampler.peak_mb,
+                     concurrency=concurrency)
+
+
+# Workloads
+def seed_keys(s3, bucket, count, concurrency):
+    """Write `count` tiny objects straight to the emulator (not through the backend)."""
+    def put(i):
+        s3.put_object(Bucket=bucket, Key=f"seed/{i:07d}-{secrets.token_hex(4)}.txt", Body=b'x')
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(put, range(count)))
+
+
+def files_stats(client):
+    status, _, body = client.get('/api/files?limit=1')
+    if status != 200:
+        return None
+    return json.loads(body).get('stats') or {}
+
+
+def workload_list(ctx):
+    """Index sync of seeded keys, first-page latency, a full cursor walk and searches."""
+    client, args, results = ctx['client'], ctx['args'], {}
+    expected = ctx['seeded']
+
+    start = time.perf_counter()
+    wait_until(lambda: (files_stats(client) or {}).get('total_files', 0) >= expected,
+               max(120, expected / 500), f"the index to list {expected} keys")
+    results['list_index_sync'] = {'keys': expected, 'duration_s': round(time.perf_counter() - start, 3)}
+
+    first_page = lambda _: (client.get('/api/files?' + urlencode({'limit': 60}))[0] == 200, 0)  # noqa: E731
+    results['list_first_page'] = run_concurrent(first_page, range(args.requests), args.concurrency, ctx['pid'])
+
+    sort_by_size = lambda _: (client.get('/api/files?' + urlencode(  # noqa: E731
+        {'limit': 60, 'sort': 'size', 'order': 'asc'}))[0] == 200, 0)
+    results['list_sort_size'] = run_concurrent(sort_by_size, range(args.requests), args.concurrency, ctx['pid'])
+
+    search = lambda _: (client.get('/api/files?' + urlencode(  # noqa: E731
+        {'limit': 60, 'q': f"{random.randrange(10000):04d}"}))[0] == 200, 0)
+    results['list_search'] = run_concurrent(search, range(args.requests), args.concurrency, ctx['pid'])
+
+    # Walk every page with the cursor, like infinite scroll to the end
+    latencies, walked, cursor = [], 0, None
+    with RssSampler(ctx['pid']) as sampler:
+        start = time.perf_counter()
+        while True:
+            params = {'limit': 500}
+            if cursor:
+                params['cursor'] = cursor
+            page_start = time.perf_counter()
+            status, _, body = client.get('/api/files?' + urlencode(params))
+            latencies.append(time.perf_counter() - page_start)
+            if status != 200:
+                break
+            page = json.loads(body)
+            walked += len(page['files'])
+            cursor = page.get('next_cursor')
+            if not cursor:
+                break
+        duration = time.perf_counter() - start
+    results['list_full_walk'] = summarize(latencies, 0, duration, 0, sampler.peak_mb, keys_walked=walked)
+    return results
+
+
+def workload_upload_storm(ctx):
+    """Many small concurrent uploads through /api/upload."""
+    client, args = ctx['client'], ctx['args']
+    size = args.small_file_kb * 1024
+
+    def upload(i):
+        return client.upload(f"storm-{i}.bin", size) == 200, size
+    return {'upload_storm': run_concurrent(upload, range(args.small_files), args.concurrency, ctx['pid'])}
+
+
+def workload_large_upload(ctx):
+    """Single large uploads through /api/upload, one at a time."""
+    client, args = ctx['client'], ctx['args']
+    size = args.large_file_mb * MIB
+
+    def upload(i):
+        return client.upload(f"large-{i}.bin", size) == 200, size
+    return {'large_upload': run_concurrent(upload, range(args.large_files), 1, ctx['pid'])}
+
+
+def workload_download(ctx):
+    """Concurrent full downloads through /api/serve-file, spread over a set of seeded files."""
+    client, args = ctx['client'], ctx['args']
+    size = args.download_file_mb * MIB
+    names = []
+    for i in range(args.download_files):
+        if client.upload(f"download-{i}.bin", size) != 200:
+            raise RuntimeError("Seeding download files failed")
+        names.append(f"download-{i}.bin")
+
+    def download(i):
+        status, received, _ = client.get('/api/serve-file/' + quote(names[i % len(names)]))
+        return status == 200 and received == size, received
+    return {'download': run_concurrent(download, range(args.requests), args.concurrency, ctx['pid'])}
+
+
+def workload_delete(ctx):
+    """delete_buckets.py wiping everything the other workloads left in the bucket."""
+    s3, bucket = ctx['s3'], ctx['bucket']
+    count = sum(page.get('KeyCount', 0) for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket))
+    env = dict(os.environ, R2_ENDPOINT_URL=ctx['endpoint'], R2_ACCESS_KEY_ID=ACCESS_KEY,
+               R2_SECRET_ACCESS_KEY=SECRET_KEY, R2_BUCKET_NAME=bucket)
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, 'delete_buckets.py'), '--yes', '--restart'],
+        cwd=ctx['workdir'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    with RssSampler(process.pid) as sampler:
+        start = time.perf_counter()
+        process.wait()
+        duration = time.perf_counter() - start
+    left = sum(page.get('KeyCount', 0) for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket))
+    return {'delete_wipe': {
+        'objects': count, 'remaining': left, 'exit_code': process.returncode,
+        'duration_s': round(duration, 3),
+        'objects_per_s': round((count - left) / duration, 2) if duration else None,
+        'peak_rss_mb': sampler.peak_mb,
+    }}
+
+
+WORKLOADS = {
+    'list': workload_list,
+    'upload-storm': workload_upload_storm,
+    'large-upload': workload_large_upload,
+    'download': workload_download,
+    'delete': workload_delete,
+}
+
+
+# Results
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_DIR) != 0
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    print(f"\nCompared with {previous['meta'].get('started_at')} ({previous['meta'].get('revision')}):")
+    for name, result in current['results'].items():
+        before = previous['results'].get(name)
+        if not before:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'mb_per_s', 'ops_per_s', 'objects_per_s', 'peak_rss_mb',
+                       'duration_s'):
+            new, old = result.get(metric), before.get(metric)
+            if new is not None and old:
+                changes.append(f"{metric} {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+        print(f"  {name}: " + ('; '.join(changes) if changes else 'no comparable metrics'))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the backend against a local S3 emulator")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help=f"comma-separated, from: {', '.join(WORKLOADS)}")
+    parser.add_argument('--endpoint', help="use a running S3-compatible endpoint instead of starting moto")
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi', help="backend server mode")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="extra backend env var")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help="requests per download/listing workload")
+    parser.add_argument('--list-keys', type=int, default=10000, help="keys seeded for the listing workload")
+    parser.add_argument('--small-files', type=int, default=500)
+    parser.add_argument('--small-file-kb', type=int, default=16)
+    parser.add_argument('--large-files', type=int, default=1)
+    parser.add_argument('--large-file-mb', type=int, default=1024)
+    parser.add_argument('--download-files', type=int, default=20)
+    parser.add_argument('--download-file-mb', type=int, default=8)
+    parser.add_argument('--output', help="results file (default benchmarks/results/<time>-<revision>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    selected = [name.strip() for name in args.workloads.split(',') if name.strip()]
+    unknown = [name for name in selected if name not in WORKLOADS]
+    if unknown:
+        sys.exit(f"Unknown workloads: {', '.join(unknown)}")
+    extra_env = dict(item.split('=', 1) for item in args.env)
+
+    bucket = f"bench-{secrets.token_hex(4)}"
+    emulator = Emulator(args.endpoint)
+    endpoint = emulator.start()
+    workdir = tempfile.mkdtemp(prefix='r2-bench-')
+    backend = None
+    started_at = datetime.now(timezone.utc)
+    results = {}
+    try:
+        s3 = boto3.client('s3', endpoint_url=endpoint, aws_access_key_id=ACCESS_KEY,
+                          aws_secret_access_key=SECRET_KEY, region_name='us-east-1',
+                          config=Config(max_pool_connections=64))
+        s3.create_bucket(Bucket=bucket)
+
+        # Seed before the backend starts, so its startup reconcile is what indexes them
+        seeded = 0
+        if 'list' in selected and args.list_keys:
+            print(f"Seeding {args.list_keys} keys...")
+            seed_keys(s3, bucket, args.list_keys, 32)
+            seeded = args.list_keys
+
+        backend = Backend(args.server, endpoint, bucket, workdir, extra_env)
+        backend.start()
+        client = HttpClient(backend.port)
+        client.login()
+        ctx = {'args': args, 'client': client, 's3': s3, 'bucket': bucket, 'endpoint': endpoint,
+               'workdir': workdir, 'pid': backend.process.pid, 'seeded': seeded}
+
+        for name in WORKLOADS:  # fixed order: delete must run last
+            if name not in selected:
+                continue
+            print(f"Running {name}...")
+            for result_name, result in WORKLOADS[name](ctx).items():
+                results[result_name] = result
+                print(f"  {result_name}: {json.dumps(result)}")
+    finally:
+        if backend:
+            backend.stop()
+        emulator.stop()
+
+    report = {
+        'meta': {
+            'started_at': started_at.isoformat(),
+            'revision': git_revision(),
+            'server': args.server,
+            'emulator': 'external' if args.endpoint else 'moto',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'backend_env': extra_env,
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{started_at.strftime('%Y%m%dT%H%M%SZ')}-{report['meta']['revision'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output} (backend log: {os.path.join(workdir, 'backend.log')})")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
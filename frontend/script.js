@@ -34,6 +34,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const quotaProgress = document.getElementById('quotaProgress');
     const quotaText = document.getElementById('quotaText');
     const searchInput = document.getElementById('searchInput');
+    const zipButton = document.getElementById('zipButton');
     const fileSliderContainer = document.getElementById('fileSliderContainer');
     const sliderControls = document.getElementById('sliderControls');
     const sliderIndicators = document.getElementById('sliderIndicators');
@@ -51,10 +52,18 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Variabel sliding windows
     let currentSlide = 0;
-    let allFiles = [];
     let filteredFiles = [];
     const filesPerSlide = 6;
 
+    // Server-side paging state (/api/files cursor tokens)
+    const filesPageSize = 60;
+    let nextCursor = null;
+    let currentQuery = '';
+    let isLoadingPage = false;
+
+    // True while the /api/events change feed is connected; the list is then patched in place
+    let liveUpdates = false;
+
     // --- Funct Utility ---
     const formatFileSize = (bytes) => {
         if (bytes === 0) return '0 Bytes';
@@ -139,7 +148,7 @@ document.addEventListener('DOMContentLoaded', () => {
     };
 
     // --- Function sliding windows ---
-    const createFileSlides = () => {
+    const createFileSlides = (keepPosition = false) => {
         fileList.innerHTML = '';
         sliderIndicators.innerHTML = '';
         
@@ -171,7 +180,9 @@ document.addEventListener('DOMContentLoaded', () => {
                 
                 fileCard.innerHTML = `
                     <div class="file-card-header">
-                        <i class="fas ${getFileIcon(file.key)}"></i>
+                        ${file.thumbnail_url
+                            ? `<img class="file-card-thumb" src="${file.thumbnail_url}" alt="" loading="lazy" decoding="async">`
+                            : `<i class="fas ${getFileIcon(file.key)}"></i>`}
                         <h5 class="file-card-title">${file.key}</h5>
                     </div>
                     <div class="file-card-body">
@@ -219,8 +230,9 @@ document.addEventListener('DOMContentLoaded', () => {
             sliderIndicators.style.display = 'none';
         }
         
-        // Reset to first slide
-        currentSlide = 0;
+        // Reset to first slide (unless more pages were appended)
+        if (!keepPosition) currentSlide = 0;
+        currentSlide = Math.min(currentSlide, slideCount - 1);
         updateSlidePosition();
         
         // Attach event listeners
@@ -247,8 +259,14 @@ document.addEventListener('DOMContentLoaded', () => {
         });
         
         // Update button states
+        const lastSlide = Math.ceil(filteredFiles.length / filesPerSlide) - 1;
         prevSlide.disabled = currentSlide === 0;
-        nextSlide.disabled = currentSlide === (Math.ceil(filteredFiles.length / filesPerSlide) - 1);
+        nextSlide.disabled = currentSlide === lastSlide && !nextCursor;
+
+        // Infinite scroll: prefetch the next page when nearing the end
+        if (nextCursor && currentSlide >= lastSlide - 1) {
+            loadMoreFiles();
+        }
     };
 
     const goToSlide = (slideIndex) => {
@@ -264,7 +282,10 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    nextSlide.addEventListener('click', () => {
+    nextSlide.addEventListener('click', async () => {
+        if (currentSlide >= Math.ceil(filteredFiles.length / filesPerSlide) - 1 && nextCursor) {
+            await loadMoreFiles();
+        }
         if (currentSlide < Math.ceil(filteredFiles.length / filesPerSlide) - 1) {
             currentSlide++;
             updateSlidePosition();
@@ -272,6 +293,65 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     // --- Function handle download ---
+    // Either way the browser's download manager fetches the file itself: it goes straight
+    // to disk (no Blob held in the page) and can be paused and resumed
+    const startBrowserDownload = (url) => {
+        const a = document.createElement('a');
+        a.style.display = 'none';
+        a.href = url;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+    };
+
+    const downloadButtonFor = (filename) =>
+        fileList.querySelector(`.btn-download[data-filename="${CSS.escape(filename)}"]`);
+
+    // --- Download progress, polled from the ticket status endpoint ---
+    const watchDownload = (ticket, filename, originalHTML) => {
+        const startDeadline = Date.now() + ticket.expires_in * 1000;
+        let idlePolls = 0;
+
+        const restore = () => {
+            const button = downloadButtonFor(filename);
+            if (button) {
+                button.innerHTML = originalHTML;
+                button.disabled = false;
+            }
+        };
+
+        const timer = setInterval(async () => {
+            let progress;
+            try {
+                progress = await apiJSON('GET', ticket.status_url);
+            } catch (error) {
+                clearInterval(timer);
+                restore();
+                return;
+            }
+            const button = downloadButtonFor(filename);
+
+            if (progress.status === 'downloading') {
+                idlePolls = 0;
+                if (button) {
+                    button.disabled = true;
+                    button.innerHTML = `<small>${Math.floor(progress.percent)}%</small>`;
+                }
+            } else if (progress.status === 'complete') {
+                clearInterval(timer);
+                restore();
+                if (!liveUpdates) fetchAndDisplayFiles();
+            } else if (progress.status === 'paused') {
+                // Paused in the download manager (or the connection dropped); it resumes with the same URL
+                restore();
+                if (++idlePolls > 60) clearInterval(timer);
+            } else if (Date.now() > startDeadline) {
+                clearInterval(timer);
+                restore();
+            }
+        }, 1000);
+    };
+
     const handleDownloadClick = async (e) => {
         const button = e.currentTarget;
         const filename = button.dataset.filename;
@@ -281,28 +361,24 @@ document.addEventListener('DOMContentLoaded', () => {
         button.disabled = true;
 
         try {
-            const downloadUrl = `/api/serve-file/${encodeURIComponent(filename)}?t=${Date.now()}`;
-            const response = await fetch(downloadUrl, { cache: 'no-cache', credentials: 'same-origin' });
-            if (handleAuthError(response.status)) return;
-            if (!response.ok) throw new Error('Download failed');
-            
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.style.display = 'none';
-            a.href = url;
-            a.setAttribute('download', filename);
-            document.body.appendChild(a);
-            a.click();
-            document.body.removeChild(a);
-            window.URL.revokeObjectURL(url);
-            
-            fetchAndDisplayFiles();
+            if (transferConfig.direct) {
+                // Presigned R2 URL
+                const result = await apiJSON('GET', `/api/direct/download/${encodeURIComponent(filename)}`);
+                startBrowserDownload(result.url);
+                button.innerHTML = originalHTML;
+                button.disabled = false;
+                if (!liveUpdates) fetchAndDisplayFiles();
+                return;
+            }
+
+            // Signed ticket URL served by the backend; progress comes from its status endpoint
+            const ticket = await apiJSON('POST', '/api/download-tickets', { key: filename });
+            startBrowserDownload(ticket.url);
+            watchDownload(ticket, filename, originalHTML);
 
         } catch (error) {
             console.error('Download failed:', error);
             showNotification('Download failed. Please try again.', 'error');
-        } finally {
             button.innerHTML = originalHTML;
             button.disabled = false;
         }
@@ -333,6 +409,11 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- Upload progress bar ---
     const uploadFileXHR = (file, callback) => {
+        if (transferConfig.direct || file.size > chunkedUploadThreshold) {
+            uploadFileChunked(file, callback, transferConfig.direct);
+            return;
+        }
+
         const formData = new FormData();
         formData.append('file', file);
 
@@ -385,6 +466,152 @@ document.addEventListener('DOMContentLoaded', () => {
         xhr.send(formData);
     };
 
+    // --- Transfer mode (proxied through the backend, or direct to R2) ---
+    let transferConfig = { direct: false };
+    const loadTransferConfig = async () => {
+        try {
+            transferConfig = await apiJSON('GET', '/api/transfer-config');
+        } catch (e) {
+            transferConfig = { direct: false };
+        }
+    };
+
+    // --- Resumable chunked upload (parallel parts, /api/uploads) ---
+    const chunkedUploadThreshold = 16 * 1024 * 1024;
+    const parallelParts = 4;
+    const maxPartRetries = 5;
+
+    const apiJSON = async (method, url, body) => {
+        const options = { method, credentials: 'same-origin' };
+        if (body) {
+            options.headers = { 'Content-Type': 'application/json' };
+            options.body = JSON.stringify(body);
+        }
+        const response = await fetch(url, options);
+        if (handleAuthError(response.status)) throw new Error('Authentication required');
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok) throw new Error(data.error || `Request failed with status: ${response.status}`);
+        return data;
+    };
+
+    // Direct mode PUTs to presigned R2 URLs: no cookies, only the signed headers
+    const uploadPartXHR = (url, blob, onProgress, direct = false, headers = {}) => new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.upload.onprogress = (e) => onProgress(e.loaded);
+        xhr.onload = () => {
+            if (xhr.status === 401 && !direct) {
+                handleAuthError(401);
+                reject(new Error('Authentication required'));
+            } else if (xhr.status === 200) {
+                resolve();
+            } else {
+                reject(new Error(`Part upload failed with status: ${xhr.status}`));
+            }
+        };
+        xhr.onerror = () => reject(new Error('Network error. Please check your connection.'));
+        xhr.open('PUT', url, true);
+        xhr.withCredentials = !direct;
+        const requestHeaders = direct ? headers : { 'Content-Type': 'application/octet-stream' };
+        Object.entries(requestHeaders).forEach(([name, value]) => xhr.setRequestHeader(name, value));
+        xhr.send(blob);
+    });
+
+    const partUploadUrl = async (session, partNumber, direct) => {
+        if (!direct) return `/api/uploads/${session.upload_id}/parts/${partNumber}`;
+        const result = await apiJSON('POST', `/api/direct/uploads/${session.upload_id}/part-urls`, {
+            part_numbers: [partNumber]
+        });
+        return result.urls[partNumber];
+    };
+
+    const uploadFileChunked = async (file, callback, direct = false) => {
+        // Same file picked again after a failure resumes the same session
+        const resumeKey = `chunkedUpload:${file.name}:${file.size}:${file.lastModified}`;
+        const partProgress = {};
+        const showProgress = () => {
+            const loaded = Object.values(partProgress).reduce((sum, n) => sum + n, 0);
+            progressBar.style.width = `${(loaded / file.size) * 100}%`;
+            progressContainer.style.display = 'block';
+        };
+
+        try {
+            let session = null;
+            const savedId = localStorage.getItem(resumeKey);
+            if (savedId) {
+                try {
+                    session = await apiJSON('GET', `/api/uploads/${savedId}`);
+                } catch (e) {
+                    localStorage.removeItem(resumeKey);
+                }
+            }
+            if (!session) {
+                session = await apiJSON('POST', direct ? '/api/direct/uploads' : '/api/uploads', {
+                    filename: file.name,
+                    size: file.size,
+                    content_type: file.type || 'application/octet-stream'
+                });
+                session.parts = [];
+                if (session.mode === 'single') {
+                    // Small file, direct mode: one presigned PUT straight to R2
+                    await uploadPartXHR(session.url, file, (loaded) => {
+                        partProgress[1] = loaded;
+                        showProgress();
+                    }, true, session.headers);
+                    const result = await apiJSON('POST', `/api/uploads/${session.upload_id}/complete`);
+                    callback(null, result);
+                    return;
+                }
+                localStorage.setItem(resumeKey, session.upload_id);
+            }
+
+            const queue = [];
+            const done = new Set(session.parts.map(part => part.part_number));
+            session.parts.forEach(part => { partProgress[part.part_number] = part.size; });
+            for (let n = 1; n <= session.part_count; n++) {
+                if (!done.has(n)) queue.push(n);
+            }
+            showProgress();
+
+            let failed = false;
+            const worker = async () => {
+                while (queue.length && !failed) {
+                    const partNumber = queue.shift();
+                    const start = (partNumber - 1) * session.part_size;
+                    const blob = file.slice(start, Math.min(start + session.part_size, file.size));
+                    for (let attempt = 1; ; attempt++) {
+                        try {
+                            const url = await partUploadUrl(session, partNumber, direct);
+                            await uploadPartXHR(url, blob, (loaded) => {
+                                partProgress[partNumber] = loaded;
+                                showProgress();
+                            }, direct);
+                            partProgress[partNumber] = blob.size;
+                            showProgress();
+                            break;
+                        } catch (err) {
+                            partProgress[partNumber] = 0;
+                            if (attempt >= maxPartRetries || failed) {
+                                failed = true;
+                                throw err;
+                            }
+                            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** (attempt - 1)));
+                        }
+                    }
+                }
+            };
+            await Promise.all(Array.from({ length: parallelParts }, worker));
+
+            const result = await apiJSON('POST', `/api/uploads/${session.upload_id}/complete`);
+            localStorage.removeItem(resumeKey);
+            callback(null, result);
+        } catch (error) {
+            callback(`${error.message} (select the same file again to resume)`);
+        } finally {
+            progressContainer.style.display = 'none';
+            progressBar.style.width = '0%';
+        }
+    };
+
     // --- Event listener upload form ---
     uploadForm.addEventListener('submit', (e) => {
         e.preventDefault();
@@ -403,7 +630,7 @@ document.addEventListener('DOMContentLoaded', () => {
             } else {
                 uploadForm.reset();
                 uploadForm.classList.remove('was-validated');
-                fetchAndDisplayFiles();
+                if (!liveUpdates) fetchAndDisplayFiles();
                 showNotification(result.message, 'success');
             }
             uploadButton.disabled = false;
@@ -427,7 +654,7 @@ document.addEventListener('DOMContentLoaded', () => {
             } else {
                 modalUploadForm.reset();
                 uploadModal.classList.remove('show');
-                fetchAndDisplayFiles();
+                if (!liveUpdates) fetchAndDisplayFiles();
                 showNotification(result.message, 'success');
             }
         });
@@ -453,21 +680,42 @@ document.addEventListener('DOMContentLoaded', () => {
     searchInput.addEventListener('input', (e) => {
         clearTimeout(searchTimeout);
         searchTimeout = setTimeout(() => {
-            const searchTerm = e.target.value.toLowerCase();
-            
-            if (searchTerm === '') {
-                filteredFiles = [...allFiles];
-            } else {
-                filteredFiles = allFiles.filter(file => 
-                    file.key.toLowerCase().includes(searchTerm)
-                );
-            }
-            
-            currentSlide = 0;
-            createFileSlides();
+            // Filtering happens server-side on the metadata index
+            currentQuery = e.target.value.trim();
+            fetchAndDisplayFiles();
         }, 300);
     });
 
+    // --- Function download as ZIP ---
+    // A plain form POST lets the browser save the archive natively while the backend streams it
+    zipButton.addEventListener('click', () => {
+        if (filteredFiles.length === 0) {
+            showNotification('No files to download.', 'error');
+            return;
+        }
+        const form = document.createElement('form');
+        form.method = 'POST';
+        form.action = '/api/download/zip';
+        form.style.display = 'none';
+        const addField = (name, value) => {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = name;
+            input.value = value;
+            form.appendChild(input);
+        };
+        if (currentQuery) {
+            // Searching: the files shown (loaded so far) in the list
+            filteredFiles.forEach(file => addField('keys', file.key));
+        } else {
+            addField('prefix', '');
+        }
+        document.body.appendChild(form);
+        form.submit();
+        document.body.removeChild(form);
+        showNotification('ZIP download started.', 'success');
+    });
+
     // --- Function notify ---
     const showNotification = (message, type = 'info') => {
         const notification = document.getElementById('notification');
@@ -480,6 +728,36 @@ document.addEventListener('DOMContentLoaded', () => {
         }, 3000);
     };
 
+    // --- Fetch one page of files ---
+    const fetchFilesPage = async (cursor) => {
+        const params = new URLSearchParams({ limit: filesPageSize, t: Date.now() });
+        if (currentQuery) params.set('q', currentQuery);
+        if (cursor) params.set('cursor', cursor);
+
+        const response = await fetch(`/api/files?${params}`, { cache: 'no-cache', credentials: 'same-origin' });
+        if (handleAuthError(response.status)) return null;
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        return response.json();
+    };
+
+    // --- Infinite scroll: append the next page ---
+    const loadMoreFiles = async () => {
+        if (!nextCursor || isLoadingPage) return;
+        isLoadingPage = true;
+        const query = currentQuery;
+        try {
+            const result = await fetchFilesPage(nextCursor);
+            if (!result || query !== currentQuery) return;
+            filteredFiles = filteredFiles.concat(result.files || []);
+            nextCursor = result.next_cursor;
+            createFileSlides(true);
+        } catch (error) {
+            console.error('Failed to load more files:', error);
+        } finally {
+            isLoadingPage = false;
+        }
+    };
+
     // --- Fetch data & view file ---
     const fetchAndDisplayFiles = async () => {
         try {
@@ -487,14 +765,13 @@ document.addEventListener('DOMContentLoaded', () => {
             loadingMessage.innerHTML = '<span class="loading-spinner"></span> Loading files...';
             fileSliderContainer.style.display = 'none';
             
-            const response = await fetch('/api/files?t=' + Date.now(), { cache: 'no-cache', credentials: 'same-origin' });
-            if (handleAuthError(response.status)) return;
-            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            isLoadingPage = true;
+            const result = await fetchFilesPage(null);
+            isLoadingPage = false;
+            if (!result) return;
             
-            const result = await response.json();
-            
-            allFiles = result.files || [];
-            filteredFiles = [...allFiles];
+            filteredFiles = result.files || [];
+            nextCursor = result.next_cursor;
             
             createFileSlides();
             updateBucketStats(result.stats || {
@@ -511,14 +788,61 @@ document.addEventListener('DOMContentLoaded', () => {
             console.error('Failed to load files:', error);
             loadingMessage.textContent = `Error: ${error.message}`;
             loadingMessage.style.color = '#e74c3c';
-            allFiles = [];
+            isLoadingPage = false;
+            nextCursor = null;
             filteredFiles = [];
             createFileSlides();
         }
     };
 
+    // --- Live updates: apply change feed events to the loaded list ---
+    const subscribeToChanges = () => {
+        if (!window.EventSource) return;
+        const source = new EventSource('/api/events');
+        const on = (type, handler) => source.addEventListener(type, (e) => handler(JSON.parse(e.data)));
+
+        source.onopen = () => { liveUpdates = true; };
+        source.onerror = () => {
+            // EventSource reconnects by itself (resuming from the last event id) unless CLOSED
+            if (source.readyState === EventSource.CLOSED) liveUpdates = false;
+        };
+
+        on('upload', (file) => {
+            filteredFiles = filteredFiles.filter(f => f.key !== file.key);
+            if (!currentQuery || file.key.toLowerCase().includes(currentQuery.toLowerCase())) {
+                filteredFiles.unshift(file);
+            }
+            createFileSlides(true);
+        });
+        on('delete', ({ keys }) => {
+            const removed = new Set(keys);
+            const before = filteredFiles.length;
+            filteredFiles = filteredFiles.filter(f => !removed.has(f.key));
+            if (filteredFiles.length !== before) createFileSlides(true);
+        });
+        on('downloads', ({ counts }) => {
+            filteredFiles.forEach(file => {
+                if (counts[file.key] === undefined) return;
+                file.download_count = counts[file.key];
+                const button = fileList.querySelector(`.btn-download[data-filename="${CSS.escape(file.key)}"]`);
+                const counter = button && button.closest('.file-card').querySelector('.download-count');
+                if (counter) counter.innerHTML = `<i class="fas fa-download"></i> ${file.download_count} times`;
+            });
+        });
+        on('thumbnail', ({ key, thumbnail_url }) => {
+            const file = filteredFiles.find(f => f.key === key);
+            if (!file) return;
+            file.thumbnail_url = thumbnail_url;
+            createFileSlides(true);
+        });
+        on('stats', updateBucketStats);
+        on('resync', () => fetchAndDisplayFiles());
+    };
+
     // Initialize
+    loadTransferConfig();
     fetchAndDisplayFiles();
+    subscribeToChanges();
     
     // Update countdown every day
     setInterval(fetchAndDisplayFiles, 24 * 60 * 60 * 1000);